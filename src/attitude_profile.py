@@ -0,0 +1,105 @@
+import csv
+import os
+import numpy as np
+from logger import logger as log
+from profiling import profiled
+from celestial_bodies import get_interval_states, get_target_position
+from quaternions import target_unit_vectors_from_positions, shortest_arc_quaternions
+
+DAY_S = 24*60*60
+
+# One little-endian record per sample of the binary profiles, 52 bytes
+profile_dtype = np.dtype([('capture', '<u4'), ('time', '<f8'), ('qs', '<f8'), ('qx', '<f8'), ('qy', '<f8'), ('qz', '<f8'), ('off_nadir_deg', '<f8')])
+
+csv_header = ['capture', 'time', 'qx', 'qy', 'qz', 'qs', 'off_nadir_deg']
+
+@profiled('attitude_profile.get_attitude_profile')
+def get_attitude_profile(captures, sat, target, observer, ts, rate, durations):
+    """
+    Sample the quaternion and off nadir angle tracking a target over the capture interval of each capture.
+
+    Each capture interval is centred on the capture time, and sampled from its start at the rate up to
+    its end. The samples of all captures are evaluated as one time array: the satellite is propagated
+    with one SGP4 call, see celestial_bodies.get_interval_states, the target is observed once and the
+    orbit frames are built at once, see quaternions.target_unit_vectors_from_positions.
+
+    Arguments:
+        captures: list of tuples of time, quaternion and off nadir angle, as returned by the planners
+        sat: skyfield EarthSatellite
+        target: skyfield object or EphemerisTable
+        observer: skyfield object
+        ts: skyfield timescale
+        rate: float, samples per second
+        durations: float or array of shape (C,), length of the capture intervals in seconds,
+            e.g. hypso_moon_script_cmd_generator.calculate_total_capture_time of the off nadir angles
+
+    Returns:
+        structured array of shape (N,) with dtype profile_dtype. capture is the number of the capture from 1,
+        time the UNIX time in seconds and qs, qx, qy, qz the quaternion q_ob as in get_quaternion
+    """
+    if not captures:
+        return np.zeros(0, dtype=profile_dtype)
+
+    durations = np.broadcast_to(np.asarray(durations, dtype=float), (len(captures),))
+    counts = np.floor(durations * rate).astype(int) + 1
+
+    # Seconds from the capture time of every sample, the samples of each capture after each other
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    offsets = (np.arange(counts.sum()) - first) / rate - np.repeat(durations / 2, counts)
+
+    centres = ts.from_datetimes([capture[0] for capture in captures])
+    times = ts.tt_jd(np.repeat(centres.whole, counts), np.repeat(centres.tt_fraction, counts) + offsets / DAY_S)
+
+    sat_pos, sat_vel = get_interval_states(times, sat, centres, counts)
+    u = target_unit_vectors_from_positions(sat_pos, sat_vel, get_target_position(times, target, observer))
+    q = shortest_arc_quaternions(u)
+
+    profile = np.empty(len(offsets), dtype=profile_dtype)
+    profile['capture'] = np.repeat(np.arange(1, len(captures) + 1), counts)
+    profile['time'] = np.repeat([capture[0].timestamp() for capture in captures], counts) + offsets
+    profile['qs'], profile['qx'], profile['qy'], profile['qz'] = q.T
+    profile['off_nadir_deg'] = np.degrees(np.arccos(np.clip(u[:, 2], -1, 1)))
+    log.debug('Sampled {} attitudes of {} captures at {} Hz'.format(len(profile), len(captures), rate))
+
+    return profile
+
+def write_attitude_profile(path, profile):
+    """
+    Write an attitude profile to a file, with the format given by its extension: .csv, or else binary.
+
+    The binary format is the records of profile_dtype back to back without a header, readable with
+    numpy.fromfile(path, dtype=profile_dtype) or read_attitude_profile.
+
+    Arguments:
+        path: str, path of the profile file
+        profile: structured array with dtype profile_dtype, as returned by get_attitude_profile
+    """
+    if os.path.splitext(path)[1].lower() == '.csv':
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(csv_header)
+            writer.writerows(zip(profile['capture'].tolist(), *(profile[field].tolist() for field in csv_header[1:])))
+    else:
+        profile.astype(profile_dtype, copy=False).tofile(path)
+    log.info('Wrote {} attitudes to {}'.format(len(profile), path))
+
+def read_attitude_profile(path):
+    """
+    Read back an attitude profile written by write_attitude_profile.
+
+    Arguments:
+        path: str, path of the profile file
+
+    Returns:
+        structured array with dtype profile_dtype
+    """
+    if os.path.splitext(path)[1].lower() != '.csv':
+        return np.fromfile(path, dtype=profile_dtype)
+
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))[1:]
+    profile = np.empty(len(rows), dtype=profile_dtype)
+    for i, field in enumerate(csv_header):
+        profile[field] = [row[i] for row in rows]
+
+    return profile
@@ -0,0 +1,335 @@
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+import planner
+from celestial_bodies import get_satellite, get_target, geometry_modes
+from ephemeris import get_ephemeris, get_timescale
+from ephemeris_cache import get_ephemeris_table
+from plan_export import get_plan_writer
+from result_cache import ResultCache
+from visibility import VisibilityConstraints
+from progress import no_progress
+from logger import logger as log
+
+try:
+    import yaml
+except ImportError:
+    # Job files can only be JSON
+    yaml = None
+
+modes = ('single', 'multi', 'fleet', 'targets')
+
+# Values of a job that are not given in the job or in the defaults of the job file
+job_defaults = {
+    'mode': 'single',
+    'catnr': 51053,
+    'target': 301,
+    'start_hours': 0,
+    'end_hours': 24,
+    'search_interval': 1,
+    'tolerance': None,
+    'workers': None,
+    'cache_ephemeris': False,
+    'constraints': None,
+    'max_phase_angle': None,
+    'geometry': 'precise',
+    'cache_results': True,
+}
+
+# Keys of a job without a default
+job_keys = ('name', 'start', 'end', 'intervals', 'output')
+
+class InvalidJob(ValueError):
+    """
+    Raised for a job with unknown keys or invalid values.
+    """
+
+class PlannerState:
+    """
+    Timescale, ephemeris, satellites, targets and ephemeris tables loaded once and shared by every plan
+    run in the process. Satellites are loaded per catalog number the first time they are used, with the
+    same 24 hour TLE check as main.py. Single and multi plans are cached in the shared result cache,
+    by default the one in src/data/result_cache.
+    """
+
+    def __init__(self, ts=None, force_update=False, results=None):
+        self.ts = ts or get_timescale()
+        self.planets = get_ephemeris()
+        self.earth = self.planets['earth']
+        self.force_update = force_update
+        self.results = results if results is not None else ResultCache()
+        self._satellites = {}
+        self._targets = {}
+        self._tables = {}
+        self._lock = threading.RLock()
+
+    def satellite(self, catnr):
+        catnr = int(catnr)
+        with self._lock:
+            if catnr not in self._satellites:
+                self._satellites[catnr] = get_satellite({'catnr': catnr}, self.force_update)
+
+            return self._satellites[catnr]
+
+    def reload_satellite(self, catnr):
+        """
+        Run the TLE check of a satellite again, e.g. once a day in a long running process, and return the
+        satellite.
+        """
+        sat = get_satellite({'catnr': int(catnr)}, False)
+        with self._lock:
+            self._satellites[int(catnr)] = sat
+
+        return sat
+
+    def satellites(self):
+        with self._lock:
+            return dict(self._satellites)
+
+    def target(self, code, t_start=None, t_end=None, cache_ephemeris=False):
+        """
+        Get a target by segment number, or its ephemeris table covering t_start to t_end if cache_ephemeris
+        is True.
+        """
+        code = int(code)
+        with self._lock:
+            if code not in self._targets:
+                self._targets[code] = get_target(code)
+            target = self._targets[code]
+
+            if not cache_ephemeris:
+                return target
+
+            # Tables cover whole days, so any table covering the window can be reused
+            for table in self._tables.get(code, []):
+                if _table_covers(table, t_start, t_end):
+                    return table
+            table = get_ephemeris_table(t_start, t_end, target, self.earth)
+            self._tables.setdefault(code, []).append(table)
+
+            return table
+
+def load_jobs(path):
+    """
+    Read a job file, in JSON or, if PyYAML is installed, YAML.
+
+    The file holds either a list of jobs, or a dict with the list under 'jobs' and optional 'defaults'
+    applied to every job. Each job is a dict with the keys:
+
+    * mode: 'single', 'multi', 'fleet' or 'targets'
+    * catnr: the satellite catalog number, or a list of them in fleet mode
+    * target: the target segment number, or a list of them in targets mode
+    * start, end: the search window as ISO 8601 UTC times, or
+    * start_hours, end_hours: the search window in hours from the time the batch started
+    * intervals: the number of captures in multi, fleet and targets mode, default one per day
+    * search_interval: the search step in minutes
+    * tolerance: the time tolerance in seconds for refining the capture time
+    * workers: the number of worker processes in multi mode
+    * cache_ephemeris: serve the target from an ephemeris table
+    * constraints: the visibility constraints as a dict, see visibility.VisibilityConstraints. Not used in fleet and targets mode
+    * max_phase_angle: in multi mode with the Moon as target, skip the intervals where the phase angle of the Moon stays above it
+    * geometry: 'precise' or 'fast' target positions in the search, see celestial_bodies.get_target_position. Not used in fleet mode
+    * cache_results: serve and store the captures in the result cache, default true. Not used in fleet and targets mode
+    * name: the name of the job, used for the results file
+    * output: the results file, .txt, .csv or .jsonl
+
+    :param path: The path of the job file.
+    :return: The list of jobs, with the defaults applied.
+    """
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+            if yaml is None:
+                raise RuntimeError('PyYAML is required to read YAML job files: {}'.format(path))
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+
+    if isinstance(data, list):
+        data = {'jobs': data}
+    defaults = dict(job_defaults, **data.get('defaults', {}))
+
+    jobs = []
+    for i, job in enumerate(data['jobs']):
+        jobs.append(make_job(job, defaults, 'job-{}'.format(i + 1)))
+
+    return jobs
+
+def make_job(job, defaults=job_defaults, name='job'):
+    """
+    Apply the defaults to a job and check its keys and values. Raises InvalidJob for an invalid job.
+    """
+    job = dict(defaults, **job)
+    job.setdefault('name', name)
+    if job['mode'] not in modes:
+        raise InvalidJob('Unknown mode {} in job {}, expected one of {}'.format(job['mode'], job['name'], ', '.join(modes)))
+    unknown = sorted(set(job) - set(job_defaults) - set(job_keys))
+    if unknown:
+        raise InvalidJob('Unknown keys {} in job {}'.format(', '.join(unknown), job['name']))
+
+    lists = {'fleet': 'catnr', 'targets': 'target'}.get(job['mode'])
+    for key, types in (('catnr', int), ('target', (int, str))):
+        # Catalog numbers are integers, targets ephemeris codes or names
+        values = job[key] if key == lists and isinstance(job[key], list) else [job[key]]
+        if not values or not all(isinstance(value, types) and not isinstance(value, bool) for value in values):
+            raise InvalidJob('Invalid {} {} in job {}'.format(key, job[key], job['name']))
+    if job['search_interval'] != 'auto' and not _is_positive(job['search_interval']):
+        raise InvalidJob('Invalid search_interval {} in job {}, expected minutes or auto'.format(job['search_interval'], job['name']))
+    for key in ('tolerance', 'max_phase_angle'):
+        if job[key] is not None and not _is_positive(job[key]):
+            raise InvalidJob('Invalid {} {} in job {}'.format(key, job[key], job['name']))
+    for key in ('intervals', 'workers'):
+        if job.get(key) is not None and not (_is_int(job[key]) and job[key] > 0):
+            raise InvalidJob('Invalid {} {} in job {}'.format(key, job[key], job['name']))
+    for key in ('start_hours', 'end_hours'):
+        if not _is_number(job[key]):
+            raise InvalidJob('Invalid {} {} in job {}'.format(key, job[key], job['name']))
+    for key in ('cache_ephemeris', 'cache_results'):
+        if not isinstance(job[key], bool):
+            raise InvalidJob('Invalid {} {} in job {}, expected true or false'.format(key, job[key], job['name']))
+    if job['max_phase_angle'] is not None and str(job['target']).lower() not in ('301', 'moon'):
+        raise InvalidJob('max_phase_angle in job {} only applies to the Moon as target, not {}'.format(job['name'], job['target']))
+    if job['geometry'] not in geometry_modes:
+        raise InvalidJob('Unknown geometry {} in job {}, expected one of {}'.format(job['geometry'], job['name'], ', '.join(geometry_modes)))
+    if job['constraints'] is not None:
+        if not isinstance(job['constraints'], dict):
+            raise InvalidJob('Invalid constraints {} in job {}'.format(job['constraints'], job['name']))
+        try:
+            VisibilityConstraints.from_dict(job['constraints'])
+        except TypeError as e:
+            raise InvalidJob('Invalid constraints in job {}: {}'.format(job['name'], e))
+
+    return job
+
+def plan_job(job, state, t_now):
+    """
+    Run one plan request.
+
+    :param job: The job, as returned by load_jobs.
+    :param state: The PlannerState shared by the jobs.
+    :param t_now: The time start_hours and end_hours are counted from.
+    :return: The list of captures, an iterator of captures in multi mode, in fleet mode a dict with the list
+             of captures per catalog number, or in targets mode a dict with the list of captures per target.
+    """
+    ts = state.ts
+    t_start = _job_time(job, 'start', t_now, ts)
+    t_end = _job_time(job, 'end', t_now, ts)
+    intervals = job.get('intervals') or max(round((t_end - t_start)), 1)
+    if job['mode'] == 'targets':
+        codes = job['target'] if isinstance(job['target'], list) else [job['target']]
+        targets = [state.target(code, t_start, t_end, job['cache_ephemeris']) for code in codes]
+    else:
+        target = state.target(job['target'], t_start, t_end, job['cache_ephemeris'])
+
+    cache = state.results if job['cache_results'] else None
+
+    log.info('Job {}: {} plan from {} to {}'.format(job['name'], job['mode'], t_start.utc_iso(), t_end.utc_iso()))
+    if job['mode'] == 'single':
+        sat = state.satellite(job['catnr'])
+        return [planner.single_planner(t_start, t_end, sat, target, state.earth, job['search_interval'], ts, job['tolerance'], progress=no_progress, constraints=job['constraints'], geometry=job['geometry'], cache=cache)]
+    elif job['mode'] == 'multi':
+        sat = state.satellite(job['catnr'])
+        # Planned as the captures are consumed, so they can be written out one at a time
+        captures = planner.iter_multi_planner(t_start, t_end, sat, target, state.earth, intervals, job['search_interval'], ts, job['tolerance'], job['workers'], progress=no_progress, constraints=job['constraints'], max_phase_angle=job['max_phase_angle'], geometry=job['geometry'], cache=cache)
+        return (capture for _, capture in captures)
+    elif job['mode'] == 'targets':
+        sat = state.satellite(job['catnr'])
+        plans = planner.multi_target_planner(t_start, t_end, sat, targets, state.earth, intervals, job['search_interval'], ts, job['tolerance'], progress=no_progress, geometry=job['geometry'])
+        return dict(zip([int(code) for code in codes], plans))
+    else:
+        catnrs = job['catnr'] if isinstance(job['catnr'], list) else [job['catnr']]
+        sats = [state.satellite(catnr) for catnr in catnrs]
+        plans = planner.fleet_planner(t_start, t_end, sats, target, state.earth, intervals, job['search_interval'], ts, job['tolerance'], progress=no_progress)
+        return dict(zip([int(catnr) for catnr in catnrs], plans))
+
+def run_job(job, state, t_now, output_dir='results'):
+    """
+    Run one plan request and write its results file.
+
+    :param job: The job, as returned by load_jobs.
+    :param state: The PlannerState shared by the jobs.
+    :param t_now: The time start_hours and end_hours are counted from.
+    :param output_dir: The directory of results files without an explicit output.
+    :return: The list of results files written.
+    """
+    output = job.get('output') or os.path.join(output_dir, job['name'] + '.txt')
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    plan = plan_job(job, state, t_now)
+    if job['mode'] in ('fleet', 'targets'):
+        # One results file per satellite or target, named after the results file of the job
+        stem, extension = os.path.splitext(output)
+        plans = {'{}-{}{}'.format(stem, key, extension): captures for key, captures in plan.items()}
+    else:
+        plans = {output: plan}
+
+    for path, captures in plans.items():
+        try:
+            with get_plan_writer(path) as writer:
+                for capture in captures:
+                    writer.write(capture)
+        except BaseException:
+            # The multi plan is only planned while it is written, so a failed job leaves no partial results file
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+    log.info('Job {} written to {}'.format(job['name'], ', '.join(plans)))
+
+    return list(plans)
+
+def run_batch(path, output_dir='results', t_now=None, state=None):
+    """
+    Run every job of a job file in this process. A failing job is logged and the remaining jobs still run.
+
+    :param path: The path of the job file.
+    :param output_dir: The directory of results files without an explicit output.
+    :param t_now: The time start_hours and end_hours are counted from, default now.
+    :param state: The PlannerState to use, default a new one.
+    :return: The list of names of the failed jobs.
+    """
+    jobs = load_jobs(path)
+    state = state or PlannerState()
+    t_now = state.ts.now() if t_now is None else t_now
+
+    log.info('Running {} jobs from {}'.format(len(jobs), path))
+    failed = []
+    for i, job in enumerate(jobs):
+        log.info(f'Completed {i}/{len(jobs)} jobs')
+        try:
+            run_job(job, state, t_now, output_dir)
+        except Exception as e:
+            log.error('Job {} failed: {}'.format(job['name'], e))
+            failed.append(job['name'])
+
+    log.info('Completed {} of {} jobs'.format(len(jobs) - len(failed), len(jobs)))
+
+    return failed
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _is_positive(value):
+    return _is_number(value) and value > 0
+
+def _job_time(job, key, t_now, ts):
+    if job.get(key) is not None:
+        # YAML already parses ISO 8601 times, naive ones are UTC
+        try:
+            time = job[key] if isinstance(job[key], datetime) else datetime.fromisoformat(job[key].replace('Z', '+00:00'))
+        except (AttributeError, ValueError) as e:
+            raise InvalidJob('Invalid {} {} in job {}: {}'.format(key, job[key], job['name'], e))
+        return ts.from_datetime(time if time.tzinfo else time.replace(tzinfo=timezone.utc))
+
+    return t_now + timedelta(hours=job[key + '_hours'])
+
+def _table_covers(table, t_start, t_end):
+    # With half a day of margin after t_end, as the last search steps run past it
+    start = table.whole + table.fraction
+    end = start + table.step * (table.positions.shape[1] - 1)
+
+    return start <= t_start.tt and t_end.tt + 0.5 <= end
@@ -0,0 +1,164 @@
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import skyfield
+from skyfield.api import load
+
+import planner
+from distances import get_minimum_distance
+from ephemeris import get_ephemeris, get_timescale
+from logger import logger as log
+from logger import set_log_level
+from quaternions import get_quaternion, get_quaternions, get_maximum_off_nadir_angle
+from search import search_times
+
+# Pinned element set and start epoch, so that every run times exactly the same work
+default_tle = 'src/data/benchmark/tle-51053.txt'
+default_start = '2023-03-14T06:00:00Z'
+
+def get_cases(quick=False):
+    """
+    List the benchmark cases as (name, params) pairs.
+
+    :param quick: If True, only the shortest windows and coarsest steps are listed.
+    :return: The list of cases.
+    """
+    windows = [6, 24] if quick else [6, 24, 72]
+    steps = [1] if quick else [1, 0.25]
+
+    cases = []
+    for window in windows:
+        for step in steps:
+            cases.append(('get_minimum_distance', {'window_h': window, 'step_min': step}))
+            cases.append(('get_maximum_off_nadir_angle', {'window_h': window, 'step_min': step}))
+            cases.append(('single_planner', {'window_h': window, 'step_min': step}))
+    for n in [10] if quick else [10, 100]:
+        cases.append(('get_quaternion', {'epochs': n}))
+        cases.append(('get_quaternions', {'epochs': n}))
+    for window in [72] if quick else [72, 240]:
+        cases.append(('multi_planner', {'window_h': window, 'step_min': 1, 'intervals': window // 24}))
+
+    return cases
+
+def run_case(name, params, t_start, sat, target, earth, ts):
+    """
+    Run one benchmark case once.
+    """
+    if 'window_h' in params:
+        t_end = t_start + timedelta(hours=params['window_h'])
+
+    if name == 'get_minimum_distance':
+        get_minimum_distance(t_start, t_end, sat, target, earth, search_interval=params['step_min'])
+    elif name == 'get_maximum_off_nadir_angle':
+        get_maximum_off_nadir_angle(t_start, t_end, sat, target, earth, search_interval=params['step_min'])
+    elif name == 'single_planner':
+        planner.single_planner(t_start, t_end, sat, target, earth, params['step_min'], ts)
+    elif name == 'multi_planner':
+        planner.multi_planner(t_start, t_end, sat, target, earth, params['intervals'], params['step_min'], ts)
+    elif name == 'get_quaternion':
+        for i in range(params['epochs']):
+            get_quaternion(t_start + i/24/60, earth, target, sat)
+    elif name == 'get_quaternions':
+        get_quaternions(search_times(t_start, t_start + (params['epochs'] - 1)/24/60, 1/24/60), earth, target, sat)
+    else:
+        raise ValueError(f'Unknown benchmark case: {name}')
+
+def run_benchmarks(tle_file=default_tle, start=default_start, repeat=3, quick=False):
+    """
+    Time every benchmark case, offline, from a pinned TLE and a fixed start epoch.
+
+    :param tle_file: The TLE file of the satellite.
+    :param start: The start epoch as an ISO 8601 UTC string.
+    :param repeat: The number of timed runs per case, after one warm-up run.
+    :param quick: If True, only run the reduced set of cases.
+    :return: The report as a dict.
+    """
+    ts = get_timescale()
+    sat = load.tle_file(tle_file, ts=ts)[0]
+    planets = get_ephemeris()
+    earth = planets['earth']
+    target = planets['moon']
+    t_start = ts.from_datetime(datetime.fromisoformat(start.replace('Z', '+00:00')))
+
+    results = []
+    for name, params in get_cases(quick):
+        run_case(name, params, t_start, sat, target, earth, ts)
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            run_case(name, params, t_start, sat, target, earth, ts)
+            times.append(time.perf_counter() - t0)
+        result = {'name': name, 'params': params, 'min_s': min(times), 'median_s': statistics.median(times), 'repeat': repeat}
+        log.info('{} {}: median {:.4f} s, min {:.4f} s'.format(name, params, result['median_s'], result['min_s']))
+        results.append(result)
+
+    return {'meta': get_meta(tle_file, start), 'results': results}
+
+def get_meta(tle_file, start):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__, 'skyfield': skyfield.__version__, 'machine': platform.machine(), 'tle_file': tle_file, 'start': start}
+
+def compare(report, baseline, threshold):
+    """
+    Compare a report against a baseline report.
+
+    :param report: The report of this run.
+    :param baseline: The report to compare against, e.g. from the previous commit.
+    :param threshold: The allowed relative slowdown of the median time, e.g. 0.2 for 20 %.
+    :return: The list of regressions as dicts with the case, both medians and the ratio.
+    """
+    baseline_medians = {(r['name'], json.dumps(r['params'], sort_keys=True)): r['median_s'] for r in baseline['results']}
+
+    regressions = []
+    for result in report['results']:
+        key = (result['name'], json.dumps(result['params'], sort_keys=True))
+        if key not in baseline_medians:
+            continue
+        ratio = result['median_s'] / baseline_medians[key]
+        if ratio > 1 + threshold:
+            regressions.append({'name': result['name'], 'params': result['params'], 'baseline_s': baseline_medians[key], 'median_s': result['median_s'], 'ratio': ratio})
+
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the planning hot paths offline.')
+    parser.add_argument('-o', '--output', default=None, help='The JSON file to write the report to. Default is stdout.')
+    parser.add_argument('-b', '--baseline', default=None, help='A previous JSON report to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.2, help='The allowed relative slowdown against the baseline. Default is 0.2 (20 %%).')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='The number of timed runs per case. Default is 3.')
+    parser.add_argument('-q', '--quick', action='store_true', help='Only run the shortest windows and coarsest steps.')
+    parser.add_argument('--tle', default=default_tle, help=f'The pinned TLE file. Default is {default_tle}.')
+    parser.add_argument('--start', default=default_start, help=f'The fixed start epoch. Default is {default_start}.')
+    args = parser.parse_args()
+
+    # Keep the per-search debug output of the planners out of the timings
+    set_log_level('INFO')
+    report = run_benchmarks(args.tle, args.start, args.repeat, args.quick)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        log.info(f'Report written to {args.output}')
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        for regression in regressions:
+            log.error('Regression in {} {}: {:.4f} s -> {:.4f} s ({:.2f}x)'.format(regression['name'], regression['params'], regression['baseline_s'], regression['median_s'], regression['ratio']))
+        if regressions:
+            sys.exit(1)
+        log.info(f'No regressions above {args.threshold:.0%} against {args.baseline}')
@@ -1,75 +1,103 @@
 from skyfield.api import load
+from skyfield.sgp4lib import TEME
+from sgp4.api import SatrecArray, jday
+from ephemeris_cache import EphemerisTable
+from ephemeris import get_ephemeris, get_timescale
+from config_reader import locked, read_tle_state, update_tle_state
+from result_cache import invalidate_results
+import numpy as np
 import datetime
+import logging
+import os
 from logger import logger as log
-import json
+from profiling import profiled
 
 tle_path = 'src/data/tle_files/tle-CATNR-'
 config_path = 'src/data/config/config.json'
 tle_url = 'http://celestrak.org/NORAD/elements/gp.php?CATNR='
 
+geometry_modes = ('precise', 'fast')
+
+DAY_S = 24*60*60
+# Convergence limit of the light-time iteration of skyfield's observe(), in days
+OBSERVE_LIGHT_TIME_TOLERANCE = 1e-12
+
+@profiled('celestial_bodies.get_satellite')
 def get_satellite(config, force_update=False):
-    catnr = config['catnr']
+    """
+    Get the satellite of config['catnr'] from its local TLE file, reloading the file from URL if it
+    was pulled more than 24 hours ago, is missing, or force_update = True.
 
-    configured_at = config['configured_at']
-    try:
-        configured_at = datetime.datetime.strptime(configured_at, '%Y-%m-%d %H:%M:%S.%f')
-    except: 
-        configured_at = datetime.datetime.strptime(configured_at, '%Y-%m-%d %H:%M:%S')
-    
-    now = datetime.datetime.now()
-    time_diff = (now - configured_at).total_seconds()
+    When the TLE was last pulled is stored per catalog number in the config file. The check and
+    reload hold a lock on the TLE file, so parallel planning jobs reload it at most once.
+
+    Cached results of older element sets of the satellite are dropped, see result_cache.
+    """
+    catnr = config['catnr']
+    filename = tle_path + str(catnr) + '.txt'
     
-    # If time is more than 24 hours or force_update = True, reload the TLE file from URL
-    if abs(time_diff) > 24*60*60 or force_update:
-        log.info('Reloading TLE file from URL...')
-        url = tle_url + str(catnr)
-        filename = tle_path + str(catnr) + '.txt'
-        satellites = load.tle_file(url, filename=filename, reload=True)
-        sat = satellites[0]
+    with locked(filename):
+        state = read_tle_state(config_path, catnr)
+        last_pulled_tle = parse_config_time(state.get('last_pulled_tle', '1970-01-01 00:00:00'))
         
-        # Update configured_at
-        config['last_pulled_tle'] = str(now)
+        now = datetime.datetime.now()
+        time_diff = (now - last_pulled_tle).total_seconds()
         
-        # Save config file
-        with open(config_path, 'w') as f:
-            json.dump(config, f)
-    else:
-        try:
-            log.info('Loading TLE file from local file...')
-            filename = tle_path + str(catnr) + '.txt'
-            satellites = load.tle_file(filename)
-            sat = satellites[0]
-        except FileNotFoundError:
-            log.info('TLE file not found, reloading from URL...')
+        # If time is more than 24 hours or force_update = True, reload the TLE file from URL
+        if abs(time_diff) > 24*60*60 or force_update or not os.path.exists(filename):
+            log.info('Reloading TLE file from URL...')
             url = tle_url + str(catnr)
-            filename = tle_path + str(catnr) + '.txt'
-            satellites = load.tle_file(url, filename=filename, reload=True)
+            satellites = load.tle_file(url, filename=filename, reload=True, ts=get_timescale())
             sat = satellites[0]
-                
-    # Update config
-    config['configured_at'] = str(now)
-    config['name'] = sat.name
+            
+            update_tle_state(config_path, catnr, {'last_pulled_tle': str(now), 'name': sat.name})
+        else:
+            log.info('Loading TLE file from local file...')
+            satellites = load.tle_file(filename, ts=get_timescale())
+            sat = satellites[0]
+            
+            # Only written if the name changed
+            update_tle_state(config_path, catnr, {'name': sat.name})
     
-    # Save config file
-    with open(config_path, 'w') as f:
-        json.dump(config, f)
+    config['name'] = sat.name
+    invalidate_results(sat)
         
     return sat 
 
+def parse_config_time(time):
+    try:
+        return datetime.datetime.strptime(time, '%Y-%m-%d %H:%M:%S.%f')
+    except ValueError: 
+        return datetime.datetime.strptime(time, '%Y-%m-%d %H:%M:%S')
+
 def get_satellite_from_catnr(catnr, tle_url, save=True):
     url = tle_url + str(catnr)
     if save:
         filename = tle_path + str(catnr) + '.txt'
-        satellites = load.tle_file(url, filename=filename, reload=True)
+        satellites = load.tle_file(url, filename=filename, reload=True, ts=get_timescale())
     else:
-        satellites = load.tle_file(url)
+        satellites = load.tle_file(url, ts=get_timescale())
     sat = satellites[0]
     
     return sat
 
+def get_satellites_from_store(catnrs, t, store, force_update=False):
+    """
+    Get the satellites with the element sets nearest to time t from a TLE store. Element sets are
+    downloaded for catalog numbers missing from the store, or for all of them if force_update = True,
+    unless the store is offline.
+    """
+    for catnr in catnrs:
+        if not store.offline and (force_update or catnr not in store):
+            store.fetch(catnr=catnr)
+    satellites = [store.nearest(catnr, t) for catnr in catnrs]
+    
+    return satellites
+
+@profiled('celestial_bodies.get_target')
 def get_target(target):
     print(target)
-    planets = load('de421.bsp')
+    planets = get_ephemeris()
     target = planets[target]
     if target is not None:
         return target
@@ -77,15 +105,210 @@ def get_target(target):
         log.error('Target not supported. Exiting.')
         return
 
-def get_positions(time, target, object, observer):
+@profiled('observe')
+def get_target_position(time, target, observer, geometry='precise'):
+    """
+    Get the apparent position of a target seen from an observer.
+
+    In 'precise' mode the light time is solved at every epoch by observe(). In 'fast' mode it is solved
+    once, at the middle of the times, and the target is evaluated once per epoch with that fixed light time.
+    The error of either mode over a timeframe is bounded by get_geometry_error. Ephemeris tables are
+    interpolated in both modes.
+
+    Arguments:
+        time: skyfield time object, holding a single time or an array of times
+        target: skyfield object or EphemerisTable
+        observer: skyfield object
+        geometry: str, 'precise' or 'fast'
+
+    Returns:
+        array of shape (3,) or (3, N), position in km
+    """
+    if isinstance(target, EphemerisTable):
+        return target.position_km(time)
+    if geometry == 'fast':
+        return _fixed_light_time_position(time, target, observer)
+    if geometry != 'precise':
+        raise ValueError('Unknown geometry mode {}, expected one of {}'.format(geometry, ', '.join(geometry_modes)))
+    
     target_position = observer.at(time).observe(target).position.km
-    obj_position = object.at(time).position.km
+    
+    return target_position
+
+def _fixed_light_time_position(time, target, observer):
+    t_ref = time if time.shape == () else time[0] + (time[-1] - time[0]) / 2
+    light_time = observer.at(t_ref).observe(target).light_time
+
+    return target.at(time - light_time).position.km - observer.at(time).position.km
+
+def get_geometry_error(t_start, t_end, target, observer, geometry='fast', samples=25):
+    """
+    Bound the error of the apparent target positions of a geometry mode over a timeframe, as used by
+    a search over that timeframe.
+
+    The timing error is the largest difference between the light time used and the true light time,
+    i.e. for 'fast' the spread of the light time over the timeframe, whichever epoch within it the
+    light time was solved at. The target is then seen as it was up to that long before or after the
+    correct time, and its position is off by at most its barycentric speed times the timing error.
+
+    Ephemeris tables are interpolated in both modes, from precise positions, so their error is the
+    interpolation error of the table.
+
+    Arguments:
+        t_start: skyfield time object
+        t_end: skyfield time object
+        target: skyfield object or EphemerisTable
+        observer: skyfield object
+        geometry: str, 'precise' or 'fast'
+        samples: int, number of epochs the light time is sampled at
+
+    Returns:
+        dict with the timing error in s, position error in km and angular error in degrees seen from the observer
+    """
+    if geometry not in geometry_modes:
+        raise ValueError('Unknown geometry mode {}, expected one of {}'.format(geometry, ', '.join(geometry_modes)))
+
+    ts = t_start.ts
+    times = ts.tt_jd(t_start.whole, t_start.tt_fraction + (t_end - t_start) * np.linspace(0, 1, samples))
+    if isinstance(target, EphemerisTable):
+        distance = np.linalg.norm(target.position_km(times), axis=0)
+        return {'geometry': geometry, 'timing_error_s': 0.0, 'position_error_km': float(target.max_error), 'angular_error_deg': float(np.degrees(target.max_error / np.min(distance)))}
+
+    astrometric = observer.at(times).observe(target)
+    light_time = astrometric.light_time
+    distance = astrometric.distance().km
+
+    if geometry == 'fast':
+        timing_error = np.ptp(light_time) * DAY_S
+    else:
+        timing_error = OBSERVE_LIGHT_TIME_TOLERANCE * DAY_S
+
+    speed = np.max(np.linalg.norm(target.at(times).velocity.km_per_s, axis=0))
+    position_error = speed * timing_error
+
+    return {'geometry': geometry, 'timing_error_s': float(timing_error), 'position_error_km': float(position_error), 'angular_error_deg': float(np.degrees(position_error / np.min(distance)))}
+
+def report_geometry_error(t_start, t_end, target, observer, geometry, report=None):
+    """
+    Pass the error bound of the target positions of a scan to report, and log it at debug level in
+    'fast' mode. The bound is only computed when it is reported or logged.
+    """
+    logged = geometry != 'precise' and log.isEnabledFor(logging.DEBUG)
+    if report is None and not logged:
+        return
+
+    error = get_geometry_error(t_start, t_end, target, observer, geometry)
+    if logged:
+        log.debug('Geometry error of the scan: %s', error)
+    if report is not None:
+        report(error)
+
+def get_orbit_step(t, sat, target, observer, samples_per_revolution=16):
+    """
+    Derive the search step and revolution length of a satellite's view of a target, from the mean
+    motion of its element set and the angular rate of the target seen from the observer.
+
+    The geometry repeats once per revolution relative to the target direction. As the target moves, that
+    takes between 1/(n + w) and 1/(n - w) for a mean motion n and target rate w in revolutions per day,
+    and the shorter one is used, so no revolution holds two peaks.
+
+    Arguments:
+        t: skyfield time object, time the target rate is taken at
+        sat: skyfield EarthSatellite
+        target: skyfield object or EphemerisTable
+        observer: skyfield object
+        samples_per_revolution: int, number of search steps per revolution
+
+    Returns:
+        period: float, revolution length in days
+        step: float, search step in days
+    """
+    mean_motion = sat.model.no_kozai * 24*60 / (2*np.pi)
+    times = t + np.array([0, 1/24])
+    u = get_target_position(times, target, observer)
+    u = u / np.linalg.norm(u, axis=0)
+    target_rate = np.degrees(np.arccos(np.clip(np.dot(u[:, 0], u[:, 1]), -1, 1))) * 24 / 360
+
+    period = 1 / (mean_motion + target_rate)
+
+    return period, period / samples_per_revolution
+
+@profiled('sgp4')
+def propagate(time, object):
+    return object.at(time)
+
+def get_positions(time, target, object, observer):
+    target_position = get_target_position(time, target, observer)
+    obj_position = propagate(time, object).position.km
     
     positions = [obj_position, target_position]
 
     return positions
 
 def get_velocity(time,  object):
-    obj_velocity = object.at(time).velocity.km_per_s
+    obj_velocity = propagate(time, object).velocity.km_per_s
     
     return obj_velocity
+
+
+@profiled('sgp4')
+def get_fleet_states(times, sats):
+    """
+    Propagate many satellites over a time array with one batched SGP4 call.
+
+    The TEME to GCRS rotation is computed once for the time array and shared by all satellites.
+
+    Arguments:
+        times: skyfield time object holding an array of times
+        sats: list of skyfield EarthSatellite objects
+
+    Returns:
+        positions: array of shape (S, 3, N), GCRS positions in km
+        velocities: array of shape (S, 3, N), GCRS velocities in km/s
+        errors: array of shape (S, N), True where SGP4 failed to propagate
+    """
+    satrecs = SatrecArray([sat.model for sat in sats])
+    jd, fraction = _utc_jd(times)
+    errors, r_teme, v_teme = satrecs.sgp4(jd, fraction)
+
+    # TEME.rotation_at rotates GCRS to TEME, its transpose TEME to GCRS
+    R = np.swapaxes(TEME.rotation_at(times), 0, 1)
+    positions = np.einsum('ijn,snj->sin', R, r_teme)
+    velocities = np.einsum('ijn,snj->sin', R, v_teme)
+
+    return positions, velocities, errors != 0
+
+@profiled('sgp4')
+def get_interval_states(times, sat, centres, counts):
+    """
+    Propagate a satellite over short time intervals, e.g. the samples of captures, with one SGP4 call.
+
+    The TEME to GCRS rotation is computed once per interval, at its centre. Precession and nutation
+    turn it by less than 1e-9 radians per minute, so this only holds for intervals of minutes.
+
+    Arguments:
+        times: skyfield time object holding an array of times, the times of each interval after each other
+        sat: skyfield EarthSatellite
+        centres: skyfield time object holding an array of times, the centre of each interval
+        counts: array of shape (C,), number of times of each interval
+
+    Returns:
+        positions: array of shape (3, N), GCRS positions in km
+        velocities: array of shape (3, N), GCRS velocities in km/s
+    """
+    jd, fraction = _utc_jd(times)
+    errors, r_teme, v_teme = sat.model.sgp4_array(jd, fraction)
+    if np.any(errors):
+        log.warning('SGP4 failed to propagate {} at {} times'.format(sat.name, np.count_nonzero(errors)))
+
+    R = np.repeat(np.swapaxes(TEME.rotation_at(centres), 0, 1), counts, axis=2)
+    positions = np.einsum('ijn,nj->in', R, r_teme)
+    velocities = np.einsum('ijn,nj->in', R, v_teme)
+
+    return positions, velocities
+
+def _utc_jd(times):
+    # The UTC Julian dates SGP4 takes, split in a whole and a fraction
+    jd, fraction = jday(*times.utc)
+
+    return np.atleast_1d(jd), np.atleast_1d(fraction)
@@ -1,7 +1,15 @@
 import json
 import os
+import tempfile
+from contextlib import contextmanager
 from logger import logger as log
 
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks on this platform, writes are still atomic
+    fcntl = None
+
 def read_config(config_file):
     # Check if config file exists or if contents are empty
     if not os.path.exists(config_file):
@@ -44,11 +52,96 @@ def create_config_from_default(default_file, save_path=None):
     # Create config file
     config_file = os.path.join(os.path.dirname(default_file), os.path.basename(default_file).replace('default_', ''))
     try:
-        with open(save_path, 'w') as f:
-            json.dump(data, f, indent=4)
-            log.info("Created config file from default at path " + config_file)
+        write_config(save_path, data)
+        log.info("Created config file from default at path " + config_file)
     except(FileNotFoundError, json.JSONDecodeError) as e:
         log.error(f'Error creating config file: {e}')
         return None
     
-    return config_file
\ No newline at end of file
+    return config_file
+
+@contextmanager
+def locked(path):
+    """
+    Hold an exclusive lock on a file for the duration of the context, using a lock file next to it,
+    so that several processes can read-modify-write it safely.
+    """
+    with open(path + '.lock', 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def write_config(config_file, data):
+    """
+    Write a config file atomically, by writing a temporary file in the same directory and renaming
+    it over the config file. Readers see either the old or the new file, never a partial one.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(config_file) or '.', prefix='.tmp-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, config_file)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def update_config(config_file, updates):
+    """
+    Merge updates into a config file under its lock. The file is only rewritten if the merged
+    content differs from what is on disk.
+
+    :param config_file: The path of the config file.
+    :param updates: The dict of keys to set. Dict values are merged one level deep.
+    :return: The merged config.
+    """
+    with locked(config_file):
+        data = read_config(config_file) or {}
+        merged = dict(data)
+        for key, value in updates.items():
+            if isinstance(value, dict) and isinstance(merged.get(key), dict):
+                merged[key] = {**merged[key], **value}
+            else:
+                merged[key] = value
+
+        if merged != data:
+            write_config(config_file, merged)
+
+    return merged
+
+def read_tle_state(config_file, catnr):
+    """
+    Read the TLE state of a satellite, e.g. when its TLE was last pulled, from the config file.
+
+    :param config_file: The path of the config file.
+    :param catnr: The satellite catalog number.
+    :return: The dict of the satellite's state, empty if it has none.
+    """
+    data = read_config(config_file) or {}
+
+    return data.get('tle_state', {}).get(str(catnr), {})
+
+def update_tle_state(config_file, catnr, state):
+    """
+    Update the TLE state of a satellite in the config file, leaving the other satellites untouched.
+
+    :param config_file: The path of the config file.
+    :param catnr: The satellite catalog number.
+    :param state: The dict of keys to set in the satellite's state.
+    :return: The satellite's updated state.
+    """
+    with locked(config_file):
+        data = read_config(config_file) or {}
+        tle_state = data.get('tle_state', {})
+        old = tle_state.get(str(catnr), {})
+        new = {**old, **state}
+        if new != old:
+            data['tle_state'] = {**tle_state, str(catnr): new}
+            write_config(config_file, data)
+
+    return new
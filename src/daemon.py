@@ -0,0 +1,139 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from batch import InvalidJob, PlannerState, make_job, modes, plan_job
+from plan_export import capture_to_dict
+from logger import logger as log
+from logger import set_log_level
+
+default_host = '127.0.0.1'
+default_port = 8750
+
+class PlannerDaemon:
+    """
+    Planning service keeping the timescale, the ephemeris, the satellites and the ephemeris tables loaded
+    between requests. Requests are served over HTTP on the local host, each in its own thread:
+
+    * POST /single, /multi, /fleet or /targets with a JSON job as body, see batch.load_jobs for the keys. The
+      mode is given by the path. The response holds the captures, or the captures per catalog number for
+      /fleet and per target for /targets.
+    * GET /health for the loaded satellites and the uptime.
+
+    The element sets of the loaded satellites are checked in the background every refresh_hours, with the
+    same 24 hour TLE check as main.py.
+    """
+
+    def __init__(self, host=default_host, port=default_port, refresh_hours=1, state=None):
+        self.state = state or PlannerState()
+        self.refresh_hours = refresh_hours
+        self.started = time.monotonic()
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.planner = self
+        self._stop = threading.Event()
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def serve_forever(self):
+        refresher = threading.Thread(target=self._refresh_loop, name='tle-refresh', daemon=True)
+        refresher.start()
+        log.info('Planner daemon listening on http://{}:{}'.format(*self.address))
+        try:
+            self.server.serve_forever()
+        finally:
+            self._stop.set()
+            self.server.server_close()
+
+    def shutdown(self):
+        self._stop.set()
+        self.server.shutdown()
+
+    def plan(self, mode, request):
+        """
+        Plan a request, raising batch.InvalidJob for an invalid one.
+        """
+        if not isinstance(request, dict):
+            raise InvalidJob('Expected a JSON object as request')
+        if request.get('mode', mode) != mode:
+            raise InvalidJob('Mode {} does not match the path /{}'.format(request['mode'], mode))
+        job = make_job(dict(request, mode=mode), name=request.get('name', mode))
+        plan = plan_job(job, self.state, self.state.ts.now())
+        if mode in ('fleet', 'targets'):
+            return {'plans': {str(key): [capture_to_dict(i + 1, capture) for i, capture in enumerate(captures)] for key, captures in plan.items()}}
+
+        return {'captures': [capture_to_dict(i + 1, capture) for i, capture in enumerate(plan)]}
+
+    def health(self):
+        satellites = self.state.satellites()
+
+        return {'status': 'ok', 'uptime_s': time.monotonic() - self.started, 'satellites': {str(catnr): {'name': sat.name, 'epoch': sat.epoch.utc_iso()} for catnr, sat in satellites.items()}}
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_hours * 3600):
+            for catnr in self.state.satellites():
+                try:
+                    self.state.reload_satellite(catnr)
+                except Exception as e:
+                    # Keep serving the element set already loaded
+                    log.error('Refreshing TLE of {} failed: {}'.format(catnr, e))
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/health':
+            self._respond(200, self.server.planner.health())
+        else:
+            self._respond(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        mode = self.path.strip('/')
+        if mode not in modes:
+            self._respond(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            self._respond(400, {'error': 'Invalid JSON request: {}'.format(e)})
+            return
+
+        t0 = time.perf_counter()
+        try:
+            response = self.server.planner.plan(mode, request)
+        except InvalidJob as e:
+            self._respond(400, {'error': str(e)})
+            return
+        except Exception as e:
+            log.exception('Planning request failed')
+            self._respond(500, {'error': str(e)})
+            return
+        response['elapsed_s'] = time.perf_counter() - t0
+
+        self._respond(200, response)
+
+    def log_message(self, format, *args):
+        log.debug('%s - %s', self.address_string(), format % args)
+
+    def _respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve planning requests over HTTP on the local host, with the ephemeris and satellites kept loaded.')
+    parser.add_argument('--host', default=default_host, help=f'The address to listen on. Default is {default_host}.')
+    parser.add_argument('-p', '--port', type=int, default=default_port, help=f'The port to listen on. Default is {default_port}.')
+    parser.add_argument('--refresh-hours', type=float, default=1, help='The hours between the background TLE checks of the loaded satellites. Default is 1.')
+    parser.add_argument('--log-level', default='INFO', help='The log level. Default is INFO.')
+    args = parser.parse_args()
+
+    set_log_level(args.log_level)
+    PlannerDaemon(args.host, args.port, args.refresh_hours).serve_forever()
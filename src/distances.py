@@ -1,6 +1,11 @@
 import numpy as np
 from skyfield.api import load, wgs84
 from logger import logger as log
+from search import refine_extremum, bracket, orbit_search, chunked_search, best_of_chunks, chunk_length, AUTO_TOLERANCE_S, SWEEP_MEMORY_BUDGET
+from celestial_bodies import get_target_position, report_geometry_error, get_orbit_step, propagate
+from profiling import profiled
+from progress import get_progress_reporter, check_cancelled
+from visibility import VisibilityConstraints, get_constrained_windows, get_window_times, iter_window_times, count_window_times, get_window
 
 def distance_obj_to_target(t, obj, target, observer):
     """
@@ -16,13 +21,34 @@ def distance_obj_to_target(t, obj, target, observer):
         float, distance in km
     """
     
-    target_position = observer.at(t).observe(target).position.km
+    target_position = get_target_position(t, target, observer)
 
-    obj_position = obj.at(t).position.km
+    obj_position = propagate(t, obj).position.km
     
     return np.linalg.norm(target_position - obj_position)
 
-def get_minimum_distance(t_start, t_end, obj, target, observer, search_interval=1):
+def distances_obj_to_target(times, obj, target, observer, geometry='precise'):
+    """
+    Compute the linear distance between an orbiting object and a target for every epoch in a time array.
+    
+    Arguments:
+        times: skyfield time object holding an array of times
+        obj: skyfield object
+        target: skyfield object
+        observer: skyfield object
+
+    Returns:
+        array of shape (N,), distances in km
+    """
+    
+    target_position = get_target_position(times, target, observer, geometry)
+
+    obj_position = propagate(times, obj).position.km
+    
+    return np.linalg.norm(target_position - obj_position, axis=0)
+
+@profiled('distances.get_minimum_distance')
+def get_minimum_distance(t_start, t_end, obj, target, observer, search_interval=1, batched=True, tolerance=None, progress=None, cancel=None, constraints=None, geometry='precise', memory_budget=SWEEP_MEMORY_BUDGET, geometry_report=None):
     """
     Find the time when the distance between an object and a target is minimum within a timeframe.
     
@@ -32,15 +58,79 @@ def get_minimum_distance(t_start, t_end, obj, target, observer, search_interval=
         obj: skyfield object
         target: skyfield object
         observer: skyfield object
-        search_interval: float, time step in minutes
+        search_interval: float, time step in minutes, or 'auto' to derive it from the orbit, see celestial_bodies.get_orbit_step.
+            The best step of each revolution is then refined, to the tolerance or else AUTO_TOLERANCE_S, see search.orbit_search
+        batched: bool, evaluate the whole timeframe as one time array instead of one epoch at a time
+        tolerance: float, time tolerance in seconds. If set, the best step is refined with Brent's method
+        progress: function taking the completed fraction, rate limited. Default only writes to a TTY
+        cancel: progress.CancellationToken, raises progress.SearchCancelled once cancelled
+        constraints: visibility.VisibilityConstraints or dict. If set, only the visibility windows satisfying them are searched
+        geometry: str, 'precise' or 'fast' target positions for the scan, see get_target_position. The result is always
+            evaluated, and refined, with precise positions
+        memory_budget: float, peak memory in bytes of the batched scan, which evaluates the timeframe in chunks
+            fitting it, see search.chunked_search. None evaluates the whole timeframe as one array
+        geometry_report: function taking the error bound of the target positions of the scan, a dict as returned
+            by celestial_bodies.get_geometry_error, called once per search
         
     Returns:
         min_d: float, minimum distance in km
         min_t: datetime object, time of minimum distance
     """
     
-    search_interval = search_interval * 1/24/60 # Transform from minutes to days
+    auto = search_interval == 'auto'
+    if auto:
+        period, search_interval = get_orbit_step(t_start, obj, target, observer)
+    else:
+        search_interval = search_interval * 1/24/60 # Transform from minutes to days
+    progress = get_progress_reporter(progress)
+    check_cancelled(cancel)
+    
+    constraints = VisibilityConstraints.from_dict(constraints)
+    window = (t_start, t_end)
+    refined = False
+    
+    if constraints is not None:
+        # Only the epochs within the visibility windows are searched
+        windows = get_constrained_windows(t_start, t_end, obj, target, observer, constraints, search_interval)
+        log.debug('Looking for minimum distance between {} and {} in {} visibility windows with search_interval {}.'.format(obj.name, target, len(windows), search_interval))
+        if batched:
+            chunks = iter_window_times(windows, search_interval, chunk_length(memory_budget))
+            min_t, min_d = best_of_chunks(lambda t: distances_obj_to_target(t, obj, target, observer, geometry), chunks, count_window_times(windows, search_interval), progress=progress, cancel=cancel)
+        else:
+            times = get_window_times(windows, search_interval)
+            d = np.array([distance_obj_to_target(t, obj, target, observer) for t in times])
+            i_min = np.argmin(d)
+            min_d = float(d[i_min])
+            min_t = times[i_min]
+        window = get_window(min_t, windows)
+    elif batched and auto:
+        log.debug('Looking for minimum distance between {} and {} from {} to {} per revolution of {:.2f} min with search_interval {}.'.format(obj.name, target, t_start.tt_strftime('%Y-%m-%d %H:%M:%S'), t_end.tt_strftime('%Y-%m-%d %H:%M:%S'), period*24*60, search_interval))
+        min_t, min_d = orbit_search(lambda t: distances_obj_to_target(t, obj, target, observer, geometry), t_start, t_end, period, search_interval, tolerance or AUTO_TOLERANCE_S, memory_budget=memory_budget, refine=None if geometry == 'precise' else lambda t: distances_obj_to_target(t, obj, target, observer))
+        refined = True
+    elif batched:
+        log.debug('Looking for minimum distance between {} and {} from {} to {} with search_interval {} (batched).'.format(obj.name, target, t_start.tt_strftime('%Y-%m-%d %H:%M:%S'), t_end.tt_strftime('%Y-%m-%d %H:%M:%S'), search_interval))
+        min_t, min_d = chunked_search(lambda t: distances_obj_to_target(t, obj, target, observer, geometry), t_start, t_end, search_interval, memory_budget, progress=progress, cancel=cancel)
+    else:
+        min_d, min_t = _iterate_minimum_distance(t_start, t_end, obj, target, observer, search_interval, progress, cancel)
+    
+    # The iterative scan always uses precise positions
+    report_geometry_error(t_start, t_end, target, observer, geometry if batched else 'precise', geometry_report)
+    # The refinement of the orbit search is already precise
+    if geometry != 'precise' and batched and not refined:
+        min_d = float(distance_obj_to_target(min_t, obj, target, observer))
+    
+    if tolerance is not None and not refined:
+        check_cancelled(cancel)
+        t_lo, t_hi = bracket(min_t, window[0], window[1], search_interval)
+        min_t, min_d = refine_extremum(lambda t: distance_obj_to_target(t, obj, target, observer), t_lo, t_hi, min_t, min_d, tolerance)
+            
+    log.debug('Minimum distance found at {} with distance {} km.'.format(min_t.utc_datetime(), min_d))
+    min_t = min_t.utc_datetime()
+    progress(1)
     
+    return min_d, min_t
+
+def _iterate_minimum_distance(t_start, t_end, obj, target, observer, search_interval, progress, cancel):
     min_d = distance_obj_to_target(t_start, obj, target, observer)
     min_t = t_start
     total_iterations = (t_end.tt - t_start.tt) / search_interval
@@ -48,9 +138,8 @@ def get_minimum_distance(t_start, t_end, obj, target, observer, search_interval=
     
     log.debug('Looking for minimum distance between {} and {} from {} to {} with search_interval {}.'.format(obj.name, target, t_start.tt_strftime('%Y-%m-%d %H:%M:%S'), t_end.tt_strftime('%Y-%m-%d %H:%M:%S'), search_interval))
     while t_start.tt + search_interval*iter < t_end.tt:
-        progress = iter / total_iterations * 100
-        print(f"Progress: {progress:.1f}%", end='\r')
-        # print('Completed ', progress, "%", end='\r')
+        progress(iter / total_iterations)
+        check_cancelled(cancel)
         
         iter += 1
         t = t_start + search_interval*iter
@@ -58,8 +147,5 @@ def get_minimum_distance(t_start, t_end, obj, target, observer, search_interval=
         if d < min_d:
             min_t = t
             min_d = d
-            
-    log.debug('Minimum distance found at {} with distance {} km.'.format(min_t.utc_datetime(), min_d))
-    min_t = min_t.utc_datetime()
     
     return min_d, min_t
\ No newline at end of file
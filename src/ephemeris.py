@@ -0,0 +1,39 @@
+from skyfield.api import load
+from logger import logger as log
+from profiling import stage
+
+ephemeris_file = 'de421.bsp'
+
+_ephemeris = None
+_timescale = None
+
+def get_ephemeris():
+    """
+    Get the planetary ephemeris, opened on first use and then shared by every caller in the process.
+
+    The kernel segments are memory-mapped read-only by jplephem, so processes opening the same file
+    share its pages through the page cache, and forked workers inherit the already opened kernel.
+
+    Returns:
+        skyfield SpiceKernel
+    """
+    global _ephemeris
+    if _ephemeris is None:
+        log.debug('Opening ephemeris {}...'.format(ephemeris_file))
+        with stage('ephemeris.open'):
+            _ephemeris = load(ephemeris_file)
+
+    return _ephemeris
+
+def get_timescale():
+    """
+    Get the timescale, loaded on first use and then shared by every caller in the process.
+
+    Returns:
+        skyfield Timescale
+    """
+    global _timescale
+    if _timescale is None:
+        _timescale = load.timescale()
+
+    return _timescale
@@ -0,0 +1,136 @@
+import math
+import os
+import numpy as np
+from logger import logger as log
+
+cache_path = 'src/data/ephemeris_cache/'
+
+DAY_S = 24*60*60
+
+class EphemerisTable:
+    """
+    Apparent positions of a target seen from an observer, sampled once on a regular grid over a
+    timeframe and served by cubic Hermite interpolation of the sampled positions and velocities.
+
+    A table can be passed as the target to the distance, quaternion and planner functions, in which
+    case the observer passed to those functions is not used.
+    """
+
+    def __init__(self, whole, fraction, step, positions, velocities, max_error, target_code, observer_code):
+        self.whole = whole
+        self.fraction = fraction
+        self.step = step
+        self.positions = positions
+        self.velocities = velocities
+        self.max_error = max_error
+        self.target = target_code
+        self.observer = observer_code
+
+    def __repr__(self):
+        return '<EphemerisTable {} seen from {}, {} samples every {} s, max error {:.3g} km>'.format(self.target, self.observer, self.positions.shape[1], self.step*DAY_S, self.max_error)
+
+    @classmethod
+    def build(cls, t_start, t_end, target, observer, step=1/24, max_error=1e-3):
+        """
+        Sample the apparent position of a target over a timeframe.
+
+        The interpolation error is measured at the midpoints between samples, where it peaks, and
+        the step is halved until it is below max_error.
+
+        Arguments:
+            t_start: skyfield time object
+            t_end: skyfield time object
+            target: skyfield object
+            observer: skyfield object
+            step: float, initial time step in days
+            max_error: float, maximum interpolation error in km
+
+        Returns:
+            EphemerisTable
+        """
+        ts = t_start.ts
+        while True:
+            n = max(math.ceil((t_end - t_start) / step), 1) + 1
+            times = ts.tt_jd(t_start.whole, t_start.tt_fraction + step*np.arange(n))
+            astrometric = observer.at(times).observe(target)
+            table = cls(t_start.whole, t_start.tt_fraction, step, astrometric.position.km, astrometric.velocity.km_per_s, 0.0, target.target, observer.target)
+
+            midpoints = ts.tt_jd(t_start.whole, t_start.tt_fraction + step*(np.arange(n - 1) + 0.5))
+            error = np.linalg.norm(table.position_km(midpoints) - observer.at(midpoints).observe(target).position.km, axis=0)
+            table.max_error = float(error.max())
+            if table.max_error <= max_error:
+                log.debug('Built {}'.format(table))
+                return table
+
+            step = step / 2
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+
+        return cls(float(data['whole']), float(data['fraction']), float(data['step']), data['positions'], data['velocities'], float(data['max_error']), int(data['target']), int(data['observer']))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, whole=self.whole, fraction=self.fraction, step=self.step, positions=self.positions, velocities=self.velocities, max_error=self.max_error, target=self.target, observer=self.observer)
+
+    def position_km(self, time):
+        """
+        Interpolate the apparent position of the target.
+
+        Arguments:
+            time: skyfield time object, holding a single time or an array of times
+
+        Returns:
+            array of shape (3,) or (3, N), position in km
+        """
+        x = ((time.whole - self.whole) + (time.tt_fraction - self.fraction)) / self.step
+        n = self.positions.shape[1]
+        if np.any(x < 0) or np.any(x > n - 1):
+            raise ValueError('Time outside of {}'.format(self))
+
+        i = np.minimum(np.floor(x).astype(int), n - 2)
+        s = x - i
+        h = self.step * DAY_S
+
+        h00 = 2*s**3 - 3*s**2 + 1
+        h10 = s**3 - 2*s**2 + s
+        h01 = -2*s**3 + 3*s**2
+        h11 = s**3 - s**2
+
+        position = h00*self.positions[:, i] + h10*h*self.velocities[:, i] + h01*self.positions[:, i + 1] + h11*h*self.velocities[:, i + 1]
+
+        return position
+
+def get_ephemeris_table(t_start, t_end, target, observer, step=1/24, max_error=1e-3):
+    """
+    Get the ephemeris table of a target covering a timeframe, from disk if it was built before.
+
+    The timeframe is widened to whole days, with one extra day after t_end to cover the last search
+    steps, so that reruns on the same days share the same table.
+
+    Arguments:
+        t_start: skyfield time object
+        t_end: skyfield time object
+        target: skyfield object
+        observer: skyfield object
+        step: float, initial time step in days
+        max_error: float, maximum interpolation error in km
+
+    Returns:
+        EphemerisTable
+    """
+    ts = t_start.ts
+    day_start = math.floor(t_start.tt - 0.5) + 0.5
+    day_end = math.ceil(t_end.tt - 0.5) + 1.5
+
+    filename = os.path.join(cache_path, 'ephemeris-{}-{}-{:.1f}-{:.1f}-{:g}s-{:g}km.npz'.format(target.target, observer.target, day_start, day_end, step*DAY_S, max_error))
+    if os.path.exists(filename):
+        log.info('Loading ephemeris table from {}...'.format(filename))
+        return EphemerisTable.load(filename)
+
+    log.info('Building ephemeris table for {} from {} to {}...'.format(target.target, ts.tt_jd(day_start).utc_strftime('%Y-%m-%d'), ts.tt_jd(day_end).utc_strftime('%Y-%m-%d')))
+    table = EphemerisTable.build(ts.tt_jd(day_start), ts.tt_jd(day_end), target, observer, step, max_error)
+    table.save(filename)
+
+    return table
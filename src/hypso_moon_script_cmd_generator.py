@@ -1,18 +1,20 @@
 import argparse
-from celestial_bodies import get_satellite_from_catnr, get_target
+from celestial_bodies import get_satellites_from_store, get_target
 from datetime import timedelta
-from distances import distance_obj_to_target
 import numpy as np
 import math
 from logger import logger as log
 from logger import set_log_level
 from planner import multi_planner
+from ephemeris_cache import get_ephemeris_table
+from tle_store import TLEStore
+from profiling import enable_profiling
 
-from skyfield.api import load
+from ephemeris import get_ephemeris, get_timescale
 
 set_log_level('INFO')
 
-def plan_hypso_moon_capture(t_start_delta=0, t_end_delta=72, intervals=3, search_interval=1):
+def plan_hypso_moon_capture(t_start_delta=0, t_end_delta=72, intervals=3, search_interval=1, tolerance=None, workers=None, cache_ephemeris=False, offline=False, max_phase_angle=None):
     """
     Calculates the minimum distance between the satellite and target for a given time frame and
     the corresponding quaternion for each time frame.
@@ -21,46 +23,66 @@ def plan_hypso_moon_capture(t_start_delta=0, t_end_delta=72, intervals=3, search
     :param t_end_delta: The end time of the time frame.
     :param intervals: The number of intervals to split the time frame into.
     :param search_interval: The search_interval for the minimum distance calculation.
+    :param tolerance: The time tolerance in seconds for refining the capture time, or None to keep the best search step.
+    :param workers: The number of worker processes planning the intervals in parallel, or None to plan them one after another.
+    :param cache_ephemeris: If True, the Moon is served from an interpolated ephemeris table cached on disk.
+    :param offline: If True, the element set nearest to the start time is taken from the local TLE store without downloading.
+    :param max_phase_angle: The maximum phase angle of the Moon in degrees. Intervals too far from full moon are skipped.
     :return: A list of tuples containing the minimum distance time and corresponding quaternion for
              each time frame.
     """
     
-    ts = load.timescale()
+    ts = get_timescale()
     t_now = ts.now()
 
-    tle_url = 'http://celestrak.org/NORAD/elements/gp.php?CATNR='
-    sat = get_satellite_from_catnr(51053, tle_url, True)
-    target = get_target(301)
-    planets = load('de421.bsp')
-    earth = planets['earth']
-    moon = planets['moon']
-    sun = planets['sun']
-    
     t_start = t_now + timedelta(hours=t_start_delta)
     t_end = t_now + timedelta(hours=t_end_delta)
     
-    results = multi_planner(t_start, t_end, sat, target, earth, intervals, search_interval, ts)
+    sat, = get_satellites_from_store([51053], t_start, TLEStore(offline=offline, ts=ts), force_update=True)
+    target = get_target(301)
+    earth = get_ephemeris()['earth']
+    
+    if cache_ephemeris:
+        target = get_ephemeris_table(t_start, t_end, target, earth)
+    
+    positions = []
+    results = multi_planner(t_start, t_end, sat, target, earth, intervals, search_interval, ts, tolerance, workers, max_phase_angle=max_phase_angle, positions=positions)
+
+    return get_capture_metadata(results, positions)
 
+def get_capture_metadata(results, positions):
+    """
+    Builds the capture dictionaries of a plan, with the fps, frames and distances of all captures computed
+    at once. The distances are taken from the positions the planner computed the captures from, so no
+    ephemeris is evaluated.
+
+    :param results: The list of tuples of time, quaternion and off nadir angle returned by the planner.
+    :param positions: The list of tuples of the satellite, Moon and Sun positions in km at each capture time,
+                      as filled by multi_planner.
+    :return: The dict of capture dictionaries, by capture_<nr>.
+    """
+    
+    if not results:
+        return {}
+    
+    off_nadir_angles = np.array([result[2] for result in results])
+    total_times = calculate_total_capture_time(off_nadir_angles)
+    # capture_time_start = calculate_capture_start_time(capture_time, total_time)
+    frames, fps = calculate_frames(total_times)
+    sat_pos, moon_pos, sun_pos = (np.array(position) for position in zip(*positions))
+    d_sun_moon = np.round(np.linalg.norm(moon_pos - sun_pos, axis=1)).astype(int)
+    d_sat_moon = np.round(np.linalg.norm(moon_pos - sat_pos, axis=1)).astype(int)
+    
     results_dict = {}
-    for i, result in enumerate(results):
-        off_nadir_angle = result[2]
-        quaternions = result[1]
-        capture_time_utc = result[0]
-        capture_start = int(result[0].timestamp())
-        total_time = calculate_total_capture_time(off_nadir_angle)
-        # capture_time_start = calculate_capture_start_time(capture_time, total_time)
-        frames, fps = calculate_frames(total_time)
-        t_start = ts.utc(capture_time_utc) 
-        d_sun_moon = round(distance_obj_to_target(t_start, sun, moon, sun))
-        d_sat_moon = round(distance_obj_to_target(t_start, sat, moon, earth))
-        
-        results_dict[f'capture_{i+1}'] = {'datetime_center': capture_time_utc, 'capture_start': capture_start, 'qs (r)': quaternions[0], 'qx (l)': quaternions[1], 'qy (j)': quaternions[2], 'qz (k)': quaternions[3], 'fps': fps, 'frames': frames, 'total_time': total_time, 'off_nadir_angle': off_nadir_angle, 'd_sun_moon': d_sun_moon, 'd_sat_moon': d_sat_moon}
+    for i, (capture_time_utc, quaternions, off_nadir_angle) in enumerate(results):
+        capture_start = int(capture_time_utc.timestamp())
+        results_dict[f'capture_{i+1}'] = {'datetime_center': capture_time_utc, 'capture_start': capture_start, 'qs (r)': quaternions[0], 'qx (l)': quaternions[1], 'qy (j)': quaternions[2], 'qz (k)': quaternions[3], 'fps': float(fps[i]), 'frames': int(frames[i]), 'total_time': float(total_times[i]), 'off_nadir_angle': off_nadir_angle, 'd_sun_moon': int(d_sun_moon[i]), 'd_sat_moon': int(d_sat_moon[i])}
 
     return results_dict
     
 def calculate_total_capture_time(off_nadir_angle):
     """
-    Calculates the total capture time for a given off-nadir angle.
+    Calculates the total capture time for a given off-nadir angle, or an array of them.
 
     :param off_nadir_angle: The off-nadir angle.
     :return: The total capture time in seconds.
@@ -72,7 +94,7 @@ def calculate_total_capture_time(off_nadir_angle):
     sat_speed = 7.6 # satellite's linear speed in km/s
     moon_diameter = 3474 # moon's diameter in km
 
-    total_time = 1/(math.sqrt((sat_speed / moon_diameter)**2 + (extra_rotation_speed / moon_fov)**2))
+    total_time = 1/(np.sqrt((sat_speed / moon_diameter)**2 + (extra_rotation_speed / moon_fov)**2))
 
     return total_time
     
@@ -96,10 +118,10 @@ def calculate_frames(total_time):
 
     # Calculate the required FPS to capture the object in the given time
     required_fps = target_frames / total_time
-    required_fps = max(min(required_fps, target_fps), 1)  # Ensure the FPS is between 1 and 20
+    required_fps = np.clip(required_fps, 1, target_fps)  # Ensure the FPS is between 1 and 20
 
     # Calculate the number of frames based on the required FPS
-    num_frames = round(total_time * required_fps)
+    num_frames = np.round(total_time * required_fps).astype(int)
 
     return num_frames, required_fps
 
@@ -139,15 +161,15 @@ def create_script_generator_cmd(capture, buff_file=33, append=True):
 
     return cmd
 
-def get_script_generator_cmds(start_time_delta, end_time_delta, intervals, search_interval, buff_file, append):
-    t_now = load.timescale().now()
+def get_script_generator_cmds(start_time_delta, end_time_delta, intervals, search_interval, buff_file, append, tolerance=None, workers=None, cache_ephemeris=False, offline=False, max_phase_angle=None, output=None):
+    t_now = get_timescale().now()
     t_start = t_now + timedelta(hours=start_time_delta)
     t_end = t_now + timedelta(hours=end_time_delta)
     log.info('Using start time: {} UTC'.format(t_start.tt_strftime('%Y-%m-%d %H:%M:%S')))
     log.info('Using end time: {} UTC'.format(t_end.tt_strftime('%Y-%m-%d %H:%M:%S')))
     log.info('Using {} intervals with {} seconds between each search'.format(intervals, round(search_interval*60)))
 
-    plans = plan_hypso_moon_capture(start_time_delta, end_time_delta, intervals=intervals, search_interval=search_interval)
+    plans = plan_hypso_moon_capture(start_time_delta, end_time_delta, intervals=intervals, search_interval=search_interval, tolerance=tolerance, workers=workers, cache_ephemeris=cache_ephemeris, offline=offline, max_phase_angle=max_phase_angle)
 
     # log.info('Generated the following plans:')
     # for key in plans:
@@ -164,9 +186,15 @@ def get_script_generator_cmds(start_time_delta, end_time_delta, intervals, searc
     if len(plans) <= 1:
         append = False
         
+    cmds = [create_script_generator_cmd(plans[key], append=append) for key in plans]
+    if output:
+        with open(output, 'w') as f:
+            f.writelines(cmd + '\n' for cmd in cmds)
+        log.info('Wrote {} commands to {}'.format(len(cmds), output))
+        return
+    
     log.info('Generated the following commands:')
-    for key in plans:
-        cmd = create_script_generator_cmd(plans[key], append=append)
+    for cmd in cmds:
         print(cmd)
 
 default_start_delta = 0
@@ -175,17 +203,30 @@ default_search_interval = 1
 default_buff = 33
 default_append = False
 
-# Add the command line arguments
-parser = argparse.ArgumentParser(description='Generate the script generator commands for moon captures.')
-parser.add_argument('-s', '--start', type=int, default=0, help=(f'The start time delta in hours. Default is {default_start_delta}.'))
-parser.add_argument('-e', '--end', type=int, default=24, help=(f'The end time delta in hours. Default is {default_end_delta}.'))
-parser.add_argument('-i', '--intervals', type=int, default=None, help='The number of intervals to use. Default is (-e - -s)/24 (one capture per day).')
-parser.add_argument('-t', '--time_interval', type=float, default=default_search_interval, help=(f'The time interval to use when searching. Default is {default_search_interval} (1, i.e. every minute).'))
-parser.add_argument('-b', '--buff', type=int, default=default_buff, help=(f'The buff file to use. Defualt is {default_buff}.'))
-parser.add_argument('-a', '--append', type=bool, default=default_append, help=(f'Set to true if you plan multiple captures. Default is {default_append}.'))
-
-# Parse the command line arguments
-args = parser.parse_args()
-args.intervals = args.intervals if args.intervals is not None else int((args.end - args.start) / 24)
+if __name__ == '__main__':
+    # Add the command line arguments
+    parser = argparse.ArgumentParser(description='Generate the script generator commands for moon captures.')
+    parser.add_argument('-s', '--start', type=int, default=0, help=(f'The start time delta in hours. Default is {default_start_delta}.'))
+    parser.add_argument('-e', '--end', type=int, default=24, help=(f'The end time delta in hours. Default is {default_end_delta}.'))
+    parser.add_argument('-i', '--intervals', type=int, default=None, help='The number of intervals to use. Default is (-e - -s)/24 (one capture per day).')
+    parser.add_argument('-t', '--time_interval', type=float, default=default_search_interval, help=(f'The time interval to use when searching. Default is {default_search_interval} (1, i.e. every minute).'))
+    parser.add_argument('--tolerance', type=float, default=None, help='The time tolerance in seconds used to refine each capture time, e.g. 0.01. Default is no refinement.')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='The number of worker processes planning the intervals in parallel. Default is no parallelism.')
+    parser.add_argument('--cache-ephemeris', action='store_true', help='Serve the Moon from an interpolated ephemeris table cached on disk instead of evaluating de421.bsp at every step.')
+    parser.add_argument('--offline', action='store_true', help='Plan with the local TLE store only, without downloading new element sets.')
+    parser.add_argument('--max-phase-angle', type=float, default=None, help='Only plan the intervals where the phase angle of the Moon gets below this value in degrees, i.e. close enough to full moon. Default is all intervals.')
+    parser.add_argument('-o', '--output', default=None, help='Write the commands to this file, one per line, instead of printing them.')
+    parser.add_argument('--profile', default=None, help='Record the wall time, calls and allocations of each planning stage, and write them as JSON to this file.')
+    parser.add_argument('-b', '--buff', type=int, default=default_buff, help=(f'The buff file to use. Defualt is {default_buff}.'))
+    parser.add_argument('-a', '--append', type=bool, default=default_append, help=(f'Set to true if you plan multiple captures. Default is {default_append}.'))
+
+    # Parse the command line arguments
+    args = parser.parse_args()
+    args.intervals = args.intervals if args.intervals is not None else int((args.end - args.start) / 24)
+    profile = enable_profiling() if args.profile else None
  
-get_script_generator_cmds(args.start, args.end, args.intervals, args.time_interval, args.buff, args.append)
\ No newline at end of file
+    get_script_generator_cmds(args.start, args.end, args.intervals, args.time_interval, args.buff, args.append, args.tolerance, args.workers, args.cache_ephemeris, args.offline, args.max_phase_angle, args.output)
+    
+    if profile:
+        profile.log()
+        profile.save(args.profile)
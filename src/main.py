@@ -2,22 +2,30 @@ from config_reader import read_config
 from celestial_bodies import *
 from distances import *
 from quaternions import get_quaternion
+from ephemeris_cache import get_ephemeris_table
+from tle_store import TLEStore
 from logger import logger as log
 from logger import set_log_level
 import planner
-from skyfield.api import load
-from datetime import timedelta
+from ephemeris import get_ephemeris, get_timescale
+from datetime import datetime, timedelta
 from pyfiglet import Figlet
+from profiling import enable_profiling
+from plan_export import get_plan_writer, read_plan, TextPlanWriter
+from batch import PlannerState, run_batch
+from result_cache import ResultCache
+from attitude_profile import get_attitude_profile, write_attitude_profile
+from hypso_moon_script_cmd_generator import calculate_total_capture_time
+import numpy as np
+import argparse
 import json
+import sys
 
 config_path = 'src/data/config/config.json'
 
-planets = load('de421.bsp')
-earth = planets['earth']
-
-def single_planner(t_start, t_end, sat, target, observer, search_interval, ts):
+def single_planner(t_start, t_end, sat, target, observer, search_interval, ts, tolerance=None, constraints=None, geometry='precise', cache=None):
     log.info('Single planner')
-    min_distance_time_ts, q_ob, off_nadir = planner.single_planner(t_start, t_end, sat, target, observer, search_interval, ts)
+    min_distance_time_ts, q_ob, off_nadir = planner.single_planner(t_start, t_end, sat, target, observer, search_interval, ts, tolerance, constraints=constraints, geometry=geometry, cache=cache)
     
     log.info('----------------------------------------------------')
     log.info('Time = {}'.format(min_distance_time_ts))
@@ -28,35 +36,117 @@ def single_planner(t_start, t_end, sat, target, observer, search_interval, ts):
     log.info('Off-nadir angle = {:.10f} degrees'.format(off_nadir))
     log.info('----------------------------------------------------')
     
-def multi_planner(t_start, t_end, sat, target, intervals, earth, search_interval, ts):
+    return [(min_distance_time_ts, q_ob, off_nadir)]
+    
+def multi_planner(t_start, t_end, sat, target, intervals, earth, search_interval, ts, tolerance=None, workers=None, plan_path='plan.txt', resume=False, constraints=None, geometry='precise', cache=None):
     log.info('Multi planner')
-    plan = planner.multi_planner(t_start, t_end, sat, target, earth, intervals, search_interval, ts)
+    
+    # Each capture is logged and written as soon as it is planned, numbered by its interval. A resumed
+    # run continues after the last capture already in the plan file
+    log.info('----------------------------------------------------')
+    captures = []
+    with get_plan_writer(plan_path, resume) as writer:
+        for i, capture in planner.iter_multi_planner(t_start, t_end, sat, target, earth, intervals, search_interval, ts, tolerance, workers, start_index=writer.count, constraints=constraints, geometry=geometry, cache=cache):
+            writer.write(capture, i + 1)
+            log_capture(i + 1, capture)
+            captures.append(capture)
+    log.info('----------------------------------------------------')
+    log.info('Plan written to {}'.format(plan_path))
+    
+    return captures
+    
+def replan(t_start, t_end, sat, target, intervals, earth, search_interval, ts, tolerance=None, previous_path='plan.txt', plan_path='plan.txt', constraints=None, geometry='precise'):
+    log.info('Re-planning {} with the current TLE'.format(previous_path))
+    captures, diff = planner.replan(read_plan(previous_path), t_start, t_end, sat, target, earth, intervals, search_interval, ts, tolerance, constraints=constraints, geometry=geometry)
     
+    log.info('----------------------------------------------------')
+    with get_plan_writer(plan_path) as writer:
+        for entry in diff:
+            if entry['new'] is not None:
+                writer.write(entry['new'], entry['interval'] + 1)
+            log_diff(entry)
+    log.info('----------------------------------------------------')
+    log.info('Plan written to {}'.format(plan_path))
+    
+    return captures
+    
+def export_attitude_profile(captures, sat, target, earth, ts, rate, path='attitude.bin', duration=None):
+    # The capture intervals last the HYPSO capture time of their off-nadir angle, unless a duration is given
+    durations = duration if duration is not None else calculate_total_capture_time(np.array([capture[2] for capture in captures]))
+    write_attitude_profile(path, get_attitude_profile(captures, sat, target, earth, ts, rate, durations))
+    
+def log_diff(entry):
+    if entry['old'] is None or entry['new'] is None:
+        capture = entry['new'] or entry['old']
+        log.info('Capture nr. {}: {} ({})'.format(entry['interval'] + 1, capture[0] if capture else 'none', entry['method']))
+    else:
+        log.info('Capture nr. {}: {} moved {:+.3f} s, off-nadir angle {:+.6f} degrees ({})'.format(entry['interval'] + 1, entry['new'][0], entry['shift_s'], entry['off_nadir_change_deg'], entry['method']))
+    
+def fleet_planner(t_start, t_end, sats, target, intervals, earth, search_interval, ts, tolerance=None):
+    log.info('Fleet planner')
+    plans = planner.fleet_planner(t_start, t_end, sats, target, earth, intervals, search_interval, ts, tolerance)
+    
+    for sat, plan in zip(sats, plans):
+        catnr = sat.model.satnum
+        log.info('Plan for {} ({})'.format(sat.name, catnr))
+        log_plan(plan)
+        save_plan(plan, 'plan-{}.txt'.format(catnr))
+    
+def multi_target_planner(t_start, t_end, sat, targets, codes, intervals, earth, search_interval, ts, tolerance=None, geometry='precise'):
+    log.info('Multi-target planner')
+    plans = planner.multi_target_planner(t_start, t_end, sat, targets, earth, intervals, search_interval, ts, tolerance, geometry=geometry)
+    
+    for code, plan in zip(codes, plans):
+        log.info('Plan for target {}'.format(code))
+        log_plan(plan)
+        save_plan(plan, 'plan-target-{}.txt'.format(code))
+    
+def log_plan(plan):
     log.info('----------------------------------------------------')
     count = 1
-    for time, quaternion, off_nadir in plan:
-        log.info('Capture nr. {}'.format(count))
-        log.info('Time = {}'.format(time))
-        log.info('Qx = {:.10f}'.format(quaternion[1]))
-        log.info('Qy = {:.10f}'.format(quaternion[2]))
-        log.info('Qz = {:.10f}'.format(quaternion[3]))
-        log.info('Qs = {:.10f}'.format(quaternion[0]))
-        log.info('Off-nadir angle = {:.10f} degrees\n'.format(off_nadir))
+    for capture in plan:
+        log_capture(count, capture)
         count += 1
     
     log.info('----------------------------------------------------')
     
+def log_capture(count, capture):
+    time, quaternion, off_nadir = capture
+    log.info('Capture nr. {}'.format(count))
+    log.info('Time = {}'.format(time))
+    log.info('Qx = {:.10f}'.format(quaternion[1]))
+    log.info('Qy = {:.10f}'.format(quaternion[2]))
+    log.info('Qz = {:.10f}'.format(quaternion[3]))
+    log.info('Qs = {:.10f}'.format(quaternion[0]))
+    log.info('Off-nadir angle = {:.10f} degrees\n'.format(off_nadir))
+    
+def save_plan(plan, path):
     # Save plan to txt file
-    with open('plan.txt', 'w') as f:
-        f.write('Capture nr. | Time | Qx | Qy | Qz | Qs | Off-nadir angle\n')
-        count = 1
-        for time, quaternion, off_nadir in plan:
-            f.write('{} | {} | {:.10f} | {:.10f} | {:.10f} | {:.10f} | {:.10f}\n'.format(count, time, quaternion[1], quaternion[2], quaternion[3], quaternion[0], off_nadir))
-            count += 1
+    with TextPlanWriter(path) as writer:
+        for capture in plan:
+            writer.write(capture)
     
 if __name__ == '__main__':
-    ts = load.timescale()
-    t_now = ts.now()
+    parser = argparse.ArgumentParser(description='Satellite targeting tool.')
+    parser.add_argument('--plan', default='plan.txt', help='The file the multi planner writes each capture to as soon as it is planned. The format is given by the extension: .txt, .csv or .jsonl. Default is plan.txt.')
+    parser.add_argument('--resume', action='store_true', help='Keep the captures already in the plan file and continue planning after them. The other inputs, and --now, must be the same as in the interrupted run.')
+    parser.add_argument('--now', default=None, help='The time the start and end hours are counted from, as ISO 8601 UTC, e.g. 2024-03-14T06:00:00Z. Default is the current time, which is logged at the start of each run.')
+    parser.add_argument('--job', default=None, help='Run the plans listed in a JSON or YAML job file without prompting, in this process, and exit. See batch.load_jobs for the keys of a job.')
+    parser.add_argument('--output-dir', default='results', help='The directory of the results files of --job. Default is results.')
+    parser.add_argument('--constraints', type=json.loads, default=None, help='Visibility constraints of the captures as JSON, e.g. \'{"sunlit": true, "min_sun_angle": 30, "limb_margin_km": 100}\'. Only the times satisfying them are searched. See visibility.VisibilityConstraints for the keys.')
+    parser.add_argument('--geometry', choices=('precise', 'fast'), default='precise', help='The target positions of the search steps. fast solves the light time once per search instead of at every step, the capture itself is always computed precisely. Default is precise.')
+    parser.add_argument('--replan', default=None, help='In multi planner mode, re-plan this previous plan with the current TLE, searching around its capture times, and write the new plan to --plan. The other inputs, and --now, must be the same as in the previous run.')
+    parser.add_argument('--no-cache', action='store_true', help='Always search, instead of serving captures planned before with the same element set, target, window and settings from the result cache.')
+    parser.add_argument('--attitude-rate', type=float, default=None, help='In single and multi planner mode, also sample the quaternion and off-nadir angle tracking the target over each capture at this rate in Hz, e.g. 10 to 50, and write them to --attitude-out.')
+    parser.add_argument('--attitude-out', default='attitude.bin', help='The file of the attitude profile. .csv is written as CSV, any other extension as packed binary records, see attitude_profile.profile_dtype. Default is attitude.bin.')
+    parser.add_argument('--attitude-duration', type=float, default=None, help='The length in seconds of the capture intervals of the attitude profile. Default is the HYPSO capture time of the off-nadir angle of each capture.')
+    parser.add_argument('--profile', default=None, help='Record the wall time, calls and allocations of each planning stage, and write them as JSON to this file.')
+    args = parser.parse_args()
+    profile = enable_profiling() if args.profile else None
+    
+    ts = get_timescale()
+    t_now = ts.from_datetime(datetime.fromisoformat(args.now.replace('Z', '+00:00'))) if args.now else ts.now()
+    earth = get_ephemeris()['earth']
     
     config = read_config(config_path)
     if not config:
@@ -65,35 +155,96 @@ if __name__ == '__main__':
         
     set_log_level(config['log_level'])
     
+    if args.job:
+        failed = run_batch(args.job, args.output_dir, t_now, PlannerState(ts))
+        if profile:
+            profile.log()
+            profile.save(args.profile)
+        sys.exit(1 if failed else 0)
+    
     f = Figlet(font='slant')
     print(f.renderText('SatNav'))
     print('\033[34m' + '\033[1m' + '--------Satellite Targeting Tool--------\n' + '\033[0m', end='')
     print('Enter the following information to configure the tool. Press enter to use default value.\n', end='')
     
-    mode = input('Enter ' + '\033[34m' + '1' + '\033[0m' + ' to run in single planner mode, or ' + '\033[34m' + '2' + '\033[0m' + ' to run in multi planner mode (default is ' + '\033[34m' + '1' + '\033[0m' + '): ') or '1'
-    config['catnr'] = int(input('Enter satellite catalog number (default is ' + '\033[34m' + '51053' + '\033[0m' + ' (HYPSO-1)): ') or 51053)
-    target = int(input('Enter target segment number (default is ' + '\033[34m' + '301' + '\033[0m' + ' (the moon). See README for supported bodies): ') or 301)
+    mode = input('Enter ' + '\033[34m' + '1' + '\033[0m' + ' to run in single planner mode, or ' + '\033[34m' + '2' + '\033[0m' + ' to run in multi planner mode, or ' + '\033[34m' + '3' + '\033[0m' + ' to run in fleet planner mode, or ' + '\033[34m' + '4' + '\033[0m' + ' to run in multi-target planner mode (default is ' + '\033[34m' + '1' + '\033[0m' + '): ') or '1'
+    if mode == '3':
+        catnrs = [int(catnr) for catnr in (input('Enter comma separated satellite catalog numbers (default is ' + '\033[34m' + '51053' + '\033[0m' + ' (HYPSO-1)): ') or '51053').split(',')]
+    else:
+        config['catnr'] = int(input('Enter satellite catalog number (default is ' + '\033[34m' + '51053' + '\033[0m' + ' (HYPSO-1)): ') or 51053)
+    if mode == '4':
+        codes = [int(code) for code in (input('Enter comma separated target segment numbers (default is ' + '\033[34m' + '301,299' + '\033[0m' + ' (the moon and Venus)). See README for supported bodies): ') or '301,299').split(',')]
+    else:
+        target = int(input('Enter target segment number (default is ' + '\033[34m' + '301' + '\033[0m' + ' (the moon). See README for supported bodies): ') or 301)
     start_time_delta = float(input('Enter hours in the future for start time of search (default is ' + '\033[34m' + '0' + '\033[0m' + ' (now)): ') or 0)
     end_time_delta = float(input('Enter hours in the future for end time of search (default is ' + '\033[34m' + '24' + '\033[0m' + ' (1 day from now)): ') or 24)
-    if mode == '2':
+    if mode in ('2', '3', '4'):
         intervals = int(input('Enter number of intervals to search (default is ' + '\033[34m' + 'end_time_delta/24' + '\033[0m' + ' (one capture per day)): ') or round((end_time_delta-start_time_delta)/24))
+    if mode == '2':
+        workers = int(input('Enter number of worker processes to plan the intervals in parallel (default is ' + '\033[34m' + '1' + '\033[0m' + ' (no parallelism)): ') or 1)
         
-    search_interval = float(input('Enter search_interval for minimum distance search (default is 1 (1 minute)): ') or 1)
+    search_interval = input('Enter search_interval for minimum distance search (default is 1 (1 minute)), or ' + '\033[34m' + 'auto' + '\033[0m' + ' to derive it from the orbit: ') or 1
+    if search_interval != 'auto':
+        search_interval = float(search_interval)
+    tolerance = input('Enter time tolerance in seconds to refine the capture time (default is ' + '\033[34m' + 'none' + '\033[0m' + ' (no refinement), e.g. 0.01): ')
+    tolerance = float(tolerance) if tolerance else None
+    cache_ephemeris = input('Enter ' + '\033[34m' + 'true' + '\033[0m' + ' to serve the target from an interpolated ephemeris table cached on disk, or press Enter to skip: ').lower() == 'true'
     force = input('Enter ' + '\033[34m' + 'true' + '\033[0m' + ' to force update TLE data, or press Enter to skip: ').lower() == 'true'
+    if mode == '3':
+        offline = input('Enter ' + '\033[34m' + 'true' + '\033[0m' + ' to run offline from the local TLE store, or press Enter to skip: ').lower() == 'true'
     
     t_start = t_now + timedelta(hours=start_time_delta)
     t_end = t_now + timedelta(hours=end_time_delta)
     
-    log.info('Using satellite catalog number: ' + str(config['catnr']))
+    if mode == '3':
+        log.info('Using satellite catalog numbers: ' + ', '.join(str(catnr) for catnr in catnrs))
+    else:
+        log.info('Using satellite catalog number: ' + str(config['catnr']))
+    log.info('Using current time: {}'.format(t_now.utc_iso(places=6)))
     log.info('Using start time: {} UTC'.format(t_start.tt_strftime('%Y-%m-%d %H:%M:%S')))
     log.info('Using end time: {} UTC'.format(t_end.tt_strftime('%Y-%m-%d %H:%M:%S')))
     
-    sat = get_satellite(config, force)
-    target = get_target(target)
-    log.info('Config: ' + json.dumps(config, indent=4))
-    log.info('Epoch: ' + str(sat))
+    if mode == '4':
+        targets = [get_target(code) for code in codes]
+        if cache_ephemeris:
+            targets = [get_ephemeris_table(t_start, t_end, target, earth) for target in targets]
+    else:
+        target_code = target
+        target = get_target(target)
+        if cache_ephemeris:
+            target = get_ephemeris_table(t_start, t_end, target, earth)
+    if mode == '3':
+        sats = get_satellites_from_store(catnrs, t_start, TLEStore(offline=offline, ts=ts), force)
+        for sat in sats:
+            log.info('Epoch: ' + str(sat))
+    else:
+        sat = get_satellite(config, force)
+        log.info('Config: ' + json.dumps(config, indent=4))
+        log.info('Epoch: ' + str(sat))
     
+    if args.geometry == 'fast' and mode != '3':
+        for code, body in zip(codes, targets) if mode == '4' else [(target_code, target)]:
+            log.info('Geometry error bound for target {}: {}'.format(code, get_geometry_error(t_start, t_end, body, earth, args.geometry)))
+    
+    cache = None if args.no_cache else ResultCache()
+    captures = None
     if mode == '1':
-        single_planner(t_start, t_end, sat, target, earth, search_interval, ts)
+        captures = single_planner(t_start, t_end, sat, target, earth, search_interval, ts, tolerance, args.constraints, args.geometry, cache)
+    elif mode == '2' and args.replan:
+        captures = replan(t_start, t_end, sat, target, intervals, earth, search_interval, ts, tolerance, args.replan, args.plan, args.constraints, args.geometry)
     elif mode == '2':
-        multi_planner(t_start, t_end, sat, target, intervals, earth, search_interval, ts)
\ No newline at end of file
+        captures = multi_planner(t_start, t_end, sat, target, intervals, earth, search_interval, ts, tolerance, workers, args.plan, args.resume, args.constraints, args.geometry, cache)
+    elif mode == '3':
+        fleet_planner(t_start, t_end, sats, target, intervals, earth, search_interval, ts, tolerance)
+    elif mode == '4':
+        multi_target_planner(t_start, t_end, sat, targets, codes, intervals, earth, search_interval, ts, tolerance, args.geometry)
+    
+    if args.attitude_rate:
+        if captures is None:
+            log.warning('The attitude profile is only exported in single and multi planner mode.')
+        else:
+            export_attitude_profile(captures, sat, target, earth, ts, args.attitude_rate, args.attitude_out, args.attitude_duration)
+    
+    if profile:
+        profile.log()
+        profile.save(args.profile)
@@ -1,8 +1,15 @@
-from celestial_bodies import *
-from distances import *
-from skyfield.api import load
+import glob
+import math
+import os
 import numpy as np
 from datetime import timedelta
+from skyfield import almanac
+from skyfield.searchlib import find_discrete
+from ephemeris import get_ephemeris, get_timescale
+from logger import logger as log
+from profiling import profiled
+
+cache_path = 'src/data/phase_cache/'
 
 def distance_pos(t, pos1, pos2):
     return np.linalg.norm(pos1 - pos2)
@@ -68,32 +75,222 @@ def calculate_angle_2(pos_sun, pos_earth, pos_moon):
     
     return angle_deg
 
-ts = load.timescale()
-t_now = ts.now()
-# t_var = t_now - timedelta(days = 1)
-# 44 days, 21 hours, 34 minutes and 42 seconds
-t_var = t_now - timedelta(days = 44, hours = 21, minutes = 34, seconds = 42)
-
-planets = load('de421.bsp')
-earth = planets['earth']
-moon = planets['moon']
-sun = planets['sun']
-
-pos_sun = position_body(t_var, sun, earth)
-pos_earth = position_body(t_var, earth, earth)
-pos_moon = position_body(t_var, moon, earth)
-print('pos_sun: ', pos_sun)
-print('pos_earth: ', pos_earth)
-print('pos_moon: ', pos_moon)
-
-distance_earth_sun = distance_pos(t_var, pos_sun, pos_earth)
-distance_earth_moon = distance_pos(t_var, pos_moon, pos_earth)
-
-print('distance earth sun: ', distance_earth_sun)
-print('distance earth moon: ', distance_earth_moon)
-
-# Calculate the angle between sun, earth and moon at specific times
-angle = calculate_angle(pos_sun, pos_earth, pos_moon)
-angle_2 = calculate_angle_2(pos_sun, pos_earth, pos_moon)
-print('Angle: ', angle)
-print('Angle 2: ', angle_2)
\ No newline at end of file
+@profiled('moon.get_phase_angles')
+def get_phase_angles(times, planets=None):
+    """
+    Calculate the phase angle of the Moon, as in calculate_angle_2, for every epoch of a time array
+    in one pass. The angle is 0 degrees on full moon and 180 degrees on new moon.
+
+    Arguments:
+        times: skyfield time object holding an array of times
+        planets: skyfield ephemeris, default the shared de421.bsp
+
+    Returns:
+        array of shape (N,), phase angles in degrees
+    """
+    planets = planets or get_ephemeris()
+    earth = planets['earth'].at(times)
+    vec_sun_earth = earth.observe(planets['sun']).position.km
+    vec_moon_earth = earth.observe(planets['moon']).position.km
+
+    cos_angle = np.sum(vec_sun_earth * vec_moon_earth, axis=0) / (np.linalg.norm(vec_sun_earth, axis=0) * np.linalg.norm(vec_moon_earth, axis=0))
+
+    return 180 - np.degrees(np.arccos(np.clip(cos_angle, -1, 1)))
+
+class PhaseSeries:
+    """
+    Phase angles of the Moon sampled on a regular grid, served by linear interpolation. At the default
+    step of one hour the interpolation error is about 0.01 degrees.
+    """
+
+    def __init__(self, tt_start, step, angles):
+        self.tt_start = tt_start
+        self.step = step
+        self.angles = angles
+
+    def __repr__(self):
+        return '<PhaseSeries of {} samples every {} h from TT {}>'.format(len(self.angles), self.step*24, self.tt_start)
+
+    @classmethod
+    def build(cls, t_start, t_end, step=1/24, planets=None):
+        ts = t_start.ts
+        n = max(math.ceil((t_end.tt - t_start.tt) / step), 1) + 1
+        times = ts.tt_jd(t_start.whole, t_start.tt_fraction + step*np.arange(n))
+
+        return cls(t_start.tt, step, get_phase_angles(times, planets))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+
+        return cls(float(data['tt_start']), float(data['step']), data['angles'])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, tt_start=self.tt_start, step=self.step, angles=self.angles)
+
+    def min_phase(self, t_start, t_end):
+        """
+        Get the minimum phase angle of the Moon within a timeframe, i.e. the phase angle closest to full moon.
+        """
+        x = (np.array([t_start.tt, t_end.tt]) - self.tt_start) / self.step
+        if np.any(x < 0) or np.any(x > len(self.angles) - 1):
+            raise ValueError('Timeframe outside of {}'.format(self))
+
+        # The interpolated series is at its minimum either at a sample or at an end of the timeframe
+        inside = self.angles[math.ceil(x[0]):math.floor(x[1]) + 1]
+
+        return float(min(np.interp(x, np.arange(len(self.angles)), self.angles).min(), inside.min(initial=np.inf)))
+
+    def covers(self, t_start, t_end):
+        return self.tt_start <= t_start.tt and t_end.tt <= self.tt_start + self.step*(len(self.angles) - 1)
+
+    def phase_at(self, time):
+        """
+        Look up the phase angle of the Moon.
+
+        Arguments:
+            time: skyfield time object, holding a single time or an array of times
+
+        Returns:
+            float or array, phase angle in degrees
+        """
+        x = (np.asarray(time.tt) - self.tt_start) / self.step
+        if np.any(x < 0) or np.any(x > len(self.angles) - 1):
+            raise ValueError('Time outside of {}'.format(self))
+
+        return np.interp(x, np.arange(len(self.angles)), self.angles)
+
+def get_phase_series(t_start, t_end, step=1/24):
+    """
+    Get the phase angle series covering a timeframe, from disk if a series with the same step covering
+    it was built before, e.g. for a longer timeframe. Otherwise the series is built with the timeframe
+    widened to whole days, so that reruns on the same days share the same series.
+
+    Arguments:
+        t_start: skyfield time object
+        t_end: skyfield time object
+        step: float, time step in days
+
+    Returns:
+        PhaseSeries
+    """
+    ts = t_start.ts
+    day_start = math.floor(t_start.tt - 0.5) + 0.5
+    day_end = math.ceil(t_end.tt - 0.5) + 0.5
+
+    filename = os.path.join(cache_path, 'phase-{:.1f}-{:.1f}-{:g}s.npz'.format(day_start, day_end, step*24*60*60))
+    # The shortest cached series covering the timeframe, the range of each is in its file name
+    cached = []
+    for path in glob.glob(os.path.join(cache_path, 'phase-*-*-{:g}s.npz'.format(step*24*60*60))):
+        try:
+            start, end = (float(day) for day in os.path.basename(path).split('-')[1:3])
+        except ValueError:
+            continue
+        if start <= day_start and day_end <= end:
+            cached.append((end - start, path))
+    for _, path in sorted(cached):
+        series = PhaseSeries.load(path)
+        if series.covers(t_start, t_end):
+            return series
+
+    log.info('Building Moon phase series from {} to {}...'.format(ts.tt_jd(day_start).utc_strftime('%Y-%m-%d'), ts.tt_jd(day_end).utc_strftime('%Y-%m-%d')))
+    series = PhaseSeries.build(ts.tt_jd(day_start), ts.tt_jd(day_end), step)
+    series.save(filename)
+
+    return series
+
+def find_full_moons(t_start, t_end, planets=None):
+    """
+    Find the times of full moon, i.e. when the ecliptic longitudes of the Moon and Sun differ by 180
+    degrees, by root-finding on the lunar phases.
+
+    Arguments:
+        t_start: skyfield time object
+        t_end: skyfield time object
+        planets: skyfield ephemeris, default the shared de421.bsp
+
+    Returns:
+        skyfield time object holding an array of times
+    """
+    times, phases = find_discrete(t_start, t_end, almanac.moon_phases(planets or get_ephemeris()))
+
+    return times[phases == 2]
+
+def find_phase_crossings(t_start, t_end, threshold, planets=None):
+    """
+    Find the times the phase angle of the Moon crosses a threshold, located by bisection down to a
+    millisecond.
+
+    Arguments:
+        t_start: skyfield time object
+        t_end: skyfield time object
+        threshold: float, phase angle in degrees
+        planets: skyfield ephemeris, default the shared de421.bsp
+
+    Returns:
+        times: skyfield time object holding an array of times
+        below: array of bool, True where the phase angle drops below the threshold, False where it rises above
+    """
+    def below(t):
+        return (get_phase_angles(t, planets) < threshold).astype(int)
+    # The phase angle changes by about 12 degrees per day
+    below.step_days = 0.25
+
+    times, values = find_discrete(t_start, t_end, below)
+
+    return times, values.astype(bool)
+
+def get_phase_windows(t_start, t_end, max_phase_angle, planets=None):
+    """
+    Get the timeframes within t_start to t_end where the phase angle of the Moon is below max_phase_angle,
+    e.g. the days around full moon suited for captures.
+
+    Returns:
+        list of tuples (t_a, t_b) of skyfield time objects, in time order
+    """
+    times, below = find_phase_crossings(t_start, t_end, max_phase_angle, planets)
+
+    windows = []
+    t_a = t_start if get_phase_angles(t_start.ts.tt_jd(np.atleast_1d(t_start.whole), np.atleast_1d(t_start.tt_fraction)), planets)[0] < max_phase_angle else None
+    for t, is_below in zip(times, below):
+        if is_below:
+            t_a = t
+        elif t_a is not None:
+            windows.append((t_a, t))
+            t_a = None
+    if t_a is not None:
+        windows.append((t_a, t_end))
+
+    return windows
+
+if __name__ == '__main__':
+    ts = get_timescale()
+    t_now = ts.now()
+    # t_var = t_now - timedelta(days = 1)
+    # 44 days, 21 hours, 34 minutes and 42 seconds
+    t_var = t_now - timedelta(days = 44, hours = 21, minutes = 34, seconds = 42)
+
+    planets = get_ephemeris()
+    earth = planets['earth']
+    moon = planets['moon']
+    sun = planets['sun']
+
+    pos_sun = position_body(t_var, sun, earth)
+    pos_earth = position_body(t_var, earth, earth)
+    pos_moon = position_body(t_var, moon, earth)
+    print('pos_sun: ', pos_sun)
+    print('pos_earth: ', pos_earth)
+    print('pos_moon: ', pos_moon)
+
+    distance_earth_sun = distance_pos(t_var, pos_sun, pos_earth)
+    distance_earth_moon = distance_pos(t_var, pos_moon, pos_earth)
+
+    print('distance earth sun: ', distance_earth_sun)
+    print('distance earth moon: ', distance_earth_moon)
+
+    # Calculate the angle between sun, earth and moon at specific times
+    angle = calculate_angle(pos_sun, pos_earth, pos_moon)
+    angle_2 = calculate_angle_2(pos_sun, pos_earth, pos_moon)
+    print('Angle: ', angle)
+    print('Angle 2: ', angle_2)
\ No newline at end of file
@@ -0,0 +1,195 @@
+import abc
+import csv
+import io
+import json
+import os
+from datetime import datetime
+import numpy as np
+from logger import logger as log
+
+class PlanWriter(abc.ABC):
+    """
+    Writes the captures of a plan to a file one at a time, as they are planned. Every capture is
+    flushed when it is written, so an interrupted run keeps all captures planned so far.
+
+    Opening an existing file with resume=True keeps its captures, drops a partly written last line
+    and appends after it. count is the number of the last capture in the file, i.e. the index of the
+    next interval to plan when captures are numbered by interval.
+
+    Subclasses implement format, parse and number for their file format.
+    """
+
+    header = None
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.count = 0
+
+        if resume and os.path.exists(path):
+            lines = self._recover()
+            self.count = self.number(lines[-1]) if lines else 0
+            self._file = open(path, 'a', newline='')
+            log.info('Resuming plan {} after {} captures'.format(path, self.count))
+        else:
+            self._file = open(path, 'w', newline='')
+            if self.header is not None:
+                self._file.write(self.header + '\n')
+                self._file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def write(self, capture, nr=None):
+        """
+        Append a capture, a tuple of time, quaternion and off nadir angle as returned by the planners.
+        The capture is numbered nr, e.g. the number of its interval, or else after the previous capture.
+        """
+        self.count = self.count + 1 if nr is None else nr
+        self._file.write(self.format(self.count, capture) + '\n')
+        self._file.flush()
+
+    @staticmethod
+    @abc.abstractmethod
+    def format(nr, capture):
+        pass
+
+    @staticmethod
+    @abc.abstractmethod
+    def parse(line):
+        pass
+
+    @staticmethod
+    @abc.abstractmethod
+    def number(line):
+        pass
+
+    @classmethod
+    def read(cls, path):
+        """
+        Read back the complete captures of a plan file.
+        """
+        with open(path, newline='') as f:
+            lines = _complete_lines(f.read(), cls.header)
+
+        return [cls.parse(line) for line in lines]
+
+    def _recover(self):
+        with open(self.path, newline='') as f:
+            text = f.read()
+        lines = _complete_lines(text, self.header)
+
+        # Rewrite the file if the last line was cut off, or the header is missing
+        keep = ([self.header] if self.header is not None else []) + lines
+        kept = ''.join(line + '\n' for line in keep)
+        if kept != text:
+            if not text.endswith('\n') and text.strip():
+                log.warning('Dropping incomplete capture at the end of {}'.format(self.path))
+            with open(self.path, 'w', newline='') as f:
+                f.write(kept)
+
+        return lines
+
+class TextPlanWriter(PlanWriter):
+    """
+    The plan.txt format of main.py.
+    """
+
+    header = 'Capture nr. | Time | Qx | Qy | Qz | Qs | Off-nadir angle'
+
+    @staticmethod
+    def format(nr, capture):
+        time, quaternion, off_nadir = capture
+        return '{} | {} | {:.10f} | {:.10f} | {:.10f} | {:.10f} | {:.10f}'.format(nr, time, quaternion[1], quaternion[2], quaternion[3], quaternion[0], off_nadir)
+
+    @staticmethod
+    def parse(line):
+        _, time, qx, qy, qz, qs, off_nadir = [field.strip() for field in line.split('|')]
+        return datetime.fromisoformat(time), np.array([float(qs), float(qx), float(qy), float(qz)]), float(off_nadir)
+
+    @staticmethod
+    def number(line):
+        return int(line.split('|')[0])
+
+class CSVPlanWriter(PlanWriter):
+    header = 'capture,time,qx,qy,qz,qs,off_nadir_deg'
+
+    @staticmethod
+    def format(nr, capture):
+        time, quaternion, off_nadir = capture
+        row = io.StringIO()
+        csv.writer(row, lineterminator='').writerow([nr, time.isoformat(), repr(float(quaternion[1])), repr(float(quaternion[2])), repr(float(quaternion[3])), repr(float(quaternion[0])), repr(float(off_nadir))])
+        return row.getvalue()
+
+    @staticmethod
+    def parse(line):
+        _, time, qx, qy, qz, qs, off_nadir = next(csv.reader([line]))
+        return datetime.fromisoformat(time), np.array([float(qs), float(qx), float(qy), float(qz)]), float(off_nadir)
+
+    @staticmethod
+    def number(line):
+        return int(line.split(',')[0])
+
+class JSONLinesPlanWriter(PlanWriter):
+    @staticmethod
+    def format(nr, capture):
+        return json.dumps(capture_to_dict(nr, capture))
+
+    @staticmethod
+    def parse(line):
+        record = json.loads(line)
+        return datetime.fromisoformat(record['time']), np.array([record['qs'], record['qx'], record['qy'], record['qz']]), record['off_nadir_deg']
+
+    @staticmethod
+    def number(line):
+        return json.loads(line)['capture']
+
+writers = {'.txt': TextPlanWriter, '.csv': CSVPlanWriter, '.jsonl': JSONLinesPlanWriter}
+
+def get_plan_writer(path, resume=False):
+    """
+    Open the plan writer for a file, with the format given by its extension: .txt, .csv or .jsonl.
+
+    :param path: The path of the plan file.
+    :param resume: If True, keep the captures already in the file and append after them.
+    :return: The plan writer.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in writers:
+        raise ValueError('Unknown plan format {}, expected one of {}'.format(extension, ', '.join(writers)))
+
+    return writers[extension](path, resume)
+
+def read_plan(path):
+    """
+    Read the captures of a plan file written by a plan writer.
+
+    :param path: The path of the plan file.
+    :return: The list of tuples containing the capture time, quaternion and off nadir angle.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in writers:
+        raise ValueError('Unknown plan format {}, expected one of {}'.format(extension, ', '.join(writers)))
+
+    return writers[extension].read(path)
+
+def capture_to_dict(nr, capture):
+    """
+    The capture as a JSON serializable dict, as written to JSON Lines plans.
+    """
+    time, quaternion, off_nadir = capture
+
+    return {'capture': nr, 'time': time.isoformat(), 'qx': float(quaternion[1]), 'qy': float(quaternion[2]), 'qz': float(quaternion[3]), 'qs': float(quaternion[0]), 'off_nadir_deg': float(off_nadir)}
+
+def _complete_lines(text, header):
+    # Lines after the header, without a last line that was not terminated
+    lines = text.split('\n')[:-1]
+    if header is not None and lines and lines[0] == header:
+        lines = lines[1:]
+
+    return [line for line in lines if line.strip()]
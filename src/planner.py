@@ -1,9 +1,31 @@
 from distances import get_minimum_distance
-from quaternions import get_quaternion, get_off_nadir_angle, get_maximum_off_nadir_angle
+from quaternions import get_quaternion, get_quaternion_from_state, get_off_nadir_angle, target_unit_vectors_from_positions, shortest_arc_quaternions, get_maximum_off_nadir_angle, get_fleet_off_nadir_angles, get_multi_target_off_nadir_angles
+from search import chunked_search, refine_extremum, bracket, AUTO_TOLERANCE_S, SWEEP_MEMORY_BUDGET
+import numpy as np
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from sgp4.exporter import export_tle
+from skyfield.api import EarthSatellite
+from ephemeris import get_ephemeris, get_timescale
+from ephemeris_cache import EphemerisTable
+from celestial_bodies import get_orbit_step, get_target_position, propagate
 
 from logger import logger as log
+from profiling import disable_profiling, enable_profiling, get_profile, profiled
+from progress import get_progress_reporter, check_cancelled, no_progress, SearchCancelled
+from visibility import NoVisibilityWindow
+from moon_sun_earth_angle import get_phase_series
+from result_cache import result_key
 
-def multi_planner(t_start, t_end, sat, target, observer, intervals, search_interval, ts):
+# Segment number of the Moon, the only target the phase angle filter applies to
+MOON = 301
+
+# Satellite, target and observer loaded once per worker process by _init_worker
+_worker_state = {}
+
+@profiled('planner.multi_planner')
+def multi_planner(t_start, t_end, sat, target, observer, intervals, search_interval, ts, tolerance=None, workers=None, pool='process', progress=None, cancel=None, constraints=None, max_phase_angle=None, geometry='precise', cache=None, positions=None):
     """
     Calculates the minimum distance between the satellite and target for a given time frame and
     the corresponding quaternion for each time frame.
@@ -14,16 +36,95 @@ def multi_planner(t_start, t_end, sat, target, observer, intervals, search_inter
     :param target: The target object.
     :param observer: The observer object.
     :param intervals: The number of intervals to split the time frame into.
-    :param search_interval: The search_interval for the minimum distance calculation.
+    :param search_interval: The search_interval for the minimum distance calculation, in minutes, or 'auto', see quaternions.get_maximum_off_nadir_angle.
     :param ts: The timescale object.
+    :param tolerance: The time tolerance in seconds for refining the capture time, or None to keep the best search step.
+    :param workers: The number of workers planning the time frames in parallel, or None to plan them one after another.
+    :param pool: The kind of worker pool, 'process' or 'thread'.
+    :param progress: The callback taking the completed fraction of all time frames, rate limited. Default only writes to a TTY.
+    :param cancel: A progress.CancellationToken, checked between search steps. Raises progress.SearchCancelled once cancelled.
+    :param constraints: The visibility.VisibilityConstraints, or a dict of them. If set, only the visibility windows are searched,
+                        and time frames without any are skipped.
+    :param max_phase_angle: The maximum phase angle of the Moon in degrees, or None. Time frames where the phase angle
+                            stays above it, i.e. too far from full moon, are skipped. Raises ValueError if the target is
+                            not the Moon.
+    :param geometry: The target positions of the search steps, 'precise' or 'fast'. See celestial_bodies.get_target_position.
+    :param cache: A result_cache.ResultCache, or None. Time frames planned before with the same element set and settings
+                  are served from it, the others are stored in it.
+    :param positions: A list, or None. The positions at each capture time, in the order of the captures, are appended
+                      to it, see iter_multi_planner.
     :return: A list of tuples containing the minimum distance time and corresponding quaternion for
              each time frame.
     """
     
+    found = None if positions is None else {}
+    captures = []
+    for i, capture in iter_multi_planner(t_start, t_end, sat, target, observer, intervals, search_interval, ts, tolerance, workers, pool, progress, cancel, constraints=constraints, max_phase_angle=max_phase_angle, geometry=geometry, cache=cache, positions=found):
+        captures.append(capture)
+        if positions is not None:
+            positions.append(found[i])
+    
+    return captures
+
+def iter_multi_planner(t_start, t_end, sat, target, observer, intervals, search_interval, ts, tolerance=None, workers=None, pool='process', progress=None, cancel=None, start_index=0, constraints=None, max_phase_angle=None, geometry='precise', cache=None, positions=None):
+    """
+    Generator variant of multi_planner, yielding the capture of each time frame as soon as it is planned,
+    so the plan can be written out while it is planned. The time frames are the same as in multi_planner.
+
+    :param start_index: The index of the first time frame to plan, e.g. the number of captures already written
+                        by an interrupted run.
+    :param positions: A dict, or None. The satellite, target and Sun positions in km at each capture time, as seen
+                      from the observer, are stored in it by the index of the time frame. They are those the capture
+                      quaternion was computed from, so e.g. capture distances need no further ephemeris evaluations.
+                      Only captures served from the result cache are evaluated again.
+    :return: A generator of tuples containing the index of the time frame and its capture, i.e. the tuple
+             of time, quaternion and off nadir angle.
+    """
+    
     duration = (t_end - t_start) / intervals
+    progress = get_progress_reporter(progress)
     
-    results = []
-    for i in range(intervals):
+    indices = range(start_index, intervals)
+    if max_phase_angle is not None:
+        if target.target != MOON:
+            raise ValueError('The phase angle filter only applies to the Moon, not to {}'.format(target))
+        series = get_phase_series(t_start, t_end)
+        # The end of the last time frame is clipped to t_end, which it can pass by rounding
+        indices = [i for i in indices if series.min_phase(t_start + i * duration, min(t_start + i * duration + duration, t_end, key=lambda t: t.tt)) <= max_phase_angle]
+        log.info(f'Planning {len(indices)} of {intervals - start_index} intervals with a Moon phase angle below {max_phase_angle} degrees')
+    
+    if cache is None:
+        yield from _plan_intervals(t_start, duration, sat, target, observer, intervals, search_interval, ts, tolerance, workers, pool, progress, cancel, indices, constraints, geometry, positions)
+        return
+    
+    keys = {i: result_key(sat, target, observer, t_start + i * duration, t_start + i * duration + duration, search_interval, tolerance, constraints, geometry) for i in indices}
+    cached = {}
+    for i in indices:
+        capture = cache.get(keys[i])
+        if capture is not None:
+            cached[i] = capture
+    log.info(f'Serving {len(cached)} of {len(indices)} intervals from the result cache')
+    
+    planned = _plan_intervals(t_start, duration, sat, target, observer, intervals, search_interval, ts, tolerance, workers, pool, progress, cancel, [i for i in indices if i not in cached], constraints, geometry, positions)
+    for i, capture in _merge_cached(cached, planned):
+        if i not in cached:
+            cache.put(keys[i], sat, capture)
+        elif positions is not None:
+            positions[i] = _capture_state(ts.from_datetime(capture[0]), sat, target, observer, True)[2]
+        yield i, capture
+
+def _plan_intervals(t_start, duration, sat, target, observer, intervals, search_interval, ts, tolerance, workers, pool, progress, cancel, indices, constraints, geometry, positions=None):
+    if workers is not None and workers > 1:
+        captures = _parallel_multi_planner(t_start, duration, sat, target, observer, intervals, search_interval, ts, tolerance, workers, pool, progress, cancel, indices, constraints, geometry, positions is not None)
+        for i, (capture, capture_positions) in captures:
+            if capture is not None:
+                if positions is not None:
+                    positions[i] = capture_positions
+                yield i, capture
+        return
+    
+    for i in indices:
+        check_cancelled(cancel)
         # log.info('Completed {}%'.format(round(i / intervals * 100, 2)))
         log.info(f'Completed {i}/{intervals}')
         # Calculate the start and end times for the current time frame
@@ -40,16 +141,358 @@ def multi_planner(t_start, t_end, sat, target, observer, intervals, search_inter
         # results.append((min_distance_time_datetime, quaternion, off_nadir_angle))
         
         # Calculate the maximum off nadir angle and corresponding quaternion for the current time frame
-        off_nadir_angle, max_off_nadir_time_datetime = get_maximum_off_nadir_angle(new_t_start, new_t_end, sat, target, observer, search_interval=search_interval)
-        max_off_nadir_time_ts = ts.from_datetime(max_off_nadir_time_datetime)
-        quaternion = get_quaternion(max_off_nadir_time_ts, observer, target, sat)
+        # The search progress within the time frame is reported as part of the whole plan
+        window_progress = no_progress if progress is no_progress else lambda f, i=i: progress((i + f) / intervals)
+        capture, capture_positions = _plan_window(new_t_start, new_t_end, sat, target, observer, search_interval, ts, tolerance, window_progress, cancel, constraints, geometry, positions is not None)
+        if capture is not None:
+            if positions is not None:
+                positions[i] = capture_positions
+            yield i, capture
+
+def _merge_cached(cached, planned):
+    # Both are in time frame order, and each time frame is either cached or planned
+    cached = deque(sorted(cached.items()))
+    for i, capture in planned:
+        while cached and cached[0][0] < i:
+            yield cached.popleft()
+        yield i, capture
+    yield from cached
+
+def _plan_window(t_start, t_end, sat, target, observer, search_interval, ts, tolerance, progress=no_progress, cancel=None, constraints=None, geometry='precise', positions=False):
+    # Returns the capture, or None without visibility windows, and the positions at the capture time if asked for
+    try:
+        off_nadir_angle, max_off_nadir_time_datetime = get_maximum_off_nadir_angle(t_start, t_end, sat, target, observer, search_interval=search_interval, tolerance=tolerance, progress=progress, cancel=cancel, constraints=constraints, geometry=geometry)
+    except NoVisibilityWindow as e:
+        log.warning('Skipping time frame: {}'.format(e))
+        return None, None
+    max_off_nadir_time_ts = ts.from_datetime(max_off_nadir_time_datetime)
+    sat_pos, sat_vel, capture_positions = _capture_state(max_off_nadir_time_ts, sat, target, observer, positions)
+    quaternion = get_quaternion_from_state(sat_pos, sat_vel, capture_positions[1])
+    
+    return (max_off_nadir_time_datetime, quaternion, off_nadir_angle), capture_positions if positions else None
+
+def _capture_state(t, sat, target, observer, sun=False):
+    # The satellite state and the positions of the satellite, the target and, if sun, the Sun at a capture time
+    state = propagate(t, sat)
+    sat_pos = state.position.km
+    positions = (sat_pos, get_target_position(t, target, observer), get_target_position(t, get_ephemeris()['sun'], observer) if sun else None)
+    
+    return sat_pos, state.velocity.km_per_s, positions
+
+def _parallel_multi_planner(t_start, duration, sat, target, observer, intervals, search_interval, ts, tolerance, workers, pool, progress, cancel, indices, constraints=None, geometry='precise', positions=False):
+    """
+    Plans the time frames of multi_planner in a pool of workers. The captures are yielded in the order
+    of the time frames, as in the serial path, with None for time frames without visibility windows.
+    Each capture comes with its positions, see _plan_window. Progress is reported per completed time frame.
+    """
+    
+    log.info(f'Planning {len(indices)} intervals with {workers} {pool} workers')
+    windows = [(i, t_start + i * duration, t_start + i * duration + duration) for i in indices]
+    
+    if pool == 'thread':
+        # Threads share the already loaded satellite, target and observer
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            submit = lambda w_start, w_end: executor.submit(_plan_window, w_start, w_end, sat, target, observer, search_interval, ts, tolerance, no_progress, cancel, constraints, geometry, positions)
+            yield from _collect(submit, windows, 2 * workers, intervals, progress, cancel)
+    elif pool == 'process':
+        # Processes rebuild the satellite from its elements and load the ephemeris once in the initializer,
+        # only the window boundaries are sent with each task. Ephemeris tables are sent as they are.
+        # While profiling, the workers profile each task and send the stages back with the capture.
+        line1, line2 = export_tle(sat.model)
+        target_code = target if isinstance(target, EphemerisTable) else target.target
+        profile = get_profile()
+        initargs = (line1, line2, sat.name, target_code, observer.target, profile is not None)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+            submit = lambda w_start, w_end: executor.submit(_plan_worker_window, (w_start.whole, w_start.tt_fraction), (w_end.whole, w_end.tt_fraction), search_interval, tolerance, constraints, geometry, positions)
+            for i, (planned, stages) in _collect(submit, windows, 2 * workers, intervals, progress, cancel):
+                if stages and profile is not None:
+                    profile.merge(stages)
+                yield i, planned
+    else:
+        raise ValueError(f'Unknown pool type: {pool}')
+
+def _collect(submit, windows, max_pending, intervals, progress, cancel, poll_interval=0.2):
+    # At most max_pending time frames are submitted ahead of the one yielded next, so finished captures
+    # do not pile up while the consumer is writing them out. The token cannot be sent to worker processes,
+    # so it is polled here while waiting. When cancelled, or when the consumer stops early, the time frames
+    # not yet started are dropped, the running ones finish before the pool shuts down.
+    pending = deque()
+    windows = iter(windows)
+    try:
+        for i, w_start, w_end in itertools.islice(windows, max_pending):
+            pending.append((i, submit(w_start, w_end)))
+        
+        while pending:
+            i, future = pending.popleft()
+            while True:
+                if cancel is not None and cancel.cancelled:
+                    raise SearchCancelled('Search was cancelled.')
+                if wait([future], timeout=poll_interval).done:
+                    break
+            for j, w_start, w_end in itertools.islice(windows, 1):
+                pending.append((j, submit(w_start, w_end)))
+            
+            planned = future.result()
+            progress((i + 1) / intervals)
+            yield i, planned
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+def _init_worker(line1, line2, name, target_code, observer_code, profile=False):
+    # Forked workers inherit the kernel opened by the parent, spawned workers open it once here. They also
+    # inherit the profile of the parent, which is replaced so its stages are not sent back
+    if profile:
+        enable_profiling()
+    else:
+        disable_profiling()
+    ts = get_timescale()
+    planets = get_ephemeris()
+    _worker_state['ts'] = ts
+    _worker_state['sat'] = EarthSatellite(line1, line2, name, ts)
+    _worker_state['target'] = target_code if isinstance(target_code, EphemerisTable) else planets[target_code]
+    _worker_state['observer'] = planets[observer_code]
+
+def _plan_worker_window(t_start_jd, t_end_jd, search_interval, tolerance, constraints, geometry='precise', positions=False):
+    ts = _worker_state['ts']
+    t_start = ts.tt_jd(*t_start_jd)
+    t_end = ts.tt_jd(*t_end_jd)
+    capture = _plan_window(t_start, t_end, _worker_state['sat'], _worker_state['target'], _worker_state['observer'], search_interval, ts, tolerance, constraints=constraints, geometry=geometry, positions=positions)
+    profile = get_profile()
+    
+    return capture, profile.take() if profile is not None else None
+
+@profiled('planner.replan')
+def replan(plan, t_start, t_end, sat, target, observer, intervals, search_interval, ts, tolerance=None, neighbourhood=15, progress=None, cancel=None, constraints=None, geometry='precise'):
+    """
+    Re-plans a multi_planner plan with a new element set. Each capture of the previous plan is searched for
+    again only in a neighbourhood of its previous time, as a new element set usually moves the captures by
+    seconds. The whole time frame is searched if the new capture is at the edge of the neighbourhood, i.e. the
+    extremum moved out of it, and for time frames without a previous capture.
+
+    The best orbit of each time frame is assumed to stay the best one, which holds unless the extrema of two
+    orbits were within the change made by the new element set.
+
+    :param plan: The previous plan, a list of tuples of time, quaternion and off nadir angle, e.g. from plan_export.read_plan.
+    :param t_start: The start time of the time frame, as in the previous plan.
+    :param t_end: The end time of the time frame, as in the previous plan.
+    :param sat: The satellite object with the new element set.
+    :param target: The target object.
+    :param observer: The observer object.
+    :param intervals: The number of intervals to split the time frame into, as in the previous plan.
+    :param search_interval: The search_interval for the search, in minutes, or 'auto' to derive it from the orbit.
+    :param ts: The timescale object.
+    :param tolerance: The time tolerance in seconds for refining the capture time, or None to keep the best search step.
+    :param neighbourhood: The minutes before and after the previous capture time searched first.
+    :param progress: The callback taking the completed fraction of all time frames, rate limited. Default only writes to a TTY.
+    :param cancel: A progress.CancellationToken, checked between search steps. Raises progress.SearchCancelled once cancelled.
+    :param constraints: The visibility.VisibilityConstraints, or a dict of them, as in multi_planner.
+    :param geometry: The target positions of the search steps, 'precise' or 'fast'. See celestial_bodies.get_target_position.
+    :return: The list of new captures, and the diff as a list with a dict per time frame with the keys interval, method
+             ('refined', 'searched' or 'dropped'), old and new (the captures, or None), shift_s and off_nadir_change_deg.
+    """
+
+    duration = (t_end - t_start) / intervals
+    step = _search_step(search_interval, t_start, [sat], [target], observer)
+    progress = get_progress_reporter(progress)
+
+    previous = {}
+    for capture in plan:
+        t = ts.from_datetime(capture[0])
+        i = int((t - t_start) // duration)
+        if 0 <= i < intervals:
+            previous.setdefault(i, capture)
+        else:
+            log.warning('Capture at {} is outside of the time frame, ignored'.format(capture[0]))
+
+    captures = []
+    diff = []
+    for i in range(intervals):
+        check_cancelled(cancel)
+        w_start = t_start + i * duration
+        w_end = w_start + duration
+        old = previous.get(i)
+
+        new = None
+        method = 'searched'
+        if old is not None:
+            t_old = ts.from_datetime(old[0])
+            n_start = max(w_start, t_old - neighbourhood / 24 / 60, key=lambda t: t.tt)
+            n_end = min(w_end, t_old + neighbourhood / 24 / 60, key=lambda t: t.tt)
+            new, _ = _plan_window(n_start, n_end, sat, target, observer, search_interval, ts, tolerance, cancel=cancel, constraints=constraints, geometry=geometry)
+            if new is not None and not _at_edge(ts.from_datetime(new[0]), n_start, n_end, w_start, w_end, step):
+                method = 'refined'
+            else:
+                new = None
+        if new is None:
+            new, _ = _plan_window(w_start, w_end, sat, target, observer, search_interval, ts, tolerance, cancel=cancel, constraints=constraints, geometry=geometry)
+        if new is None:
+            method = 'dropped'
+        else:
+            captures.append(new)
+
+        diff.append({'interval': i, 'method': method, 'old': old, 'new': new,
+                     'shift_s': (new[0] - old[0]).total_seconds() if old is not None and new is not None else None,
+                     'off_nadir_change_deg': new[2] - old[2] if old is not None and new is not None else None})
+        progress((i + 1) / intervals)
+
+    refined = sum(entry['method'] == 'refined' for entry in diff)
+    log.info(f'Re-planned {intervals} intervals, {refined} refined around the previous capture and {intervals - refined} searched')
+
+    return captures, diff
+
+def _at_edge(t, n_start, n_end, w_start, w_end, step):
+    # Within a search step of an end of the neighbourhood that is not an end of the time frame
+    return (n_start.tt > w_start.tt and t.tt - n_start.tt < step) or (n_end.tt < w_end.tt and n_end.tt - t.tt < step)
+
+def _search_step(search_interval, t, sats, targets, observer):
+    # The step in days, with 'auto' the shortest orbit derived step of all satellite and target pairs
+    if search_interval == 'auto':
+        return min(get_orbit_step(t, sat, target, observer)[1] for sat in sats for target in targets)
+    
+    return search_interval * 1/24/60 # Transform from minutes to days
+
+@profiled('planner.fleet_planner')
+def fleet_planner(t_start, t_end, sats, target, observer, intervals, search_interval, ts, tolerance=None, progress=None, cancel=None, memory_budget=SWEEP_MEMORY_BUDGET):
+    """
+    Calculates the maximum off nadir angle capture of a target for many satellites at once, for each
+    time frame.
+
+    The target is observed once per time frame and all satellites are propagated together with one
+    batched SGP4 call, so adding a satellite only grows the arrays.
+
+    :param t_start: The start time of the time frame.
+    :param t_end: The end time of the time frame.
+    :param sats: The list of satellite objects.
+    :param target: The target object.
+    :param observer: The observer object.
+    :param intervals: The number of intervals to split the time frame into.
+    :param search_interval: The search_interval for the maximum off nadir angle calculation, in minutes, or 'auto' for the
+                            shortest orbit derived step of all satellites and targets, refined to AUTO_TOLERANCE_S if no tolerance is set.
+    :param ts: The timescale object.
+    :param tolerance: The time tolerance in seconds for refining the capture time, or None to keep the best search step.
+    :param progress: The callback taking the completed fraction of all time frames, rate limited. Default only writes to a TTY.
+    :param cancel: A progress.CancellationToken, checked between time frames. Raises progress.SearchCancelled once cancelled.
+    :param memory_budget: The peak memory in bytes of the scan of a time frame, which is evaluated in chunks fitting it,
+                          see search.chunked_search. None evaluates each time frame as one array.
+    :return: A list with one plan per satellite, in the order of sats. Each plan is a list of tuples
+             containing the capture time, quaternion and off nadir angle for each time frame, as returned
+             by multi_planner.
+    """
+    
+    duration = (t_end - t_start) / intervals
+    step = _search_step(search_interval, t_start, sats, [target], observer)
+    if search_interval == 'auto' and tolerance is None:
+        tolerance = AUTO_TOLERANCE_S
+    
+    progress = get_progress_reporter(progress)
+    
+    def fleet_off_nadir(times):
+        # Epochs where SGP4 failed are never picked
+        off_nadir = get_fleet_off_nadir_angles(times, observer, target, sats)
+        return np.where(np.isnan(off_nadir), -np.inf, off_nadir)
+    
+    plans = [[] for _ in sats]
+    for i in range(intervals):
+        check_cancelled(cancel)
+        progress(i / intervals)
+        log.info(f'Completed {i}/{intervals}')
+        new_t_start = t_start + i * duration
+        new_t_end = new_t_start + duration
+        
+        max_times, max_off_nadir = chunked_search(fleet_off_nadir, new_t_start, new_t_end, step, memory_budget, maximize=True, cancel=cancel)
+        
+        for s, sat in enumerate(sats):
+            max_t = max_times[s]
+            off_nadir_angle = float(max_off_nadir[s])
+            if tolerance is not None:
+                t_lo, t_hi = bracket(max_t, new_t_start, new_t_end, step)
+                max_t, off_nadir_angle = refine_extremum(lambda t: get_off_nadir_angle(t, observer, target, sat), t_lo, t_hi, max_t, off_nadir_angle, tolerance, maximize=True)
+            
+            max_off_nadir_time_datetime = max_t.utc_datetime()
+            max_off_nadir_time_ts = ts.from_datetime(max_off_nadir_time_datetime)
+            quaternion = get_quaternion(max_off_nadir_time_ts, observer, target, sat)
+            plans[s].append((max_off_nadir_time_datetime, quaternion, off_nadir_angle))
+    
+    progress(1)
+    
+    return plans
+
+@profiled('planner.multi_target_planner')
+def multi_target_planner(t_start, t_end, sat, targets, observer, intervals, search_interval, ts, tolerance=None, progress=None, cancel=None, geometry='precise', memory_budget=SWEEP_MEMORY_BUDGET):
+    """
+    Calculates the maximum off nadir angle capture of many targets for a satellite at once, for each
+    time frame.
+
+    The satellite is propagated once per time frame for all targets, so adding a target only adds its
+    observation and grows the arrays. The captures of all targets are evaluated together as well, with
+    the batched quaternions of quaternions.shortest_arc_quaternions.
+
+    :param t_start: The start time of the time frame.
+    :param t_end: The end time of the time frame.
+    :param sat: The satellite object.
+    :param targets: The list of target objects.
+    :param observer: The observer object.
+    :param intervals: The number of intervals to split the time frame into.
+    :param search_interval: The search_interval for the maximum off nadir angle calculation, in minutes, or 'auto' for the
+                            shortest orbit derived step of all satellites and targets, refined to AUTO_TOLERANCE_S if no tolerance is set.
+    :param ts: The timescale object.
+    :param tolerance: The time tolerance in seconds for refining the capture time, or None to keep the best search step.
+    :param progress: The callback taking the completed fraction of all time frames, rate limited. Default only writes to a TTY.
+    :param cancel: A progress.CancellationToken, checked between time frames. Raises progress.SearchCancelled once cancelled.
+    :param geometry: The target positions of the search steps, 'precise' or 'fast'. See celestial_bodies.get_target_position.
+    :param memory_budget: The peak memory in bytes of the scan of a time frame, as in fleet_planner.
+    :return: A list with one plan per target, in the order of targets. Each plan is a list of tuples
+             containing the capture time, quaternion and off nadir angle for each time frame, as returned
+             by multi_planner.
+    """
+    
+    duration = (t_end - t_start) / intervals
+    step = _search_step(search_interval, t_start, [sat], targets, observer)
+    if search_interval == 'auto' and tolerance is None:
+        tolerance = AUTO_TOLERANCE_S
+    
+    progress = get_progress_reporter(progress)
+    
+    plans = [[] for _ in targets]
+    for i in range(intervals):
+        check_cancelled(cancel)
+        progress(i / intervals)
+        log.info(f'Completed {i}/{intervals}')
+        new_t_start = t_start + i * duration
+        new_t_end = new_t_start + duration
+        
+        max_times, _ = chunked_search(lambda t: get_multi_target_off_nadir_angles(t, observer, targets, sat, geometry), new_t_start, new_t_end, step, memory_budget, maximize=True, cancel=cancel)
         
-        # Store the results for the current time frame
-        results.append((max_off_nadir_time_datetime, quaternion, off_nadir_angle))
+        if tolerance is not None:
+            # Brent's method refines each target on its own, from the precise value at its best step
+            _, off_nadir_angles = _target_captures(max_times, sat, targets, observer)
+            refined = []
+            for k, target in enumerate(targets):
+                t_lo, t_hi = bracket(max_times[k], new_t_start, new_t_end, step)
+                max_t, _ = refine_extremum(lambda t: get_off_nadir_angle(t, observer, target, sat), t_lo, t_hi, max_times[k], off_nadir_angles[k], tolerance, maximize=True)
+                refined.append(max_t)
+            max_times = ts.tt_jd(np.array([t.whole for t in refined]), np.array([t.tt_fraction for t in refined]))
+        
+        capture_times = [t.utc_datetime() for t in max_times]
+        quaternions, off_nadir_angles = _target_captures(ts.from_datetimes(capture_times), sat, targets, observer)
+        for k in range(len(targets)):
+            plans[k].append((capture_times[k], quaternions[k], float(off_nadir_angles[k])))
+    
+    progress(1)
+    
+    return plans
+
+def _target_captures(times, sat, targets, observer):
+    # The quaternions and off nadir angles of each target at its own epoch of times, with one propagation of the satellite
+    sat_state = propagate(times, sat)
+    target_pos = np.stack([get_target_position(times[k], target, observer) for k, target in enumerate(targets)], axis=1)
+    u = target_unit_vectors_from_positions(sat_state.position.km, sat_state.velocity.km_per_s, target_pos)
     
-    return results
+    return shortest_arc_quaternions(u), np.degrees(np.arccos(np.clip(u[:, 2], -1, 1)))
 
-def single_planner(t_start, t_end, sat, target, observer, search_interval, ts):
+@profiled('planner.single_planner')
+def single_planner(t_start, t_end, sat, target, observer, search_interval, ts, tolerance=None, progress=None, cancel=None, constraints=None, geometry='precise', cache=None):
     """
     Calculates the minimum distance between the satellite and target for a given time frame and
     the corresponding quaternion.
@@ -59,8 +502,16 @@ def single_planner(t_start, t_end, sat, target, observer, search_interval, ts):
     :param sat: The satellite object.
     :param target: The target object.
     :param observer: The observer object.
-    :param search_interval: The search_interval for the minimum distance calculation.
+    :param search_interval: The search_interval for the minimum distance calculation, in minutes, or 'auto', see quaternions.get_maximum_off_nadir_angle.
     :param ts: The timescale object.
+    :param tolerance: The time tolerance in seconds for refining the capture time, or None to keep the best search step.
+    :param progress: The callback taking the completed fraction of the search, rate limited. Default only writes to a TTY.
+    :param cancel: A progress.CancellationToken, checked between search steps. Raises progress.SearchCancelled once cancelled.
+    :param constraints: The visibility.VisibilityConstraints, or a dict of them. If set, only the visibility windows are searched.
+                        Raises visibility.NoVisibilityWindow if there are none.
+    :param geometry: The target positions of the search steps, 'precise' or 'fast'. See celestial_bodies.get_target_position.
+    :param cache: A result_cache.ResultCache, or None. A capture planned before with the same element set and settings is
+                  served from it, a new one is stored in it.
     :return: The minimum distance time and corresponding quaternion.
     """
     
@@ -71,9 +522,19 @@ def single_planner(t_start, t_end, sat, target, observer, search_interval, ts):
     
     # return min_distance_time_datetime, quaternion, off_nadir_angle
     
-    off_nadir_angle, max_off_nadir_time_datetime = get_maximum_off_nadir_angle(t_start, t_end, sat, target, observer, search_interval=search_interval)
+    if cache is not None:
+        key = result_key(sat, target, observer, t_start, t_end, search_interval, tolerance, constraints, geometry)
+        capture = cache.get(key)
+        if capture is not None:
+            log.info('Serving the capture from the result cache')
+            return capture
+    
+    off_nadir_angle, max_off_nadir_time_datetime = get_maximum_off_nadir_angle(t_start, t_end, sat, target, observer, search_interval=search_interval, tolerance=tolerance, progress=progress, cancel=cancel, constraints=constraints, geometry=geometry)
     max_off_nadir_time_ts = ts.from_datetime(max_off_nadir_time_datetime)
     quaternion = get_quaternion(max_off_nadir_time_ts, observer, target, sat)
     
+    if cache is not None:
+        cache.put(key, sat, (max_off_nadir_time_datetime, quaternion, off_nadir_angle))
+    
     return max_off_nadir_time_datetime, quaternion, off_nadir_angle
     
\ No newline at end of file
@@ -0,0 +1,152 @@
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from logger import logger as log
+
+class Profile:
+    """
+    Wall time, call count, net allocated bytes and peak memory recorded per stage of a planner run.
+
+    Memory is traced with tracemalloc, which numpy reports its array buffers to. allocated_bytes is the
+    memory a stage left allocated, summed over its calls, and peak_bytes the most memory allocated above
+    its start during any call. Times and memory are inclusive, i.e. a stage running inside another stage
+    is counted in both. Stages running concurrently in threads share the traced memory.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, wall_time, allocated_bytes, peak_bytes):
+        self.merge({stage: {'calls': 1, 'wall_s': wall_time, 'allocated_bytes': allocated_bytes, 'peak_bytes': peak_bytes}})
+
+    def merge(self, stages):
+        """
+        Add the stages of another profile, e.g. recorded in a worker process.
+        """
+        with self._lock:
+            for stage, other in stages.items():
+                record = self.stages.setdefault(stage, {'calls': 0, 'wall_s': 0.0, 'allocated_bytes': 0, 'peak_bytes': 0})
+                record['calls'] += other['calls']
+                record['wall_s'] += other['wall_s']
+                record['allocated_bytes'] += other['allocated_bytes']
+                record['peak_bytes'] = max(record['peak_bytes'], other['peak_bytes'])
+
+    def take(self):
+        """
+        Return the recorded stages and start over.
+        """
+        with self._lock:
+            stages, self.stages = self.stages, {}
+
+        return stages
+
+    def to_dict(self):
+        with self._lock:
+            return {stage: dict(record) for stage, record in sorted(self.stages.items(), key=lambda item: -item[1]['wall_s'])}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+        log.info(f'Profile written to {path}')
+
+    def log(self):
+        log.info('{:<45} {:>8} {:>12} {:>12} {:>12}'.format('Stage', 'Calls', 'Wall [s]', 'Alloc [MiB]', 'Peak [MiB]'))
+        for stage, record in self.to_dict().items():
+            log.info('{:<45} {:>8} {:>12.4f} {:>12.2f} {:>12.2f}'.format(stage, record['calls'], record['wall_s'], record['allocated_bytes'] / 2**20, record['peak_bytes'] / 2**20))
+
+# The active profile, None while profiling is disabled
+_profile = None
+# True if tracemalloc was started by enable_profiling
+_tracing = False
+# Per thread stack of [memory at the start, highest peak of the nested stages] of the running stages
+_stack = threading.local()
+
+def enable_profiling():
+    """
+    Start recording a new profile, and return it. Starts tracemalloc if it is not already tracing.
+    """
+    global _profile, _tracing
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _tracing = True
+    _profile = Profile()
+
+    return _profile
+
+def disable_profiling():
+    """
+    Stop recording, and return the recorded profile.
+    """
+    global _profile, _tracing
+    profile, _profile = _profile, None
+    if _tracing:
+        tracemalloc.stop()
+        _tracing = False
+
+    return profile
+
+def get_profile():
+    return _profile
+
+@contextmanager
+def stage(name):
+    """
+    Record the enclosed block as a stage of the active profile.
+    """
+    profile = _profile
+    if profile is None:
+        yield
+        return
+
+    _start_memory()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - t0, *_stop_memory())
+
+def profiled(name):
+    """
+    Decorator recording every call of a function as a stage of the active profile. While profiling
+    is disabled the only cost is one check of the active profile per call.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = _profile
+            if profile is None:
+                return func(*args, **kwargs)
+
+            _start_memory()
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.add(name, time.perf_counter() - t0, *_stop_memory())
+
+        return wrapper
+
+    return decorator
+
+def _start_memory():
+    # The peak of tracemalloc is reset for each stage, so the peak reached so far is kept for the enclosing stage
+    stack = _stack.__dict__.setdefault('stages', [])
+    current, peak = tracemalloc.get_traced_memory()
+    if stack:
+        stack[-1][1] = max(stack[-1][1], peak)
+    stack.append([current, 0])
+    tracemalloc.reset_peak()
+
+def _stop_memory():
+    # Returns the net allocated bytes and the peak above the start of the stage
+    start, nested_peak = _stack.stages.pop()
+    current, peak = tracemalloc.get_traced_memory()
+    peak = max(peak, nested_peak)
+    if _stack.stages:
+        _stack.stages[-1][1] = max(_stack.stages[-1][1], peak)
+
+    return current - start, max(peak - start, 0)
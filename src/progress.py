@@ -0,0 +1,73 @@
+import sys
+import threading
+import time
+
+class SearchCancelled(Exception):
+    """
+    Raised by a search or planner when its cancellation token is cancelled.
+    """
+
+class CancellationToken:
+    """
+    Token shared between a long search and whoever may want to abort it, e.g. another thread.
+    The search checks the token between steps and raises SearchCancelled once it is cancelled.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise SearchCancelled('Search was cancelled.')
+
+class ProgressReporter:
+    """
+    Rate limited progress callback. The wrapped callback is called with the completed fraction at most
+    once every min_interval seconds, and always on completion.
+    """
+
+    def __init__(self, callback, min_interval=0.5):
+        self.callback = callback
+        self.min_interval = min_interval
+        self._last = -float('inf')
+
+    def __call__(self, fraction):
+        now = time.monotonic()
+        if now - self._last >= self.min_interval or fraction >= 1:
+            self._last = now
+            self.callback(fraction)
+
+def no_progress(fraction):
+    pass
+
+def write_progress(fraction, stream=None):
+    stream = stream or sys.stdout
+    stream.write(f'Progress: {fraction*100:.1f}%\r')
+    stream.flush()
+
+def get_progress_reporter(progress=None, min_interval=0.5):
+    """
+    Get the rate limited reporter of a progress callback.
+
+    :param progress: The callback taking the completed fraction, or None for the default reporter,
+                     which only writes to stdout if it is a TTY. Pass no_progress to disable reporting.
+    :param min_interval: The minimum time in seconds between two calls of the callback.
+    :return: The reporter.
+    """
+    if progress is None:
+        progress = write_progress if sys.stdout.isatty() else no_progress
+    if progress is no_progress or isinstance(progress, ProgressReporter):
+        return progress
+
+    return ProgressReporter(progress, min_interval)
+
+def check_cancelled(cancel):
+    if cancel is not None:
+        cancel.check()
@@ -1,9 +1,14 @@
 import numpy as np
 import scipy.linalg
 from logger import logger as log
-from celestial_bodies import get_positions, get_velocity
+from celestial_bodies import get_positions, get_velocity, get_fleet_states, get_target_position, report_geometry_error, get_orbit_step, propagate
+from profiling import profiled
+from progress import get_progress_reporter, check_cancelled
+from visibility import VisibilityConstraints, get_constrained_windows, get_window_times, iter_window_times, count_window_times, get_window
+from search import refine_extremum, bracket, orbit_search, chunked_search, best_of_chunks, chunk_length, AUTO_TOLERANCE_S, SWEEP_MEMORY_BUDGET
 import math
 
+@profiled('quaternion_math')
 def eci2LVLH(r_i, v_i):
     z_o = -r_i / np.linalg.norm(r_i)
     y_o = -np.cross(r_i, v_i)/np.linalg.norm(np.cross(r_i, v_i))
@@ -15,6 +20,29 @@ def eci2LVLH(r_i, v_i):
     
     return r_o, v_o, R_o_i
 
+@profiled('quaternion_math')
+def eci2LVLH_batch(r_i, v_i):
+    """
+    Compute the LVLH frames for many epochs at once.
+
+    Arguments:
+        r_i: array of shape (3, N), positions in ECI [km]
+        v_i: array of shape (3, N), velocities in ECI [km/s]
+
+    Returns:
+        R_o_i: array of shape (N, 3, 3), rotation matrices from ECI to the orbit frame
+    """
+    r_i = np.asarray(r_i).T
+    v_i = np.asarray(v_i).T
+    h_i = np.cross(r_i, v_i)
+    z_o = -r_i / np.linalg.norm(r_i, axis=1)[:, np.newaxis]
+    y_o = -h_i / np.linalg.norm(h_i, axis=1)[:, np.newaxis]
+    x_o = np.cross(y_o, z_o)
+    R_o_i = np.stack([x_o, y_o, z_o], axis=1)
+
+    return R_o_i
+
+@profiled('quaternion_math')
 def rot_rodrigues(a, b, theta):
     a_hat = a/np.linalg.norm(a)
     b_hat = b/np.linalg.norm(b)
@@ -37,6 +65,7 @@ def skew_sym(x):
     
     return S
     
+@profiled('quaternion_math')
 def rot2q(R):  
     theta = np.arccos((np.trace(R)-1)/2)
     if np.isclose(theta, 0):
@@ -56,6 +85,22 @@ def rot2q(R):
 def get_quaternion(time, earth, target, sat):
     sat_pos, target_pos = get_positions(time, target, sat, earth)
     sat_vel = get_velocity(time, sat)
+
+    return get_quaternion_from_state(sat_pos, sat_vel, target_pos)
+
+def get_quaternion_from_state(sat_pos, sat_vel, target_pos):
+    """
+    Compute the quaternion of get_quaternion from the satellite position and velocity and the target
+    position at the capture time, e.g. as already evaluated by the planner.
+
+    Arguments:
+        sat_pos: array of shape (3,), satellite position in km
+        sat_vel: array of shape (3,), satellite velocity in km/s
+        target_pos: array of shape (3,), target position in km
+
+    Returns:
+        array of shape (4,), quaternion q_ob
+    """
     log.debug('sat_pos: {}'.format(sat_pos))
     log.debug('sat_vel: {}'.format(sat_vel))
 
@@ -107,13 +152,261 @@ def get_off_nadir_angle(time, earth, target, sat):
 
     return off_nadir_angle
 
-def get_maximum_off_nadir_angle(t_start, t_end, obj, target, observer, search_interval = 1):
+def get_target_unit_vectors(times, earth, target, sat, geometry='precise'):
+    """
+    Compute the unit vector from a satellite to a target in the satellite's orbit frame for every
+    epoch in a skyfield time array.
+
+    The satellite and the target are propagated once for the whole array.
+
+    Arguments:
+        times: skyfield time object holding an array of times
+        earth: skyfield object, observer of the target
+        target: skyfield object
+        sat: skyfield object
+        geometry: str, 'precise' or 'fast' target positions, see celestial_bodies.get_target_position
+
+    Returns:
+        array of shape (N, 3), target unit vectors in the orbit frame
+    """
+    sat_state = propagate(times, sat)
+    sat_pos = sat_state.position.km
+    sat_vel = sat_state.velocity.km_per_s
+    target_pos = get_target_position(times, target, earth, geometry)
+
+    return target_unit_vectors_from_positions(sat_pos, sat_vel, target_pos)
+
+def target_unit_vectors_from_positions(sat_pos, sat_vel, target_pos):
+    """
+    Compute the unit vectors from a satellite to a target in the satellite's orbit frame.
+
+    Arguments:
+        sat_pos: array of shape (3, N), satellite positions in ECI [km]
+        sat_vel: array of shape (3, N), satellite velocities in ECI [km/s]
+        target_pos: array of shape (3, N), target positions in ECI [km]
+
+    Returns:
+        array of shape (N, 3), target unit vectors in the orbit frame
+    """
+    R_o_i = eci2LVLH_batch(sat_pos, sat_vel)
+
+    relative_pos = (target_pos - sat_pos).T
+    relative_pos_orbit = np.einsum('nij,nj->ni', R_o_i, relative_pos)
+
+    target_unit_vectors = relative_pos_orbit / np.linalg.norm(relative_pos_orbit, axis=1)[:, np.newaxis]
+
+    return target_unit_vectors
+
+@profiled('quaternion_math')
+def shortest_arc_quaternions(u):
+    """
+    Compute the quaternions of the shortest rotations taking the nadir axis z_o onto unit vectors u.
+
+    The quaternions are computed in closed form as [1 + z_o.u, z_o x u] normalized, and follow the
+    convention of get_quaternion, i.e. q_ob = [qs, qx, qy, qz]. For the nadir direction the identity
+    is returned. For the anti-nadir direction the rotation axis is not unique, and a rotation of 180
+    degrees about x_o is returned.
+
+    Arguments:
+        u: array of shape (N, 3), unit vectors in the orbit frame
+
+    Returns:
+        array of shape (N, 4), quaternions
+    """
+    u = np.atleast_2d(u)
+    q = np.zeros((len(u), 4))
+    q[:, 0] = 1 + u[:, 2]
+    q[:, 1] = -u[:, 1]
+    q[:, 2] = u[:, 0]
+
+    norm = np.linalg.norm(q, axis=1)
+    anti_nadir = norm < 1e-12
+    q[anti_nadir] = [0, 1, 0, 0]
+    norm[anti_nadir] = 1
+    q = q / norm[:, np.newaxis]
+
+    return q
+
+def get_quaternions(times, earth, target, sat):
+    """
+    Compute the quaternions pointing the satellite's z axis at a target for every epoch in a skyfield
+    time array. This is the batched, closed form equivalent of get_quaternion.
+
+    Arguments:
+        times: skyfield time object holding an array of times
+        earth: skyfield object, observer of the target
+        target: skyfield object
+        sat: skyfield object
+
+    Returns:
+        array of shape (N, 4), quaternions q_ob = [qs, qx, qy, qz]
+    """
+    target_unit_vectors = get_target_unit_vectors(times, earth, target, sat)
+
+    return shortest_arc_quaternions(target_unit_vectors)
+
+def get_off_nadir_angles(times, earth, target, sat, geometry='precise'):
+    """
+    Compute the off nadir angle of a target for every epoch in a skyfield time array.
+
+    Arguments:
+        times: skyfield time object holding an array of times
+        earth: skyfield object, observer of the target
+        target: skyfield object
+        sat: skyfield object
+        geometry: str, 'precise' or 'fast' target positions, see celestial_bodies.get_target_position
+
+    Returns:
+        array of shape (N,), off nadir angles in degrees
+    """
+    target_unit_vectors = get_target_unit_vectors(times, earth, target, sat, geometry)
+    off_nadir_angle = np.degrees(np.arccos(target_unit_vectors[:, 2]))
+
+    return off_nadir_angle
+
+def get_fleet_off_nadir_angles(times, earth, target, sats):
+    """
+    Compute the off nadir angle of a target for many satellites and every epoch in a skyfield time array.
+
+    The target is observed once for the time array, and all satellites are propagated together with
+    one batched SGP4 call.
+
+    Arguments:
+        times: skyfield time object holding an array of times
+        earth: skyfield object, observer of the target
+        target: skyfield object
+        sats: list of skyfield EarthSatellite objects
+
+    Returns:
+        array of shape (S, N), off nadir angles in degrees, NaN where SGP4 failed to propagate
+    """
+    sat_pos, sat_vel, errors = get_fleet_states(times, sats)
+    target_pos = get_target_position(times, target, earth)
+    n_sats, _, n_times = sat_pos.shape
+
+    # Flatten satellites and epochs into one batch of S*N samples
+    sat_pos = sat_pos.transpose(1, 0, 2).reshape(3, -1)
+    sat_vel = sat_vel.transpose(1, 0, 2).reshape(3, -1)
+    target_pos = np.tile(target_pos, n_sats)
+
+    target_unit_vectors = target_unit_vectors_from_positions(sat_pos, sat_vel, target_pos)
+    off_nadir_angle = np.degrees(np.arccos(target_unit_vectors[:, 2])).reshape(n_sats, n_times)
+    off_nadir_angle[errors] = np.nan
+
+    return off_nadir_angle
+
+def get_multi_target_off_nadir_angles(times, earth, targets, sat, geometry='precise'):
+    """
+    Compute the off nadir angles of many targets for a satellite and every epoch in a skyfield time array.
+
+    The satellite is propagated and its orbit frames are built once for the time array, each target is
+    only observed.
+
+    Arguments:
+        times: skyfield time object holding an array of times
+        earth: skyfield object, observer of the targets
+        targets: list of skyfield objects or EphemerisTables
+        sat: skyfield object
+        geometry: str, 'precise' or 'fast' target positions, see celestial_bodies.get_target_position
+
+    Returns:
+        array of shape (T, N), off nadir angles in degrees
     """
-    Find the time when the off nadir angle between a satellite and a target is at minimum within a timeframe.
+    sat_state = propagate(times, sat)
+    sat_pos = sat_state.position.km
+    R_o_i = eci2LVLH_batch(sat_pos, sat_state.velocity.km_per_s)
+    target_pos = np.stack([get_target_position(times, target, earth, geometry) for target in targets])
+
+    # The rotations of the epochs are shared by all targets
+    relative_pos_orbit = np.einsum('nij,tjn->tni', R_o_i, target_pos - sat_pos)
+    cos_off_nadir = relative_pos_orbit[:, :, 2] / np.linalg.norm(relative_pos_orbit, axis=2)
+
+    return np.degrees(np.arccos(np.clip(cos_off_nadir, -1, 1)))
+
+@profiled('quaternions.get_maximum_off_nadir_angle')
+def get_maximum_off_nadir_angle(t_start, t_end, obj, target, observer, search_interval = 1, batched=True, tolerance=None, progress=None, cancel=None, constraints=None, geometry='precise', memory_budget=SWEEP_MEMORY_BUDGET, geometry_report=None):
     """
+    Find the time when the off nadir angle between a satellite and a target is at maximum within a timeframe.
+
+    Arguments:
+        t_start: skyfield time object
+        t_end: skyfield time object
+        obj: skyfield object
+        target: skyfield object
+        observer: skyfield object
+        search_interval: float, time step in minutes, or 'auto' to derive it from the orbit, see celestial_bodies.get_orbit_step.
+            The best step of each revolution is then refined, to the tolerance or else AUTO_TOLERANCE_S, see search.orbit_search
+        batched: bool, evaluate the whole timeframe as one time array instead of one epoch at a time
+        tolerance: float, time tolerance in seconds. If set, the best step is refined with Brent's method
+        progress: function taking the completed fraction, rate limited. Default only writes to a TTY
+        cancel: progress.CancellationToken, raises progress.SearchCancelled once cancelled
+        constraints: visibility.VisibilityConstraints or dict. If set, only the visibility windows satisfying them are searched
+        geometry: str, 'precise' or 'fast' target positions for the scan, see celestial_bodies.get_target_position. The result
+            is always evaluated, and refined, with precise positions
+        memory_budget: float, peak memory in bytes of the batched scan, which evaluates the timeframe in chunks
+            fitting it, see search.chunked_search. None evaluates the whole timeframe as one array
+        geometry_report: function taking the error bound of the target positions of the scan, a dict as returned
+            by celestial_bodies.get_geometry_error, called once per search
+
+    Returns:
+        max_off_nadir: float, maximum off nadir angle in degrees
+        max_t: datetime object, time of maximum off nadir angle
+    """
+    
+    auto = search_interval == 'auto'
+    if auto:
+        period, search_interval = get_orbit_step(t_start, obj, target, observer)
+    else:
+        search_interval = search_interval * 1/24/60 # Transform from minutes to days
+    progress = get_progress_reporter(progress)
+    check_cancelled(cancel)
     
-    search_interval = search_interval * 1/24/60 # Transform from minutes to days
+    constraints = VisibilityConstraints.from_dict(constraints)
+    window = (t_start, t_end)
+    refined = False
+    
+    if constraints is not None:
+        # Only the epochs within the visibility windows are searched
+        windows = get_constrained_windows(t_start, t_end, obj, target, observer, constraints, search_interval)
+        log.debug('Looking for maximum off nadir angle between {} and {} in {} visibility windows with search_interval {}.'.format(obj.name, target, len(windows), search_interval))
+        if batched:
+            chunks = iter_window_times(windows, search_interval, chunk_length(memory_budget))
+            max_t, max_off_nadir = best_of_chunks(lambda t: get_off_nadir_angles(t, observer, target, obj, geometry), chunks, count_window_times(windows, search_interval), maximize=True, progress=progress, cancel=cancel)
+        else:
+            times = get_window_times(windows, search_interval)
+            off_nadir = np.array([get_off_nadir_angle(t, observer, target, obj) for t in times])
+            i_max = np.argmax(off_nadir)
+            max_off_nadir = float(off_nadir[i_max])
+            max_t = times[i_max]
+        window = get_window(max_t, windows)
+    elif batched and auto:
+        log.debug('Looking for maximum off nadir angle between {} and {} from {} to {} per revolution of {:.2f} min with search_interval {}.'.format(obj.name, target, t_start.tt_strftime('%Y-%m-%d %H:%M:%S'), t_end.tt_strftime('%Y-%m-%d %H:%M:%S'), period*24*60, search_interval))
+        max_t, max_off_nadir = orbit_search(lambda t: get_off_nadir_angles(t, observer, target, obj, geometry), t_start, t_end, period, search_interval, tolerance or AUTO_TOLERANCE_S, maximize=True, memory_budget=memory_budget, refine=None if geometry == 'precise' else lambda t: get_off_nadir_angles(t, observer, target, obj))
+        refined = True
+    elif batched:
+        log.debug('Looking for maximum off nadir angle between {} and {} from {} to {} with search_interval {} (batched).'.format(obj.name, target, t_start.tt_strftime('%Y-%m-%d %H:%M:%S'), t_end.tt_strftime('%Y-%m-%d %H:%M:%S'), search_interval))
+        max_t, max_off_nadir = chunked_search(lambda t: get_off_nadir_angles(t, observer, target, obj, geometry), t_start, t_end, search_interval, memory_budget, maximize=True, progress=progress, cancel=cancel)
+    else:
+        max_off_nadir, max_t = _iterate_maximum_off_nadir_angle(t_start, t_end, obj, target, observer, search_interval, progress, cancel)
     
+    # The iterative scan always uses precise positions
+    report_geometry_error(t_start, t_end, target, observer, geometry if batched else 'precise', geometry_report)
+    # The refinement of the orbit search is already precise
+    if geometry != 'precise' and batched and not refined:
+        max_off_nadir = float(get_off_nadir_angle(max_t, observer, target, obj))
+    
+    if tolerance is not None and not refined:
+        check_cancelled(cancel)
+        t_lo, t_hi = bracket(max_t, window[0], window[1], search_interval)
+        max_t, max_off_nadir = refine_extremum(lambda t: get_off_nadir_angle(t, observer, target, obj), t_lo, t_hi, max_t, max_off_nadir, tolerance, maximize=True)
+    
+    log.debug('Maximum off nadir angle found at {} with angle {} deg.'.format(max_t.utc_datetime(), max_off_nadir))
+    max_t = max_t.utc_datetime()
+    progress(1)
+    
+    return max_off_nadir, max_t
+
+def _iterate_maximum_off_nadir_angle(t_start, t_end, obj, target, observer, search_interval, progress, cancel):
     max_off_nadir = get_off_nadir_angle(t_start, observer, target, obj)
     max_t = t_start
     total_iterations = (t_end.tt - t_start.tt) / search_interval
@@ -121,8 +414,8 @@ def get_maximum_off_nadir_angle(t_start, t_end, obj, target, observer, search_in
     
     log.debug('Looking for maximum off nadir angle between {} and {} from {} to {} with search_interval {}.'.format(obj.name, target, t_start.tt_strftime('%Y-%m-%d %H:%M:%S'), t_end.tt_strftime('%Y-%m-%d %H:%M:%S'), search_interval))
     while t_start.tt + search_interval*iter < t_end.tt:
-        progress = iter / total_iterations * 100
-        print(f"Progress: {progress:.1f}%", end="\r")
+        progress(iter / total_iterations)
+        check_cancelled(cancel)
         
         iter += 1 
         t = t_start + search_interval*iter
@@ -131,7 +424,4 @@ def get_maximum_off_nadir_angle(t_start, t_end, obj, target, observer, search_in
             max_t = t
             max_off_nadir = off_nadir
     
-    log.debug('Maximum off nadir angle found at {} with angle {} deg.'.format(max_t.utc_datetime(), max_off_nadir))
-    max_t = max_t.utc_datetime()
-    
     return max_off_nadir, max_t
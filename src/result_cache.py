@@ -0,0 +1,155 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime
+import numpy as np
+from sgp4.exporter import export_tle
+from ephemeris_cache import EphemerisTable
+from logger import logger as log
+from profiling import profiled
+
+cache_file = 'src/data/result_cache/results.sqlite'
+
+# Part of every key, so results of an older version of the searches are never served
+cache_version = 1
+
+class ResultCache:
+    """
+    On-disk cache of planned captures, in SQLite. A capture is stored under a key of everything the
+    search depends on, see result_key, together with the catalog number and epoch of the element set
+    it was planned with.
+
+    Entries older than max_age_days are dropped, and beyond max_entries the least recently used ones
+    are dropped, whenever a capture is stored. Entries of older element sets of a satellite are dropped
+    by invalidate, which get_satellite calls for every element set it loads.
+
+    Every call opens its own connection, so the cache can be shared by threads and processes.
+    """
+
+    def __init__(self, path=cache_file, max_entries=10000, max_age_days=30):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with closing(self._connect()) as db, db:
+            db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, catnr INTEGER, epoch REAL, created REAL, used REAL, capture TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+            db.execute('CREATE INDEX IF NOT EXISTS results_catnr ON results (catnr, epoch)')
+
+    def __repr__(self):
+        return '<ResultCache {} max_entries={} max_age_days={}>'.format(self.path, self.max_entries, self.max_age_days)
+
+    def __len__(self):
+        with closing(self._connect()) as db:
+            return db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    @profiled('result_cache.get')
+    def get(self, key):
+        """
+        Get a cached capture.
+
+        Arguments:
+            key: str, as returned by result_key
+
+        Returns:
+            tuple of time, quaternion and off nadir angle, or None if the key is not cached
+        """
+        now = time.time()
+        with closing(self._connect()) as db, db:
+            row = db.execute('SELECT capture FROM results WHERE key = ? AND created >= ?', (key, now - self.max_age_days * 86400)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE results SET used = ? WHERE key = ?', (now, key))
+
+        return decode_capture(row[0])
+
+    def put(self, key, sat, capture):
+        """
+        Store a capture planned with the element set of sat, and evict old entries.
+
+        Arguments:
+            key: str, as returned by result_key
+            sat: skyfield EarthSatellite
+            capture: tuple of time, quaternion and off nadir angle
+        """
+        now = time.time()
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)', (key, sat.model.satnum, _epoch(sat), now, now, encode_capture(capture)))
+            self._evict(db, now)
+
+    def invalidate(self, sat):
+        """
+        Drop the entries planned with element sets of the satellite older than the one of sat.
+
+        Returns:
+            int, number of entries dropped
+        """
+        with closing(self._connect()) as db, db:
+            dropped = db.execute('DELETE FROM results WHERE catnr = ? AND epoch < ?', (sat.model.satnum, _epoch(sat))).rowcount
+        if dropped:
+            log.info('Dropped {} cached results of older element sets of {}'.format(dropped, sat.model.satnum))
+
+        return dropped
+
+    def clear(self):
+        with closing(self._connect()) as db, db:
+            db.execute('DELETE FROM results')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _evict(self, db, now):
+        db.execute('DELETE FROM results WHERE created < ?', (now - self.max_age_days * 86400,))
+        db.execute('DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+def result_key(sat, target, observer, t_start, t_end, search_interval, tolerance=None, constraints=None, geometry='precise'):
+    """
+    Build the cache key of the capture of a timeframe, from the element set, the target and observer, the
+    timeframe and every search setting.
+
+    Arguments:
+        sat: skyfield EarthSatellite
+        target: skyfield object or EphemerisTable
+        observer: skyfield object
+        t_start: skyfield time object
+        t_end: skyfield time object
+        search_interval: float, search step in minutes
+        tolerance: float, time tolerance of the refinement in seconds, or None
+        constraints: visibility.VisibilityConstraints or dict, or None
+        geometry: str, 'precise' or 'fast'
+
+    Returns:
+        str, the key
+    """
+    if isinstance(target, EphemerisTable):
+        # Interpolated positions give slightly different captures than the ephemeris itself
+        target = ['table', target.target, target.step, target.max_error]
+    else:
+        target = target.target
+    if constraints is not None and not isinstance(constraints, dict):
+        constraints = vars(constraints)
+
+    return json.dumps([cache_version, export_tle(sat.model), target, observer.target, '{:.9f}'.format(t_start.tt), '{:.9f}'.format(t_end.tt), search_interval, tolerance, constraints, geometry], sort_keys=True)
+
+def invalidate_results(sat, path=cache_file):
+    """
+    Drop the cached results of older element sets of a satellite, if there is a cache.
+    """
+    if os.path.exists(path):
+        ResultCache(path).invalidate(sat)
+
+def encode_capture(capture):
+    time, quaternion, off_nadir = capture
+
+    return json.dumps([time.isoformat(), [float(q) for q in quaternion], float(off_nadir)])
+
+def decode_capture(text):
+    time, quaternion, off_nadir = json.loads(text)
+
+    return datetime.fromisoformat(time), np.array(quaternion), off_nadir
+
+def _epoch(sat):
+    return sat.model.jdsatepoch + sat.model.jdsatepochF
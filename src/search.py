@@ -0,0 +1,306 @@
+import math
+import numpy as np
+import scipy.optimize
+from profiling import profiled
+from progress import check_cancelled
+
+DAY_S = 24*60*60
+# Time tolerance of the automatic step search when none is given, in seconds
+AUTO_TOLERANCE_S = 1.0
+# Peak memory of a batched sweep per epoch in bytes, mostly the nutation series of the TEME to GCRS
+# rotation of the satellite, and the default memory budget of the sweeps
+SWEEP_BYTES_PER_EPOCH = 24000
+SWEEP_MEMORY_BUDGET = 256 * 2**20
+
+def search_times(t_start, t_end, search_interval):
+    """
+    Build the array of epochs visited by a fixed step search over a timeframe.
+
+    The epochs are t_start and every search_interval after it, up to and including the first
+    epoch at or past t_end, i.e. exactly the epochs visited by the iterative searches.
+
+    Arguments:
+        t_start: skyfield time object
+        t_end: skyfield time object
+        search_interval: float, time step in days
+
+    Returns:
+        skyfield time object holding an array of times
+    """
+
+    n_max = max(math.ceil((t_end.tt - t_start.tt) / search_interval), 0) + 1
+    steps = np.arange(n_max + 1)
+    n = np.count_nonzero(t_start.tt + search_interval*steps < t_end.tt)
+
+    return t_start + search_interval*np.arange(n + 1)
+
+def chunk_length(memory_budget):
+    """
+    The number of epochs of a sweep chunk fitting a memory budget in bytes, or None for no limit.
+    """
+
+    if memory_budget is None:
+        return None
+
+    return max(int(memory_budget // SWEEP_BYTES_PER_EPOCH), 1)
+
+def iter_search_times(t_start, t_end, search_interval, chunk=None):
+    """
+    Build the epochs of search_times in chunks, without building the whole array.
+
+    Arguments:
+        t_start: skyfield time object
+        t_end: skyfield time object
+        search_interval: float, time step in days
+        chunk: int, number of epochs per chunk, or None for a single chunk
+
+    Yields:
+        skyfield time object holding an array of at most chunk times
+    """
+
+    if chunk is None:
+        yield search_times(t_start, t_end, search_interval)
+        return
+
+    k = 0
+    while True:
+        steps = k + np.arange(chunk)
+        # An epoch is visited if the step before it is still before t_end, as in search_times
+        steps = steps[(steps == 0) | (t_start.tt + search_interval*(steps - 1) < t_end.tt)]
+        if len(steps):
+            yield t_start + search_interval*steps
+        if len(steps) < chunk:
+            return
+        k += chunk
+
+@profiled('search.chunked_search')
+def chunked_search(f, t_start, t_end, search_interval, memory_budget=SWEEP_MEMORY_BUDGET, maximize=False, progress=None, cancel=None):
+    """
+    Find the best epoch of a fixed step search over a timeframe, evaluating the epochs of search_times
+    in chunks fitting a memory budget, see best_of_chunks.
+
+    Arguments:
+        f: function of a skyfield time object holding an array of times, returning an array of shape (N,), or (R, N) for
+            R searches over the same epochs
+        t_start: skyfield time object
+        t_end: skyfield time object
+        search_interval: float, time step in days
+        memory_budget: float, peak memory of a chunk in bytes, see SWEEP_BYTES_PER_EPOCH, or None for a single chunk
+        maximize: bool, look for a maximum instead of a minimum
+        progress: function taking the completed fraction, called after each chunk
+        cancel: progress.CancellationToken, checked before each chunk
+
+    Returns:
+        t: skyfield time object, best epoch, or array of the best epoch of each row
+        value: float, value of f at t, or array of the value of each row
+    """
+
+    total = max((t_end.tt - t_start.tt) / search_interval, 0) + 1
+    chunks = iter_search_times(t_start, t_end, search_interval, chunk_length(memory_budget))
+
+    return best_of_chunks(f, chunks, total, maximize, progress, cancel)
+
+def best_of_chunks(f, chunks, total=None, maximize=False, progress=None, cancel=None):
+    """
+    Find the best epoch of a search evaluated chunk by chunk, carrying the best epoch from chunk to chunk.
+
+    The result is the same as evaluating all epochs as one array, including the first of equal values.
+    Peak memory is that of one chunk.
+
+    Arguments:
+        f: function of a skyfield time object holding an array of times, returning an array of shape (N,), or (R, N) for
+            R searches over the same epochs
+        chunks: iterable of skyfield time objects holding arrays of times
+        total: float, number of epochs of all chunks, for the progress
+        maximize: bool, look for a maximum instead of a minimum
+        progress: function taking the completed fraction, called after each chunk
+        cancel: progress.CancellationToken, checked before each chunk
+
+    Returns:
+        t: skyfield time object, best epoch, or array of the best epoch of each row
+        value: float, value of f at t, or array of the value of each row
+    """
+
+    sign = -1 if maximize else 1
+    ts = None
+    done = 0
+
+    for times in chunks:
+        check_cancelled(cancel)
+        values = sign * np.asarray(f(times))
+        i = np.argmin(values, axis=-1)
+        f_chunk = np.take_along_axis(values, np.expand_dims(i, -1), -1)[..., 0]
+        whole = np.broadcast_to(times.whole, times.shape)[i]
+        fraction = times.tt_fraction[i]
+        if ts is None:
+            ts = times.ts
+            best_whole, best_fraction, f_best = whole, fraction, f_chunk
+        else:
+            better = f_chunk < f_best
+            best_whole = np.where(better, whole, best_whole)
+            best_fraction = np.where(better, fraction, best_fraction)
+            f_best = np.where(better, f_chunk, f_best)
+
+        done += len(times)
+        if progress is not None and total:
+            progress(min(done / total, 1))
+
+    if np.ndim(f_best) == 0:
+        return ts.tt_jd(best_whole, best_fraction), float(sign * f_best)
+
+    return ts.tt_jd(best_whole, best_fraction), sign * f_best
+
+@profiled('search.refine_extremum')
+def refine_extremum(f, t_lo, t_hi, t_best, f_best, tolerance, maximize=False):
+    """
+    Refine an extremum found by a coarse scan with Brent's method on a bracketing timeframe.
+
+    The number of evaluations of f grows with log(bracket width / tolerance).
+
+    Arguments:
+        f: function of a skyfield time object returning a float
+        t_lo: skyfield time object, lower end of the bracket
+        t_hi: skyfield time object, upper end of the bracket
+        t_best: skyfield time object, best epoch of the coarse scan
+        f_best: float, value of f at t_best
+        tolerance: float, time tolerance in seconds
+        maximize: bool, look for a maximum instead of a minimum
+
+    Returns:
+        t: skyfield time object, time of the refined extremum
+        value: float, value of f at t
+    """
+
+    sign = -1 if maximize else 1
+    width = (t_hi - t_lo) * DAY_S
+    if width <= tolerance:
+        return t_best, f_best
+
+    def objective(x):
+        return sign * f(t_lo + x/DAY_S)
+
+    res = scipy.optimize.minimize_scalar(objective, bounds=(0, width), method='bounded', options={'xatol': tolerance})
+    if res.fun < sign * f_best:
+        return t_lo + res.x/DAY_S, float(sign * res.fun)
+
+    return t_best, f_best
+
+def bracket(t_best, t_start, t_end, search_interval):
+    """
+    Bracket an epoch of a fixed step search by its neighbouring steps, clipped to the timeframe.
+
+    Arguments:
+        t_best: skyfield time object
+        t_start: skyfield time object
+        t_end: skyfield time object
+        search_interval: float, time step in days
+
+    Returns:
+        t_lo: skyfield time object
+        t_hi: skyfield time object
+    """
+
+    t_lo = t_best - min(search_interval, max(t_best - t_start, 0))
+    t_hi = t_best + min(search_interval, max(t_end - t_best, 0))
+
+    return t_lo, t_hi
+
+@profiled('search.orbit_search')
+def orbit_search(f, t_start, t_end, period, step, tolerance, maximize=False, memory_budget=SWEEP_MEMORY_BUDGET, refine=None):
+    """
+    Find the extremum of a function that has one peak per revolution of an orbit, with one candidate
+    per revolution.
+
+    The timeframe is sampled every step and split into revolutions of length period. The best sample
+    of each revolution is bracketed by its neighbouring samples, and all brackets are narrowed together
+    by a golden section search, evaluating f once per iteration for all revolutions. As long as f has a
+    single peak per revolution and the step resolves it, the bracket of the best revolution holds the
+    true extremum.
+
+    If f is approximate, e.g. with fast target positions, refine evaluates the brackets and the golden section
+    search instead, so only the choice of the best sample of each revolution is made on f.
+
+    Arguments:
+        f: function of a skyfield time object holding an array of times, returning an array
+        t_start: skyfield time object
+        t_end: skyfield time object
+        period: float, shortest time between two peaks in days
+        step: float, sampling step in days
+        tolerance: float, time tolerance in seconds
+        maximize: bool, look for a maximum instead of a minimum
+        memory_budget: float, peak memory of evaluating the samples in bytes, see chunked_search
+        refine: function as f, evaluating the refinement, or None to refine on f
+
+    Returns:
+        t: skyfield time object, time of the extremum
+        value: float, value of f at t
+    """
+
+    sign = -1 if maximize else 1
+    duration = t_end.tt - t_start.tt
+    offsets = np.append(np.arange(0, duration, step), duration)
+
+    chunk = chunk_length(memory_budget) or len(offsets)
+
+    def objective(g):
+        def evaluate(x):
+            # Offsets from t_start keep the epochs precise to well below a millisecond
+            return np.concatenate([sign * np.asarray(g(t_start.ts.tt_jd(t_start.whole, t_start.tt_fraction + x[i:i + chunk]))) for i in range(0, len(x), chunk)])
+        return evaluate
+
+    values = objective(f)(offsets)
+    revolutions = (offsets // period).astype(int)
+    order = np.lexsort((values, revolutions))
+    _, first = np.unique(revolutions[order], return_index=True)
+    best = order[first]
+
+    refined = objective(refine or f)
+    f_best = values[best] if refine is None else refined(offsets[best])
+
+    lo = np.maximum(offsets[best] - step, 0)
+    hi = np.minimum(offsets[best] + step, duration)
+    x, fx = golden_section(refined, lo, hi, tolerance / DAY_S)
+
+    # The refined point is never worse than the sample it started from
+    better = fx < f_best
+    x = np.where(better, x, offsets[best])
+    fx = np.where(better, fx, f_best)
+    i = np.argmin(fx)
+
+    return t_start.ts.tt_jd(t_start.whole, t_start.tt_fraction + x[i]), float(sign * fx[i])
+
+def golden_section(f, lo, hi, tolerance):
+    """
+    Minimize a function on many brackets at once with a golden section search.
+
+    Arguments:
+        f: function taking an array of points, one per bracket, and returning an array of values
+        lo: array, lower ends of the brackets
+        hi: array, upper ends of the brackets
+        tolerance: float, width of the brackets when the search stops
+
+    Returns:
+        x: array, minimum of each bracket
+        fx: array, value of f at x
+    """
+
+    invphi = (math.sqrt(5) - 1) / 2
+    a = np.array(lo, dtype=float)
+    b = np.array(hi, dtype=float)
+    c = b - invphi * (b - a)
+    d = a + invphi * (b - a)
+    fc = f(c)
+    fd = f(d)
+
+    while np.max(b - a) > tolerance:
+        left = fc < fd
+        # The minimum is in [a, d] where f(c) < f(d), else in [c, b]
+        b = np.where(left, d, b)
+        a = np.where(left, a, c)
+        new = np.where(left, b - invphi * (b - a), a + invphi * (b - a))
+        f_new = f(new)
+        c, d, fc, fd = np.where(left, new, d), np.where(left, c, new), np.where(left, f_new, fd), np.where(left, fc, f_new)
+
+    left = fc < fd
+
+    return np.where(left, c, d), np.where(left, fc, fd)
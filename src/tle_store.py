@@ -0,0 +1,224 @@
+import bisect
+import datetime
+import glob
+import math
+import os
+import urllib.parse
+import urllib.request
+from sgp4.api import jday
+from skyfield.api import EarthSatellite
+from ephemeris import get_timescale
+from config_reader import locked
+from logger import logger as log
+from profiling import profiled
+
+store_path = 'src/data/tle_files/'
+gp_url = 'http://celestrak.org/NORAD/elements/gp.php'
+
+def parse_tle_text(text):
+    """
+    Parse two- or three-line element sets from a TLE file or a GP response in TLE format.
+
+    Arguments:
+        text: str, contents of the file
+
+    Returns:
+        list of tuples (catnr, epoch, name, line1, line2), with epoch as a UTC Julian date
+    """
+    elements = []
+    name = None
+    lines = [line.rstrip() for line in text.splitlines() if line.strip()]
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.startswith('1 ') and i + 1 < len(lines) and lines[i + 1].startswith('2 '):
+            line1, line2 = line, lines[i + 1]
+            catnr = int(line1[2:7])
+            elements.append((catnr, tle_epoch(line1), name or str(catnr), line1, line2))
+            name = None
+            i += 2
+        else:
+            name = line.strip()
+            i += 1
+
+    return elements
+
+def tle_epoch(line1):
+    """
+    Read the epoch of an element set from its first line.
+
+    Arguments:
+        line1: str, first line of the element set
+
+    Returns:
+        float, epoch as a UTC Julian date
+    """
+    year = int(line1[18:20])
+    year += 2000 if year < 57 else 1900
+    day = float(line1[20:32])
+
+    return datetime.date(year, 1, 1).toordinal() + 1721424.5 + day - 1
+
+class TLEStore:
+    """
+    Local store of element sets indexed by catalog number and epoch.
+
+    Element sets are ingested from bulk GP responses (a whole group, or any multi-object file) and
+    appended to an archive file, so every element set ever pulled stays available offline. Each
+    catalog number keeps its epochs sorted together with a per-day index, so the element set nearest
+    to a time is found by looking at a handful of candidates.
+
+    In offline mode the store never downloads, and only serves what is already on disk.
+    """
+
+    def __init__(self, path=store_path, url=gp_url, offline=False, ts=None):
+        self.path = path
+        self.url = url
+        self.offline = offline
+        self.ts = ts or get_timescale()
+        self.archive = os.path.join(path, 'tle-archive.txt')
+        self._elements = {}
+        self._epochs = {}
+        self._days = {}
+        self._satellites = {}
+
+        # Files written by earlier versions are ingested as well
+        for filename in sorted(glob.glob(os.path.join(path, 'tle-*.txt'))):
+            with open(filename) as f:
+                self._add(parse_tle_text(f.read()))
+
+    def __contains__(self, catnr):
+        return int(catnr) in self._elements
+
+    def catnrs(self):
+        return sorted(self._elements)
+
+    @profiled('tle_store.fetch')
+    def fetch(self, catnr=None, group=None, timeout=30):
+        """
+        Download element sets in one GP request and ingest them.
+
+        Arguments:
+            catnr: int, catalog number of a single satellite
+            group: str, Celestrak group name, e.g. 'stations', for all its satellites
+            timeout: float, request timeout in seconds
+
+        Returns:
+            int, number of new element sets
+        """
+        if self.offline:
+            raise RuntimeError('TLE store is in offline mode, cannot fetch {}.'.format(catnr or group))
+
+        query = {'CATNR': catnr} if catnr is not None else {'GROUP': group}
+        query['FORMAT'] = 'tle'
+        url = self.url + '?' + urllib.parse.urlencode(query)
+        log.info('Fetching TLE data from {}...'.format(url))
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            text = response.read().decode('ascii', errors='replace')
+
+        new = self.ingest(text)
+        log.info('Ingested {} new element sets.'.format(new))
+
+        return new
+
+    def ingest(self, text):
+        """
+        Ingest element sets from the contents of a TLE file, and append the new ones to the archive.
+
+        Arguments:
+            text: str, contents of the file
+
+        Returns:
+            int, number of new element sets
+        """
+        new = self._add(parse_tle_text(text))
+        if new:
+            os.makedirs(self.path, exist_ok=True)
+            with locked(self.archive), open(self.archive, 'a') as f:
+                for catnr, epoch, name, line1, line2 in new:
+                    f.write('{}\n{}\n{}\n'.format(name, line1, line2))
+
+        return len(new)
+
+    def ingest_file(self, filename):
+        with open(filename) as f:
+            return self.ingest(f.read())
+
+    def latest(self, catnr):
+        """
+        Get the satellite built from the most recent element set of a catalog number.
+        """
+        catnr = int(catnr)
+        if catnr not in self._elements:
+            raise KeyError('No element sets for catalog number {} in the TLE store.'.format(catnr))
+
+        return self._satellite(catnr, len(self._epochs[catnr]) - 1)
+
+    def nearest(self, catnr, t):
+        """
+        Get the satellite built from the element set with the epoch nearest to a time.
+
+        Arguments:
+            catnr: int, catalog number
+            t: skyfield time object or float, UTC Julian date
+
+        Returns:
+            skyfield EarthSatellite
+        """
+        catnr = int(catnr)
+        if catnr not in self._elements:
+            raise KeyError('No element sets for catalog number {} in the TLE store.'.format(catnr))
+
+        # The epochs are UTC Julian dates
+        jd = sum(jday(*t.utc)) if hasattr(t, 'utc') else t
+        epochs = self._epochs[catnr]
+        first_day, index = self._days[catnr]
+        day = math.floor(jd) - first_day
+        if day < 0:
+            return self._satellite(catnr, 0)
+        if day >= len(index):
+            return self._satellite(catnr, len(epochs) - 1)
+
+        # Skip the epochs of this day before jd, the nearest is then either side of jd
+        i = index[day]
+        while i < len(epochs) and epochs[i] < jd:
+            i += 1
+        if i == len(epochs) or (i > 0 and jd - epochs[i - 1] <= epochs[i] - jd):
+            i -= 1
+
+        return self._satellite(catnr, i)
+
+    def _satellite(self, catnr, i):
+        key = (catnr, self._epochs[catnr][i])
+        if key not in self._satellites:
+            _, _, name, line1, line2 = self._elements[catnr][i]
+            self._satellites[key] = EarthSatellite(line1, line2, name, self.ts)
+
+        return self._satellites[key]
+
+    def _add(self, elements):
+        new = []
+        changed = set()
+        for element in elements:
+            catnr, epoch = element[0], element[1]
+            epochs = self._epochs.setdefault(catnr, [])
+            i = bisect.bisect_left(epochs, epoch)
+            if i < len(epochs) and epochs[i] == epoch:
+                continue
+            epochs.insert(i, epoch)
+            self._elements.setdefault(catnr, []).insert(i, element)
+            new.append(element)
+            changed.add(catnr)
+
+        for catnr in changed:
+            self._index(catnr)
+
+        return new
+
+    def _index(self, catnr):
+        # index[d] is the position of the first epoch on or after day first_day + d
+        epochs = self._epochs[catnr]
+        first_day = math.floor(epochs[0])
+        n_days = math.floor(epochs[-1]) - first_day + 1
+        index = [bisect.bisect_left(epochs, first_day + d) for d in range(n_days)]
+        self._days[catnr] = (first_day, index)
@@ -0,0 +1,219 @@
+import math
+import numpy as np
+from skyfield.searchlib import find_discrete
+from celestial_bodies import get_target_position, propagate
+from ephemeris import get_ephemeris
+from logger import logger as log
+from profiling import profiled
+
+EARTH_RADIUS_KM = 6378.137
+
+class NoVisibilityWindow(ValueError):
+    """
+    Raised by a constrained search when no time of the timeframe satisfies the constraints.
+    """
+
+class VisibilityConstraints:
+    """
+    Conditions a capture has to satisfy to be flown. A constraint set to None is not checked.
+
+    Arguments:
+        earth_occlusion: bool, the line of sight to the target must clear the Earth's limb
+        limb_margin_km: float, height above the Earth's surface the line of sight must clear
+        sunlit: bool, True if the satellite must be sunlit, False if it must be in eclipse
+        min_sun_angle: float, minimum angle between the line of sight and the Sun in degrees
+        max_off_nadir: float, maximum off nadir angle of the line of sight in degrees
+    """
+
+    def __init__(self, earth_occlusion=True, limb_margin_km=0.0, sunlit=None, min_sun_angle=None, max_off_nadir=None):
+        self.earth_occlusion = earth_occlusion
+        self.limb_margin_km = limb_margin_km
+        self.sunlit = sunlit
+        self.min_sun_angle = min_sun_angle
+        self.max_off_nadir = max_off_nadir
+
+    def __repr__(self):
+        return '<VisibilityConstraints earth_occlusion={} limb_margin_km={} sunlit={} min_sun_angle={} max_off_nadir={}>'.format(self.earth_occlusion, self.limb_margin_km, self.sunlit, self.min_sun_angle, self.max_off_nadir)
+
+    @classmethod
+    def from_dict(cls, constraints):
+        return constraints if constraints is None or isinstance(constraints, cls) else cls(**constraints)
+
+    @profiled('visibility.mask')
+    def mask(self, times, sat, target, observer):
+        """
+        Check the constraints at every epoch of a skyfield time array.
+
+        Arguments:
+            times: skyfield time object holding an array of times
+            sat: skyfield EarthSatellite
+            target: skyfield object or EphemerisTable
+            observer: skyfield object, the Earth
+
+        Returns:
+            array of shape (N,), True where all constraints are satisfied
+        """
+        sat_pos = propagate(times, sat).position.km
+        target_pos = get_target_position(times, target, observer)
+        valid = np.ones(sat_pos.shape[1], dtype=bool)
+
+        if self.earth_occlusion:
+            valid &= ~_blocked_by_earth(sat_pos, target_pos, EARTH_RADIUS_KM + self.limb_margin_km)
+        if self.max_off_nadir is not None:
+            valid &= _angle(target_pos - sat_pos, -sat_pos) <= self.max_off_nadir
+        if self.sunlit is not None or self.min_sun_angle is not None:
+            sun_pos = get_target_position(times, get_ephemeris()['sun'], observer)
+            if self.sunlit is not None:
+                valid &= _blocked_by_earth(sat_pos, sun_pos, EARTH_RADIUS_KM) != self.sunlit
+            if self.min_sun_angle is not None:
+                valid &= _angle(target_pos - sat_pos, sun_pos - sat_pos) >= self.min_sun_angle
+
+        return valid
+
+@profiled('visibility.get_visibility_windows')
+def get_visibility_windows(t_start, t_end, sat, target, observer, constraints, step=1/24/60):
+    """
+    Find the timeframes within t_start to t_end where all constraints are satisfied.
+
+    The constraints are sampled every step, and each change between two samples is located by
+    bisection down to a millisecond, so the edges of the windows do not depend on the step. Windows
+    shorter than the step may be missed.
+
+    Arguments:
+        t_start: skyfield time object
+        t_end: skyfield time object
+        sat: skyfield EarthSatellite
+        target: skyfield object or EphemerisTable
+        observer: skyfield object, the Earth
+        constraints: VisibilityConstraints
+        step: float, sampling step in days
+
+    Returns:
+        list of tuples (t_a, t_b) of skyfield time objects, in time order
+    """
+    def valid(t):
+        return constraints.mask(t, sat, target, observer).astype(int)
+    valid.step_days = step
+
+    edges, values = find_discrete(t_start, t_end, valid)
+
+    windows = []
+    t_a = t_start if valid(t_start.ts.tt_jd(np.atleast_1d(t_start.whole), np.atleast_1d(t_start.tt_fraction)))[0] else None
+    for t, value in zip(edges, values):
+        if value:
+            t_a = t
+        elif t_a is not None:
+            windows.append((t_a, t))
+            t_a = None
+    if t_a is not None:
+        windows.append((t_a, t_end))
+
+    log.debug('Visibility windows for {}: {}'.format(constraints, ', '.join('{} - {}'.format(t_a.utc_iso(), t_b.utc_iso()) for t_a, t_b in windows)))
+
+    return windows
+
+def get_window_times(windows, search_interval):
+    """
+    Build the epochs of a fixed step search within visibility windows. Each window is searched from
+    its start every search_interval, and at its end.
+
+    Arguments:
+        windows: list of tuples (t_a, t_b) of skyfield time objects
+        search_interval: float, time step in days
+
+    Returns:
+        skyfield time object holding an array of times
+    """
+    times, = iter_window_times(windows, search_interval)
+
+    return times
+
+def iter_window_times(windows, search_interval, chunk=None):
+    """
+    Build the epochs of get_window_times in chunks, without building the whole array. A chunk can hold
+    the epochs of several windows.
+
+    Arguments:
+        windows: list of tuples (t_a, t_b) of skyfield time objects
+        search_interval: float, time step in days
+        chunk: int, number of epochs per chunk, or None for a single chunk
+
+    Yields:
+        skyfield time object holding an array of at most chunk times
+    """
+    ts = windows[0][0].ts
+    whole = []
+    fraction = []
+    size = 0
+    for w, f in _window_pieces(windows, search_interval, chunk):
+        while len(f):
+            take = len(f) if chunk is None else min(len(f), chunk - size)
+            whole.append(w[:take])
+            fraction.append(f[:take])
+            size += take
+            w, f = w[take:], f[take:]
+            if size == chunk:
+                yield ts.tt_jd(np.concatenate(whole), np.concatenate(fraction))
+                whole, fraction, size = [], [], 0
+    if size:
+        yield ts.tt_jd(np.concatenate(whole), np.concatenate(fraction))
+
+def count_window_times(windows, search_interval):
+    """
+    The number of epochs of get_window_times.
+    """
+    return sum(_steps(t_a, t_b, search_interval) + 1 for t_a, t_b in windows)
+
+def _window_pieces(windows, search_interval, chunk):
+    # The epochs of each window, the steps from its start in pieces of at most chunk and then its end
+    for t_a, t_b in windows:
+        n = _steps(t_a, t_b, search_interval)
+        piece = chunk or max(n, 1)
+        for k in range(0, n, piece):
+            offsets = np.arange(k, min(k + piece, n)) * search_interval
+            yield np.full(len(offsets), t_a.whole), t_a.tt_fraction + offsets
+        yield np.array([t_a.whole]), np.array([(t_b.whole - t_a.whole) + t_b.tt_fraction])
+
+def _steps(t_a, t_b, search_interval):
+    # Length of np.arange(0, t_b.tt - t_a.tt, search_interval)
+    return max(math.ceil((t_b.tt - t_a.tt) / search_interval), 0)
+
+def get_constrained_windows(t_start, t_end, sat, target, observer, constraints, search_interval):
+    """
+    Get the visibility windows of a timeframe, sampled at the search step or every 5 minutes if shorter.
+
+    Raises NoVisibilityWindow if no time satisfies the constraints.
+
+    Returns:
+        list of tuples (t_a, t_b) of skyfield time objects
+    """
+    windows = get_visibility_windows(t_start, t_end, sat, target, observer, constraints, min(search_interval, 1/24/60*5))
+    if not windows:
+        raise NoVisibilityWindow('No time from {} to {} satisfies {}'.format(t_start.utc_iso(), t_end.utc_iso(), constraints))
+
+    return windows
+
+def get_window(t, windows):
+    """
+    Get the visibility window containing time t.
+    """
+    for t_a, t_b in windows:
+        if t_a.tt <= t.tt <= t_b.tt:
+            return t_a, t_b
+
+    raise ValueError('{} is not in a visibility window'.format(t.utc_iso()))
+
+def _blocked_by_earth(origin, point, radius):
+    # True where the segment from origin to point passes through the sphere of radius around the Earth's center
+    d = point - origin
+    length = np.linalg.norm(d, axis=0)
+    d = d / length
+    s = -np.sum(origin * d, axis=0)
+    closest = np.linalg.norm(origin + s * d, axis=0)
+
+    return (s > 0) & (s < length) & (closest < radius)
+
+def _angle(a, b):
+    cos = np.sum(a * b, axis=0) / (np.linalg.norm(a, axis=0) * np.linalg.norm(b, axis=0))
+
+    return np.degrees(np.arccos(np.clip(cos, -1, 1)))
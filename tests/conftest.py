@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'src'))
+
+from skyfield.api import load_file, EarthSatellite
+import ephemeris
+
+# The modules use paths relative to the repository root
+os.chdir(root)
+
+data = os.path.join(root, 'tests', 'data')
+
+# An excerpt of de421.bsp covering 2015-02-27 to 2015-03-07
+ephemeris._ephemeris = load_file(os.path.join(data, 'de421.bsp'))
+
+ISS = ('ISS',
+       '1 25544U 98067A   15060.50000000  .00016717  00000-0  10270-3 0  9005',
+       '2 25544  51.6416 247.4627 0006703 130.5360 325.0288 15.72125391563537')
+
+@pytest.fixture(scope='session')
+def ts():
+    return ephemeris.get_timescale()
+
+@pytest.fixture(scope='session')
+def planets():
+    return ephemeris.get_ephemeris()
+
+@pytest.fixture(scope='session')
+def earth(planets):
+    return planets['earth']
+
+@pytest.fixture(scope='session')
+def moon(planets):
+    return planets[301]
+
+@pytest.fixture(scope='session')
+def sat(ts):
+    return EarthSatellite(ISS[1], ISS[2], ISS[0], ts)
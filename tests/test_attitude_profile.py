@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from datetime import datetime, timezone
+from attitude_profile import get_attitude_profile, write_attitude_profile, read_attitude_profile
+from quaternions import get_quaternion, get_off_nadir_angle
+
+@pytest.fixture
+def captures(ts, sat, earth, moon):
+    times = [ts.utc(2015, 3, 1, 0, 11, 53.8), ts.utc(2015, 3, 1, 3, 15, 27.3)]
+    return [(t.utc_datetime(), get_quaternion(t, earth, moon, sat), get_off_nadir_angle(t, earth, moon, sat)) for t in times]
+
+def test_profile_matches_get_quaternion(ts, sat, earth, moon, captures):
+    profile = get_attitude_profile(captures, sat, moon, earth, ts, 2, [3, 4.2])
+
+    assert list(profile['capture']) == [1] * 7 + [2] * 9
+    assert np.all(np.diff(profile['time']) > 0)
+    for k, (capture, duration) in enumerate(zip(captures, (3, 4.2)), 1):
+        assert profile['time'][profile['capture'] == k][0] == pytest.approx(capture[0].timestamp() - duration / 2)
+    for sample in profile:
+        t = ts.from_datetime(datetime.fromtimestamp(sample['time'], timezone.utc))
+        assert np.allclose([sample['qs'], sample['qx'], sample['qy'], sample['qz']], get_quaternion(t, earth, moon, sat), rtol=0, atol=1e-6)
+        assert sample['off_nadir_deg'] == pytest.approx(get_off_nadir_angle(t, earth, moon, sat), abs=1e-4)
+
+@pytest.mark.parametrize('extension', ['.csv', '.bin'])
+def test_round_trip(tmp_path, ts, sat, earth, moon, captures, extension):
+    profile = get_attitude_profile(captures, sat, moon, earth, ts, 10, 2)
+    path = str(tmp_path / ('profile' + extension))
+    write_attitude_profile(path, profile)
+
+    assert np.array_equal(read_attitude_profile(path), profile)
+
+def test_empty_profile(ts, sat, earth, moon):
+    assert len(get_attitude_profile([], sat, moon, earth, ts, 10, 2)) == 0
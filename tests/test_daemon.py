@@ -0,0 +1,77 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+import daemon as daemon_module
+from batch import InvalidJob, PlannerState, make_job
+from daemon import PlannerDaemon
+from result_cache import ResultCache
+
+@pytest.fixture
+def daemon(ts, sat, tmp_path):
+    state = PlannerState(ts, results=ResultCache(str(tmp_path / 'results.sqlite')))
+    # The satellite is served without downloading its element set
+    state._satellites[25544] = sat
+    daemon = PlannerDaemon(port=0, state=state)
+    thread = threading.Thread(target=daemon.server.serve_forever, daemon=True)
+    thread.start()
+    yield daemon
+    daemon.shutdown()
+    daemon.server.server_close()
+
+def post(daemon, path, body):
+    request = urllib.request.Request('http://{}:{}{}'.format(*daemon.address, path), data=json.dumps(body).encode(), method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+@pytest.mark.parametrize('body', [
+    {'mode': 'x'},
+    {'mode': 'multi'},
+    {'catnr': 'iss'},
+    {'search_interval': 0},
+    {'geometry': 'rough'},
+    {'tolerance': -1},
+    {'cache_results': 'no'},
+    {'constraints': {'min_moon_angle': 10}},
+    {'start': 'yesterday'},
+    {'unknown': 1},
+    [],
+])
+def test_invalid_request(daemon, body):
+    status, response = post(daemon, '/single', body)
+    assert status == 400
+    assert response['error']
+
+def test_unknown_path(daemon):
+    assert post(daemon, '/x', {})[0] == 404
+
+def test_plan(daemon, tmp_path):
+    status, response = post(daemon, '/single', {'catnr': 25544, 'target': 301, 'start': '2015-03-01T00:00:00Z', 'end': '2015-03-01T02:00:00Z'})
+    assert status == 200
+    assert len(response['captures']) == 1
+    assert (tmp_path / 'results.sqlite').exists()
+
+def test_internal_error(daemon, monkeypatch):
+    def plan_job(job, state, t_now):
+        raise KeyError('internal')
+    monkeypatch.setattr(daemon_module, 'plan_job', plan_job)
+
+    status, response = post(daemon, '/single', {})
+    assert status == 500
+
+def test_make_job():
+    job = make_job({'mode': 'fleet', 'catnr': [51053, 25544], 'constraints': {'max_off_nadir': 60}})
+    assert job['catnr'] == [51053, 25544]
+    assert job['name'] == 'job'
+
+    with pytest.raises(InvalidJob):
+        make_job({'mode': 'single', 'catnr': [51053, 25544]})
+    with pytest.raises(InvalidJob):
+        make_job({'mode': 'multi', 'intervals': 1.5})
+    with pytest.raises(InvalidJob):
+        make_job({'mode': 'multi', 'target': 10, 'max_phase_angle': 30})
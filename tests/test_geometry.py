@@ -0,0 +1,43 @@
+import pytest
+from celestial_bodies import get_geometry_error
+from ephemeris_cache import EphemerisTable
+from quaternions import get_maximum_off_nadir_angle
+from distances import get_minimum_distance
+
+@pytest.mark.parametrize('geometry', ['precise', 'fast'])
+def test_fast_geometry_with_table_target(geometry, ts, sat, moon, earth):
+    t_start, t_end = ts.utc(2015, 3, 1, 6), ts.utc(2015, 3, 1, 12)
+    table = EphemerisTable.build(t_start, t_end, moon, earth)
+    reports = []
+
+    angle, _ = get_maximum_off_nadir_angle(t_start, t_end, sat, table, earth, 1, progress=lambda f: None, geometry=geometry, geometry_report=reports.append)
+    distance, _ = get_minimum_distance(t_start, t_end, sat, table, earth, 1, progress=lambda f: None, geometry=geometry, geometry_report=reports.append)
+
+    assert len(reports) == 2
+    for report in reports:
+        assert report['geometry'] == geometry
+        assert report['timing_error_s'] == 0
+        assert report['position_error_km'] == table.max_error
+
+def test_fast_geometry_error_bound(ts, sat, moon, earth):
+    t_start, t_end = ts.utc(2015, 3, 1), ts.utc(2015, 3, 2)
+    precise, _ = get_maximum_off_nadir_angle(t_start, t_end, sat, moon, earth, 1, progress=lambda f: None)
+    reports = []
+    fast, _ = get_maximum_off_nadir_angle(t_start, t_end, sat, moon, earth, 1, progress=lambda f: None, geometry='fast', geometry_report=reports.append)
+
+    assert reports[0]['timing_error_s'] > 0
+    assert reports[0]['angular_error_deg'] < 1e-3
+    assert abs(fast - precise) < 1e-3
+
+def test_unknown_geometry(ts, moon, earth):
+    with pytest.raises(ValueError):
+        get_geometry_error(ts.utc(2015, 3, 1), ts.utc(2015, 3, 2), moon, earth, 'rough')
+
+@pytest.mark.parametrize('search', [get_maximum_off_nadir_angle, get_minimum_distance])
+def test_auto_step_refines_with_precise_positions(search, ts, sat, moon, earth):
+    t_start, t_end = ts.utc(2015, 3, 1), ts.utc(2015, 3, 1, 12)
+    precise = search(t_start, t_end, sat, moon, earth, 'auto', progress=lambda f: None, tolerance=0.01)
+    fast = search(t_start, t_end, sat, moon, earth, 'auto', progress=lambda f: None, tolerance=0.01, geometry='fast')
+
+    # Only the choice of the best sample per revolution is made on fast positions
+    assert fast == precise
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+from distances import distances_obj_to_target
+from hypso_moon_script_cmd_generator import get_capture_metadata
+from planner import multi_planner
+from quaternions import get_quaternion
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_metadata_from_planner_positions(ts, sat, moon, earth, planets, workers):
+    positions = []
+    results = multi_planner(ts.utc(2015, 3, 1), ts.utc(2015, 3, 1, 6), sat, moon, earth, 3, 1, ts, workers=workers, positions=positions)
+    metadata = get_capture_metadata(results, positions)
+
+    times = ts.from_datetimes([result[0] for result in results])
+    assert len(positions) == len(results) == len(metadata) == 3
+    assert [capture['d_sat_moon'] for capture in metadata.values()] == np.round(distances_obj_to_target(times, sat, moon, earth)).astype(int).tolist()
+    # The Sun to Moon distance of the apparent geocentric positions
+    sun_moon = np.linalg.norm(earth.at(times).observe(moon).position.km - earth.at(times).observe(planets['sun']).position.km, axis=0)
+    assert [capture['d_sun_moon'] for capture in metadata.values()] == np.round(sun_moon).astype(int).tolist()
+    for i, (time, quaternion, _) in enumerate(results):
+        assert np.array_equal(quaternion, get_quaternion(times[i], earth, moon, sat))
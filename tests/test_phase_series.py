@@ -0,0 +1,43 @@
+import pytest
+import moon_sun_earth_angle
+import planner
+from moon_sun_earth_angle import PhaseSeries, get_phase_series
+
+@pytest.fixture
+def cache_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(moon_sun_earth_angle, 'cache_path', str(tmp_path))
+    return tmp_path
+
+def test_covering_series_is_reused(cache_path, ts, monkeypatch):
+    series = get_phase_series(ts.utc(2015, 2, 28), ts.utc(2015, 3, 5))
+    assert len(list(cache_path.iterdir())) == 1
+
+    def build(*args, **kwargs):
+        raise AssertionError('Series rebuilt')
+    monkeypatch.setattr(PhaseSeries, 'build', build)
+
+    t_start, t_end = ts.utc(2015, 3, 1, 6), ts.utc(2015, 3, 2, 18)
+    reused = get_phase_series(t_start, t_end)
+    assert reused.tt_start == series.tt_start
+    assert reused.min_phase(t_start, t_end) == series.min_phase(t_start, t_end)
+
+def test_uncovered_series_is_built(cache_path, ts):
+    get_phase_series(ts.utc(2015, 3, 1), ts.utc(2015, 3, 2))
+    series = get_phase_series(ts.utc(2015, 3, 1), ts.utc(2015, 3, 4))
+
+    assert series.covers(ts.utc(2015, 3, 1), ts.utc(2015, 3, 4))
+    assert len(list(cache_path.iterdir())) == 2
+
+def test_multi_planner_phase_filter(cache_path, ts, sat, earth, moon, planets, monkeypatch):
+    t_start, t_end = ts.utc(2015, 3, 1), ts.utc(2015, 3, 1, 12)
+    get_phase_series(t_start, t_end)
+
+    def build(*args, **kwargs):
+        raise AssertionError('Series rebuilt')
+    monkeypatch.setattr(PhaseSeries, 'build', build)
+
+    # The series of the planning timeframe is reused
+    assert len(planner.multi_planner(t_start, t_end, sat, moon, earth, 2, 1, ts, max_phase_angle=180)) == 2
+    assert planner.multi_planner(t_start, t_end, sat, moon, earth, 2, 1, ts, max_phase_angle=1) == []
+    with pytest.raises(ValueError):
+        planner.multi_planner(t_start, t_end, sat, planets['sun'], earth, 2, 1, ts, max_phase_angle=180)
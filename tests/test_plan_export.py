@@ -0,0 +1,40 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+import batch
+from plan_export import PlanWriter, get_plan_writer, read_plan
+
+capture = (datetime(2015, 3, 1, 0, 11, 53, 826870, tzinfo=timezone.utc), np.array([0.35, 0.93, 0.0006, 0.0]), 138.52)
+
+def test_writer_without_overrides(tmp_path):
+    class IncompleteWriter(PlanWriter):
+        @staticmethod
+        def format(nr, capture):
+            return str(nr)
+
+    with pytest.raises(TypeError):
+        IncompleteWriter(str(tmp_path / 'plan.txt'))
+
+@pytest.mark.parametrize('extension', ['.txt', '.csv', '.jsonl'])
+def test_round_trip(tmp_path, extension):
+    path = str(tmp_path / ('plan' + extension))
+    with get_plan_writer(path) as writer:
+        writer.write(capture)
+        writer.write(capture, 3)
+
+    (time, quaternion, off_nadir), _ = read_plan(path)
+    assert time == capture[0]
+    assert np.allclose(quaternion, capture[1])
+    assert off_nadir == pytest.approx(capture[2])
+
+def test_failed_job_leaves_no_results_file(tmp_path, monkeypatch):
+    def plan_job(job, state, t_now):
+        yield capture
+        raise RuntimeError('planning failed')
+    monkeypatch.setattr(batch, 'plan_job', plan_job)
+    job = batch.make_job({'mode': 'multi', 'name': 'failing'})
+
+    with pytest.raises(RuntimeError):
+        batch.run_job(job, None, None, str(tmp_path))
+    assert not (tmp_path / 'failing.txt').exists()
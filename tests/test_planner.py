@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import planner
+from skyfield.api import EarthSatellite
+from celestial_bodies import get_fleet_states, get_interval_states
+from conftest import ISS
+
+@pytest.mark.parametrize('tolerance', [None, 0.01])
+def test_multi_target_planner_matches_multi_planner(ts, sat, earth, moon, planets, tolerance):
+    t_start, t_end = ts.utc(2015, 3, 1), ts.utc(2015, 3, 1, 6)
+    targets = [moon, planets['sun'], planets['mars barycenter']]
+    plans = planner.multi_target_planner(t_start, t_end, sat, targets, earth, 2, 1, ts, tolerance, progress=lambda f: None)
+
+    assert len(plans) == len(targets)
+    for target, plan in zip(targets, plans):
+        expected = planner.multi_planner(t_start, t_end, sat, target, earth, 2, 1, ts, tolerance, progress=lambda f: None)
+        assert [capture[0] for capture in plan] == [capture[0] for capture in expected]
+        for (_, quaternion, off_nadir), (_, expected_quaternion, expected_off_nadir) in zip(plan, expected):
+            assert np.allclose(quaternion, expected_quaternion, atol=1e-9)
+            assert off_nadir == pytest.approx(expected_off_nadir, abs=1e-9)
+
+def test_fleet_states_match_skyfield(ts, sat):
+    # A second satellite with the same elements at an epoch an hour earlier
+    other = EarthSatellite(ISS[1].replace('15060.50000000', '15060.45833333'), ISS[2], 'ISS-2', ts)
+    times = ts.utc(2015, 3, 1, 0, np.arange(0, 600, 7))
+    positions, velocities, errors = get_fleet_states(times, [sat, other])
+
+    assert not errors.any()
+    for s, satellite in enumerate([sat, other]):
+        state = satellite.at(times)
+        assert np.allclose(positions[s], state.position.km, rtol=0, atol=1e-6)
+        assert np.allclose(velocities[s], state.velocity.km_per_s, rtol=0, atol=1e-9)
+
+def test_interval_states_match_skyfield(ts, sat):
+    centres = ts.utc(2015, 3, 1, [1, 5])
+    counts = np.array([3, 4])
+    times = ts.tt_jd(np.repeat(centres.whole, counts), np.repeat(centres.tt_fraction, counts) + np.array([-1, 0, 1, -2, -1, 1, 2]) / 86400)
+    positions, velocities = get_interval_states(times, sat, centres, counts)
+
+    state = sat.at(times)
+    assert np.allclose(positions, state.position.km, rtol=0, atol=1e-3)
+    assert np.allclose(velocities, state.velocity.km_per_s, rtol=0, atol=1e-6)
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+@pytest.mark.parametrize('tolerance, constraints', [(None, None), (0.01, {'max_off_nadir': 90})])
+def test_parallel_multi_planner_matches_serial(ts, sat, earth, moon, pool, tolerance, constraints):
+    t_start, t_end = ts.utc(2015, 3, 1), ts.utc(2015, 3, 1, 12)
+    expected = list(planner.iter_multi_planner(t_start, t_end, sat, moon, earth, 6, 1, ts, tolerance, progress=lambda f: None, constraints=constraints))
+    planned = list(planner.iter_multi_planner(t_start, t_end, sat, moon, earth, 6, 1, ts, tolerance, workers=2, pool=pool, progress=lambda f: None, constraints=constraints))
+
+    assert [i for i, _ in planned] == sorted(i for i, _ in planned) == [i for i, _ in expected]
+    for (_, (t, quaternion, off_nadir)), (_, (expected_t, expected_quaternion, expected_off_nadir)) in zip(planned, expected):
+        assert t == expected_t
+        assert np.allclose(quaternion, expected_quaternion, rtol=0, atol=1e-12)
+        assert off_nadir == pytest.approx(expected_off_nadir, abs=1e-12)
+
+def test_replan_matches_multi_planner(ts, sat, earth, moon):
+    t_start, t_end = ts.utc(2015, 3, 1), ts.utc(2015, 3, 1, 12)
+    plan = planner.multi_planner(t_start, t_end, sat, moon, earth, 6, 1, ts, 0.01, progress=lambda f: None)
+    # The same elements at an epoch a minute earlier, which moves the captures by about a minute
+    new_sat = EarthSatellite(ISS[1].replace('15060.50000000', '15060.49930556'), ISS[2], 'ISS', ts)
+
+    for satellite in (sat, new_sat):
+        captures, diff = planner.replan(plan, t_start, t_end, satellite, moon, earth, 6, 1, ts, 0.01, progress=lambda f: None)
+        expected = planner.multi_planner(t_start, t_end, satellite, moon, earth, 6, 1, ts, 0.01, progress=lambda f: None)
+
+        assert [entry['interval'] for entry in diff] == list(range(6))
+        assert [entry['method'] for entry in diff] == ['refined'] * 6
+        assert len(captures) == len(expected)
+        for (t, quaternion, off_nadir), (expected_t, expected_quaternion, expected_off_nadir) in zip(captures, expected):
+            assert abs((t - expected_t).total_seconds()) < 0.1
+            assert np.allclose(quaternion, expected_quaternion, rtol=0, atol=1e-5)
+            assert off_nadir == pytest.approx(expected_off_nadir, abs=1e-4)
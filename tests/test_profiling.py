@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+import planner
+from profiling import disable_profiling, enable_profiling, profiled, stage
+
+@pytest.fixture
+def profile():
+    yield enable_profiling()
+    disable_profiling()
+
+def test_numpy_memory(profile):
+    @profiled('allocate')
+    def allocate():
+        with stage('inner'):
+            data = np.ones(2**20)
+            del data
+        return np.ones(2**17)
+
+    kept = allocate()
+    stages = profile.to_dict()
+    # The 8 MiB array freed by the inner stage is its peak, and the peak of the enclosing stage
+    assert stages['inner']['peak_bytes'] >= 8 * 2**20
+    assert stages['allocate']['peak_bytes'] >= 8 * 2**20
+    assert abs(stages['inner']['allocated_bytes']) < 2**16
+    assert stages['allocate']['allocated_bytes'] >= kept.nbytes
+
+def test_worker_stages(profile, ts, sat, earth, moon):
+    t_start = ts.utc(2015, 3, 1)
+    t_end = ts.utc(2015, 3, 1, 4)
+    planner.multi_planner(t_start, t_end, sat, moon, earth, 2, 1, ts, workers=2, pool='process')
+
+    stages = profile.to_dict()
+    # Each time frame is planned in a worker process and profiled there
+    assert stages['planner.multi_planner']['calls'] == 1
+    assert stages['quaternions.get_maximum_off_nadir_angle']['calls'] == 2
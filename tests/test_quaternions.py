@@ -0,0 +1,15 @@
+import numpy as np
+import pytest
+from quaternions import get_quaternion, get_quaternions, get_off_nadir_angle, get_off_nadir_angles
+
+@pytest.mark.parametrize('name', ['moon', 'sun', 'mars barycenter'])
+def test_batched_quaternions_match_get_quaternion(ts, sat, earth, planets, name):
+    target = planets[name]
+    times = ts.utc(2015, 3, 1, 0, np.arange(0, 24 * 60, 37))
+    quaternions = get_quaternions(times, earth, target, sat)
+    off_nadir = get_off_nadir_angles(times, earth, target, sat)
+
+    assert quaternions.shape == (len(times), 4)
+    for t, q, angle in zip(times, quaternions, off_nadir):
+        assert np.allclose(q, get_quaternion(t, earth, target, sat), rtol=0, atol=1e-9)
+        assert angle == pytest.approx(get_off_nadir_angle(t, earth, target, sat), abs=1e-9)
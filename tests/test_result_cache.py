@@ -0,0 +1,27 @@
+import numpy as np
+import planner
+from ephemeris_cache import EphemerisTable
+from result_cache import ResultCache, result_key
+
+def test_cache_hit_with_table_target(tmp_path, monkeypatch, ts, sat, moon, earth):
+    t_start, t_end = ts.utc(2015, 3, 1, 6), ts.utc(2015, 3, 1, 12)
+    table = EphemerisTable.build(t_start, t_end, moon, earth)
+    cache = ResultCache(str(tmp_path / 'results.sqlite'))
+
+    planned = planner.single_planner(t_start, t_end, sat, table, earth, 1, ts, progress=lambda f: None, cache=cache)
+    assert len(cache) == 1
+
+    def search(*args, **kwargs):
+        raise AssertionError('searched instead of serving the cached capture')
+    monkeypatch.setattr(planner, 'get_maximum_off_nadir_angle', search)
+    cached = planner.single_planner(t_start, t_end, sat, table, earth, 1, ts, progress=lambda f: None, cache=cache)
+
+    assert cached[0] == planned[0]
+    assert np.allclose(cached[1], planned[1])
+    assert cached[2] == planned[2]
+
+def test_table_and_ephemeris_keys_differ(ts, sat, moon, earth):
+    t_start, t_end = ts.utc(2015, 3, 1, 6), ts.utc(2015, 3, 1, 12)
+    table = EphemerisTable.build(t_start, t_end, moon, earth)
+
+    assert result_key(sat, table, earth, t_start, t_end, 1) != result_key(sat, moon, earth, t_start, t_end, 1)
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import planner
+from search import search_times, iter_search_times, chunked_search
+from visibility import VisibilityConstraints, get_visibility_windows, get_window_times, iter_window_times, count_window_times
+from quaternions import get_maximum_off_nadir_angle, get_off_nadir_angles
+from distances import get_minimum_distance
+
+@pytest.mark.parametrize('chunk', [1, 7, 1000, None])
+def test_chunked_epochs(ts, chunk):
+    t_start = ts.utc(2015, 3, 1)
+    for t_end, step in ((t_start + 1, 1/24/60), (t_start + 0.37, 7/86400)):
+        full = search_times(t_start, t_end, step).tt
+        assert np.array_equal(np.concatenate([times.tt for times in iter_search_times(t_start, t_end, step, chunk)]), full)
+
+@pytest.mark.parametrize('chunk', [1, 7, 1000, None])
+def test_chunked_window_epochs(ts, sat, moon, earth, chunk):
+    windows = get_visibility_windows(ts.utc(2015, 3, 1), ts.utc(2015, 3, 2), sat, moon, earth, VisibilityConstraints(max_off_nadir=90))
+    full = get_window_times(windows, 1/24/60)
+    chunks = list(iter_window_times(windows, 1/24/60, chunk))
+
+    assert len(full) == count_window_times(windows, 1/24/60)
+    assert np.array_equal(np.concatenate([times.tt for times in chunks]), full.tt)
+    if chunk is not None:
+        assert max(len(times) for times in chunks) <= chunk
+
+@pytest.mark.parametrize('constraints', [None, {'max_off_nadir': 90}])
+def test_memory_budget_gives_the_same_capture(ts, sat, moon, earth, constraints):
+    t_start, t_end = ts.utc(2015, 3, 1), ts.utc(2015, 3, 2)
+    for search in (get_maximum_off_nadir_angle, get_minimum_distance):
+        full = search(t_start, t_end, sat, moon, earth, 1, progress=lambda f: None, constraints=constraints, memory_budget=None)
+        fractions = []
+        chunked = search(t_start, t_end, sat, moon, earth, 1, progress=fractions.append, constraints=constraints, memory_budget=2**20)
+        assert chunked == full
+        assert fractions == sorted(fractions) and fractions[-1] == 1
+
+def test_chunked_rows(ts, sat, moon, earth, planets):
+    t_start, t_end = ts.utc(2015, 3, 1), ts.utc(2015, 3, 1, 12)
+    targets = [moon, planets['sun']]
+    times, values = chunked_search(lambda t: np.stack([get_off_nadir_angles(t, earth, target, sat) for target in targets]), t_start, t_end, 1/24/60, 2**20, maximize=True)
+    for k, target in enumerate(targets):
+        t, value = chunked_search(lambda t: get_off_nadir_angles(t, earth, target, sat), t_start, t_end, 1/24/60, None, maximize=True)
+        assert times[k].tt == t.tt and values[k] == value
+
+def test_planners_memory_budget(ts, sat, moon, earth, planets):
+    t_start, t_end = ts.utc(2015, 3, 1), ts.utc(2015, 3, 2)
+    for memory_budget in (None, 2**20):
+        fleet = planner.fleet_planner(t_start, t_end, [sat, sat], moon, earth, 2, 1, ts, progress=lambda f: None, memory_budget=memory_budget)
+        targets = planner.multi_target_planner(t_start, t_end, sat, [moon, planets['sun']], earth, 2, 1, ts, progress=lambda f: None, memory_budget=memory_budget)
+        plans = [[(capture[0], capture[2]) for capture in plan] for plan in fleet + targets]
+        if memory_budget is None:
+            expected = plans
+    assert plans == expected
+    assert [capture[0] for capture in plans[0]] == [capture[0] for capture in plans[2]]
+    assert plans[0] == plans[1]
+
+@pytest.mark.parametrize('constraints', [None, {'max_off_nadir': 90}])
+def test_batched_search_matches_iterative(ts, sat, moon, earth, constraints):
+    t_start, t_end = ts.utc(2015, 3, 1), ts.utc(2015, 3, 1, 6)
+    for search in (get_maximum_off_nadir_angle, get_minimum_distance):
+        value, t = search(t_start, t_end, sat, moon, earth, 1, progress=lambda f: None, constraints=constraints)
+        expected_value, expected_t = search(t_start, t_end, sat, moon, earth, 1, batched=False, progress=lambda f: None, constraints=constraints)
+        assert abs((t - expected_t).total_seconds()) < 1e-3
+        assert value == pytest.approx(expected_value, rel=1e-9)
+
+def test_refined_extremum_matches_fine_search(ts, sat, moon, earth):
+    t_start, t_end = ts.utc(2015, 3, 1), ts.utc(2015, 3, 1, 6)
+    for search, sign in ((get_maximum_off_nadir_angle, 1), (get_minimum_distance, -1)):
+        value, t = search(t_start, t_end, sat, moon, earth, 1, tolerance=0.01, progress=lambda f: None)
+        fine_value, fine_t = search(t_start, t_end, sat, moon, earth, 1/60, progress=lambda f: None)
+        assert abs((t - fine_t).total_seconds()) <= 1
+        assert sign * value >= sign * fine_value - 1e-9 * abs(fine_value)
@@ -0,0 +1,111 @@
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from celestial_bodies import get_satellites_from_store
+from tle_store import TLEStore
+
+from conftest import ISS
+
+def element_set(day):
+    # The ISS element set with its epoch moved to a day of 2015
+    line1 = ISS[1][:20] + '{:012.8f}'.format(day) + ISS[1][32:68]
+    checksum = sum(int(c) if c.isdigit() else c == '-' for c in line1) % 10
+
+    return 'ISS (ZARYA)\n{}{}\n{}\n'.format(line1, checksum, ISS[2])
+
+class GPServer:
+    """
+    A local stand-in for the GP endpoint serving canned responses by catalog number or group.
+    """
+
+    def __init__(self):
+        self.responses = {}
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(url.query)
+                server.requests.append(query)
+                key = query.get('CATNR', query.get('GROUP', [None]))[0]
+                body = server.responses.get(key, 'No GP data found').encode('ascii')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/NORAD/elements/gp.php'.format(self.httpd.server_address[1])
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+@pytest.fixture
+def gp():
+    server = GPServer()
+    yield server
+    server.close()
+
+def test_fetch_and_cache_hit(tmp_path, gp, ts):
+    gp.responses['25544'] = element_set(60.5)
+    store = TLEStore(str(tmp_path), gp.url, ts=ts)
+
+    assert store.fetch(catnr=25544) == 1
+    assert gp.requests == [{'CATNR': ['25544'], 'FORMAT': ['tle']}]
+    assert 25544 in store
+
+    # The store already holds the catalog number, so nothing is downloaded
+    sat, = get_satellites_from_store([25544], ts.utc(2015, 3, 1), store)
+    assert len(gp.requests) == 1
+    assert sat.name == 'ISS (ZARYA)'
+
+def test_archive_append(tmp_path, gp, ts):
+    gp.responses['stations'] = element_set(60.5) + element_set(61.25)
+    store = TLEStore(str(tmp_path), gp.url, ts=ts)
+    assert store.fetch(group='stations') == 2
+    assert gp.requests[-1]['GROUP'] == ['stations']
+
+    # Element sets already in the store are not appended again
+    gp.responses['stations'] = element_set(61.25) + element_set(62.0)
+    assert store.fetch(group='stations') == 1
+
+    with open(store.archive) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 9
+    assert [line[18:32] for line in lines[1::3]] == ['15060.50000000', '15061.25000000', '15062.00000000']
+
+def test_offline_fallback(tmp_path, gp, ts):
+    gp.responses['25544'] = element_set(60.5) + element_set(61.25) + element_set(62.0)
+    TLEStore(str(tmp_path), gp.url, ts=ts).fetch(catnr=25544)
+    requests = len(gp.requests)
+
+    store = TLEStore(str(tmp_path), gp.url, offline=True, ts=ts)
+    with pytest.raises(RuntimeError):
+        store.fetch(catnr=25544)
+
+    # Served from the archive, the element set nearest to the time through the per-day index
+    for t, epoch in ((ts.utc(2015, 2, 20), 60.5), (ts.utc(2015, 3, 2, 9), 61.25), (ts.utc(2015, 3, 2, 20), 62.0), (ts.utc(2015, 3, 10), 62.0)):
+        sat, = get_satellites_from_store([25544], t, store, force_update=True)
+        assert sat.model.epochdays == epoch
+    assert len(gp.requests) == requests
+
+    with pytest.raises(KeyError):
+        store.nearest(51053, ts.utc(2015, 3, 1))
+
+def test_nearest_by_utc(tmp_path, gp, ts):
+    gp.responses['25544'] = element_set(60.0) + element_set(61.0)
+    store = TLEStore(str(tmp_path), gp.url, ts=ts)
+    store.fetch(catnr=25544)
+
+    # Just after the midpoint of the epochs in UTC, but before it in UT1, which is half a second behind
+    assert store.nearest(25544, ts.utc(2015, 3, 1, 12, 0, 0.3)).model.epochdays == 61.0
+    assert store.nearest(25544, ts.utc(2015, 3, 1, 11, 59, 59.7)).model.epochdays == 60.0
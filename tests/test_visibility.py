@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+from visibility import VisibilityConstraints, NoVisibilityWindow, get_constrained_windows, get_window, iter_window_times
+
+def test_window_times_inside_windows(ts, sat, moon, earth):
+    t_start, t_end = ts.utc(2015, 3, 1), ts.utc(2015, 3, 2)
+    windows = get_constrained_windows(t_start, t_end, sat, moon, earth, VisibilityConstraints(max_off_nadir=90), 1/24/60)
+    times = np.concatenate([chunk.tt for chunk in iter_window_times(windows, 1/24/60, 100)])
+
+    assert len(windows) > 1
+    for t in ts.tt_jd(times):
+        get_window(t, windows)
+
+    for t_a, t_b in windows:
+        window_times = times[(times >= t_a.tt) & (times <= t_b.tt + 1e-9)]
+        assert window_times[0] == t_a.tt
+        assert abs(window_times[-1] - t_b.tt) < 1e-9
+        assert np.all(np.diff(window_times) > 0)
+
+def test_no_visibility_window(ts, sat, moon, earth):
+    with pytest.raises(NoVisibilityWindow):
+        get_constrained_windows(ts.utc(2015, 3, 1), ts.utc(2015, 3, 1, 2), sat, moon, earth, VisibilityConstraints(max_off_nadir=0), 1/24/60)